@@ -0,0 +1,115 @@
+#
+# archipelConnectionPool.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelConnectionPool, that allows to run the XMPP streams of
+a lot of entities using a small and fixed number of threads, instead of
+one thread per entity.
+"""
+
+import threading
+
+from archipel.utils import *
+from archipelReactor import TNArchipelReactor
+
+
+class TNArchipelConnectionPool:
+    """
+    this class manages a fixed set of L{TNArchipelReactor}, each one running
+    in its own thread, and dispatches entities on the least loaded one
+    """
+
+    def __init__(self, size):
+        """
+        the contructor of the class
+
+        @type size: int
+        @param size: the number of reactor threads
+        """
+        self.reactors   = []
+        self.threads    = []
+        self.entities   = {}
+        self.lock       = threading.Lock()
+        for i in range(size):
+            reactor = TNArchipelReactor(name="ArchipelReactor-%d" % i)
+            self.reactors.append(reactor)
+            self.threads.append(threading.Thread(target=reactor.run, name=reactor.name))
+
+
+    def start(self):
+        """
+        start all the reactors
+        """
+        for thread in self.threads:
+            thread.start()
+        log.info("CONNECTIONPOOL: started with %d reactors" % len(self.reactors))
+
+
+    def stop(self):
+        """
+        stop all the reactors
+        """
+        for reactor in self.reactors:
+            reactor.stop()
+
+
+    def join(self):
+        """
+        wait for all the reactors to be stopped
+        """
+        for thread in self.threads:
+            while thread.isAlive():
+                thread.join(1.0)
+
+
+    def attach(self, entity):
+        """
+        add an entity to the pool. The entity will be connected and
+        its loop will be run by one of the reactors
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to attach
+        """
+        self.lock.acquire()
+        reactor = min(self.reactors, key=lambda r: r.count())
+        self.entities[entity.jid.getStripped()] = entity
+        self.lock.release()
+        reactor.add_entity(entity)
+
+
+    def detach(self, jid):
+        """
+        forget the entity with given JID. The reactor will drop the entity
+        by itself once its loop status is OFF
+
+        @type jid: xmpp.JID
+        @param jid: the JID of the entity
+        """
+        self.lock.acquire()
+        if self.entities.has_key(jid.getStripped()):
+            del self.entities[jid.getStripped()]
+        self.lock.release()
+
+
+    def get_entity(self, jid):
+        """
+        @type jid: xmpp.JID
+        @param jid: the JID of the entity
+        @rtype: L{TNArchipelEntity}
+        @return: the entity with given JID or None
+        """
+        return self.entities.get(jid.getStripped(), None)
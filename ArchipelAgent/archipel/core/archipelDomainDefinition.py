@@ -0,0 +1,85 @@
+#
+# archipelDomainDefinition.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelDomainDefinition, the parsed libvirt XML description of a
+domain, with precomputed views used by the virtual machine.
+"""
+
+import xmpp
+
+
+class TNArchipelDomainDefinition:
+    """
+    this class holds the parsed XML description of a domain. It is built once
+    each time the description changes, and gives direct access to the
+    interfaces, disks and graphics of the domain.
+    """
+
+    def __init__(self, xmlstring):
+        """
+        the contructor of the class
+
+        @type xmlstring: string
+        @param xmlstring: the XML description returned by libvirt
+        """
+        self.xmlstring  = xmlstring
+        self.node       = xmpp.simplexml.NodeBuilder(data=xmlstring).getDom()
+        self.nics       = []
+        self.disks      = []
+        self.aliases    = []
+        self.vnc_port   = -1
+
+        devices = self.node.getTag("devices")
+        if not devices:
+            return
+
+        for device in devices.getChildren():
+            if not isinstance(device, xmpp.Node):
+                continue
+            alias = device.getTag("alias")
+            if alias and alias.getAttr("name"):
+                self.aliases.append(alias.getAttr("name"))
+
+        for nic in devices.getTags("interface"):
+            alias   = nic.getTag("alias")
+            target  = nic.getTag("target")
+            self.nics.append({  "name": alias and alias.getAttr("name") or None,
+                                "target": target and target.getAttr("dev") or None,
+                                "mac": nic.getTag("mac") and nic.getTag("mac").getAttr("address") or None})
+
+        for disk in devices.getTags("disk"):
+            source  = disk.getTag("source")
+            target  = disk.getTag("target")
+            self.disks.append({ "device": disk.getAttr("device"),
+                                "path": source and (source.getAttr("file") or source.getAttr("dev")) or None,
+                                "target": target and target.getAttr("dev") or None})
+
+        graphics = devices.getTag("graphics")
+        if graphics and graphics.getAttr("port"):
+            self.vnc_port = int(graphics.getAttr("port"))
+
+
+    def get_public_node(self):
+        """
+        @rtype: xmpp.Node
+        @return: a copy of the description without the archipel private description tag
+        """
+        node = xmpp.simplexml.Node(node=self.node)
+        if node.getTag("description"):
+            node.delChild("description")
+        return node
@@ -37,6 +37,8 @@ import sqlite3
 from archipel.utils import *
 import archipel.core.pubsub
 import archipel.core.archipelPermissionCenter
+import archipel.core.archipelReconnectScheduler
+from archipel.core.archipelIQStats import iqstats
 
 
 ARCHIPEL_ERROR_CODE_AVATARS             = -1
@@ -93,6 +95,9 @@ class TNArchipelEntity:
         self.messages_registrar     = []
         self.isAuth                 = False
         self.loop_status            = ARCHIPEL_XMPP_LOOP_OFF
+        self.loop_restart_date      = 0
+        self.reactor                = None
+        self.executor               = None
         self.pubsubserver           = self.configuration.get("GLOBAL", "xmpp_pubsub_server")
         self.log                    = TNArchipelLogger(self)
         self.pubSubNodeEvent        = None
@@ -103,6 +108,10 @@ class TNArchipelEntity:
         self.default_avatar         = "default.png"
         self.entity_type            = "not-defined"
         self.permission_center      = None
+        self.push_coalescing_delay  = 0
+        self.pending_pushes         = []
+        self.pending_pushes_lock    = threading.Lock()
+        self.pending_pushes_timer   = None
         
         if self.name == "auto":
             self.name = self.resource
@@ -114,6 +123,9 @@ class TNArchipelEntity:
             self.ipaddr = socket.gethostbyname(socket.gethostname())
         else:
             self.ipaddr = ip_conf
+        
+        if self.configuration.has_option("GLOBAL", "push_coalescing_delay"):
+            self.push_coalescing_delay = self.configuration.getfloat("GLOBAL", "push_coalescing_delay")
     
     
     def initialize_modules(self):
@@ -130,7 +142,7 @@ class TNArchipelEntity:
         """check is iq is a valid ACP and return action"""
         try:
             action = iq.getTag("query").getTag("archipel").getAttr("action")
-            self.log.info("acp received: from: %s, type: %s, namespace: %s, action: %s" % (iq.getFrom(), iq.getType(), iq.getQueryNS(), action))
+            self.log.info("acp received: from: %s, type: %s, namespace: %s, action: %s", iq.getFrom(), iq.getType(), iq.getQueryNS(), action)
             return action
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_NS_ERROR_QUERY_NOT_WELL_FORMED)
@@ -179,7 +191,7 @@ class TNArchipelEntity:
         @type prefix: string
         @param prefix: the prefix of action_name (for example if permission if health_get and action is get, you can give 'health_' as prefix)
         """
-        self.log.info("checking permission for action %s%s asked by %s" % (prefix, action_name, stanza.getFrom()))
+        self.log.info("checking permission for action %s%s asked by %s", prefix, action_name, stanza.getFrom())
         if not self.permission_center.check_permission(str(stanza.getFrom().getStripped()), "%s%s" % (prefix, action_name)):
             conn.send(build_error_iq(self, "Cannot use '%s': permission denied" % action_name, stanza, code=error_code, ns=ARCHIPEL_NS_PERMISSION_ERROR))
             raise xmpp.protocol.NodeProcessed
@@ -198,11 +210,14 @@ class TNArchipelEntity:
         if self.xmppclient.connect() == "":
             self.log.error("unable to connect to XMPP server")
             if self.auto_reconnect:
-                self.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+                self.schedule_reconnect()
                 return False
             else:
                 sys.exit(-1)
         
+        # measure all the IQ handlers registered from now
+        iqstats.instrument(self.xmppclient)
+        
         self.loop_status = ARCHIPEL_XMPP_LOOP_ON
         self.log.info("sucessfully connected")
         return True
@@ -239,8 +254,19 @@ class TNArchipelEntity:
             self.log.warning("trying to connect, but already connected. ignoring")
             return
         
-        if self.connect_xmpp():
-            self.auth_xmpp()
+        scheduler = archipel.core.archipelReconnectScheduler.scheduler
+        if not scheduler.acquire_handshake():
+            self.log.debug("too many XMPP handshakes in progress. delaying connection")
+            self.schedule_restart(scheduler.admission_delay())
+            return
+        try:
+            if self.connect_xmpp():
+                self.auth_xmpp()
+        finally:
+            scheduler.release_handshake()
+        
+        if self.isAuth and self.loop_status == ARCHIPEL_XMPP_LOOP_ON:
+            scheduler.entity_connected(self)
     
     
     def disconnect(self):
@@ -257,14 +283,19 @@ class TNArchipelEntity:
     def recover_pubsubs(self):
         """
         create or get the current hypervisor pubsub node.
+        The requests of all the nodes are sent at once, without waiting for the answers.
+        On reconnection, the nodes are kept and only their new items are retrieved
         """
+        def get_node(node, nodename):
+            if node and node.nodename == nodename:
+                node.xmppclient = self.xmppclient
+                return node
+            return archipel.core.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, nodename)
+        
         # creating/getting the event pubsub node
         eventNodeName = "/archipel/" + self.jid.getStripped() + "/events"
-        self.pubSubNodeEvent = archipel.core.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, eventNodeName)
-        
-        if not self.pubSubNodeEvent.recover():
-            self.pubSubNodeEvent.create()
-        self.pubSubNodeEvent.configure({
+        self.pubSubNodeEvent = get_node(self.pubSubNodeEvent, eventNodeName)
+        self.pubSubNodeEvent.ensure({
             archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
             archipel.core.pubsub.XMPP_PUBSUB_VAR_DELIVER_NOTIFICATION: 1,
             archipel.core.pubsub.XMPP_PUBSUB_VAR_PERSIST_ITEMS: 0,
@@ -275,10 +306,8 @@ class TNArchipelEntity:
         
         # creating/getting the log pubsub node
         logNodeName = "/archipel/" + self.jid.getStripped() + "/logs"
-        self.pubSubNodeLog = archipel.core.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, logNodeName)
-        if not self.pubSubNodeLog.recover():
-            self.pubSubNodeLog.create()
-        self.pubSubNodeLog.configure({
+        self.pubSubNodeLog = get_node(self.pubSubNodeLog, logNodeName)
+        self.pubSubNodeLog.ensure({
                 archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
                 archipel.core.pubsub.XMPP_PUBSUB_VAR_DELIVER_NOTIFICATION: 1,
                 archipel.core.pubsub.XMPP_PUBSUB_VAR_MAX_ITEMS: self.configuration.get("LOGGING", "log_pubsub_max_items"),
@@ -290,9 +319,11 @@ class TNArchipelEntity:
         
         # creating/getting the tags pubsub node
         tagsNodeName = "/archipel/tags"
-        self.pubSubNodeTags = archipel.core.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, tagsNodeName)
-        if not self.pubSubNodeTags.recover():
-            Exception("the pubsub node /archipel/tags must have been created. You can use archipel-tagnode tool to create it.")        
+        self.pubSubNodeTags = get_node(self.pubSubNodeTags, tagsNodeName)
+        def on_tags_node(future):
+            if future.error:
+                self.log.error("the pubsub node /archipel/tags must have been created. You can use archipel-tagnode tool to create it.")
+        self.pubSubNodeTags.ensure(create=False).add_callback(on_tags_node)
     
     
     def remove_pubsubs(self):
@@ -511,12 +542,12 @@ class TNArchipelEntity:
         if not self.isAuth:
             return
         
-        self.log.debug("going to perform action to perform on auth: %s" % str(self.registered_actions_to_perform_on_connection))
+        self.log.debug("going to perform action to perform on auth: %s", self.registered_actions_to_perform_on_connection)
         
         actions_to_purge = []
         
         for action in self.registered_actions_to_perform_on_connection:
-            self.log.debug("performing action %s" % str(action))
+            self.log.debug("performing action %s", action)
             if hasattr(self, action["name"]):
                 m = getattr(self, action["name"])
                 if action["args"] != None:
@@ -527,7 +558,7 @@ class TNArchipelEntity:
                 actions_to_purge.append(action)
         
         for oneshot_action in actions_to_purge:
-            self.log.debug("purging non persistant action %s" % str(oneshot_action))
+            self.log.debug("purging non persistant action %s", oneshot_action)
             self.registered_actions_to_perform_on_connection.remove(oneshot_action)
         
         self.log.debug("all registred actions have been done")
@@ -558,14 +589,132 @@ class TNArchipelEntity:
         self.xmppclient.send(pres)
     
     
-    def push_change(self, namespace, change, excludedgroups=None):
+    def send_stanza(self, conn, stanza):
+        """
+        send a stanza from any thread. If the entity is driven by a reactor, the
+        stanza is sent from the reactor thread, so it won't be mixed with
+        the stanzas sent by the stream handlers
+        
+        @type conn: xmpp.Dispatcher
+        @param conn: the connection to use
+        @type stanza: xmpp.Node
+        @param stanza: the stanza to send
+        """
+        if self.reactor and not threading.currentThread() is self.reactor.thread:
+            self.reactor.call_later(0, conn.send, stanza)
+        else:
+            conn.send(stanza)
+    
+    
+    def defer_iq(self, conn, iq, method, ordered=True):
+        """
+        run an IQ handler in the executor, and send its reply when it is completed.
+        If there is no executor, the handler is run immediately. In both cases,
+        this will raise xmpp.protocol.NodeProcessed
+        
+        @type conn: xmpp.Dispatcher
+        @param conn: ths instance of the current connection that send the stanza
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @type method: function
+        @param method: the IQ handler. It must take the IQ and return the reply
+        @type ordered: boolean
+        @param ordered: if True, deferred IQs of the entity are run in the order they have been received
+        """
+        context = iqstats.defer()
+        def job():
+            iqstats.resume(context)
+            try:
+                reply = method(iq)
+                if reply:
+                    if context and reply.getType() == "error": context.error = True
+                    self.send_stanza(conn, reply)
+            except Exception:
+                if context: context.error = True
+                raise
+            finally:
+                iqstats.end(context, completed=True)
+        
+        if not self.executor:
+            job()
+        else:
+            key = None
+            if ordered: key = self.jid.getStripped()
+            self.executor.submit(job, key=key)
+        raise xmpp.protocol.NodeProcessed
+    
+    
+    def push_change(self, namespace, change, excludedgroups=None, flush=False):
         """
         push a change using archipel push system.
-        this system will change with inclusion of pubsub
+        this system will change with inclusion of pubsub.
+        if push_coalescing_delay is set, the change is published at most this delay
+        later, and the same change pushed again in the meantime is only published once,
+        at the position of its last push
+        
+        @type namespace: string
+        @param namespace: the namespace of the change
+        @type change: string
+        @param change: the change
+        @type flush: Boolean
+        @param flush: if True, publish this change and the pending ones right now
         """
         ns = ARCHIPEL_NS_IQ_PUSH + ":" + namespace
         
-        self.log.info("PUSH : pushing %s->%s" % (ns, change))
+        if self.push_coalescing_delay <= 0:
+            self.publish_change(ns, change)
+            return
+        
+        self.pending_pushes_lock.acquire()
+        try:
+            # a repeated change moves to the end, so the changes are published in the order of their last occurrence
+            if (ns, change) in self.pending_pushes:
+                self.log.debug("PUSH : coalescing %s->%s", ns, change)
+                self.pending_pushes.remove((ns, change))
+            self.pending_pushes.append((ns, change))
+            if not flush and not self.pending_pushes_timer:
+                if self.reactor:
+                    self.pending_pushes_timer = self.reactor.call_later(self.push_coalescing_delay, self.flush_changes)
+                else:
+                    self.pending_pushes_timer = threading.Timer(self.push_coalescing_delay, self.flush_changes)
+                    self.pending_pushes_timer.setDaemon(True)
+                    self.pending_pushes_timer.start()
+        finally:
+            self.pending_pushes_lock.release()
+        
+        if flush:
+            self.flush_changes()
+    
+    
+    def flush_changes(self):
+        """
+        publish the changes waiting in the coalescing window
+        """
+        self.pending_pushes_lock.acquire()
+        pushes = self.pending_pushes
+        self.pending_pushes = []
+        if self.pending_pushes_timer:
+            self.pending_pushes_timer.cancel()
+            self.pending_pushes_timer = None
+        self.pending_pushes_lock.release()
+        
+        for ns, change in pushes:
+            try:
+                self.publish_change(ns, change)
+            except Exception as ex:
+                self.log.error("PUSH : unable to push %s->%s: %s" % (ns, change, str(ex)))
+    
+    
+    def publish_change(self, ns, change):
+        """
+        publish a change in the event pubsub node
+        
+        @type ns: string
+        @param ns: the full namespace of the change
+        @type change: string
+        @param change: the change
+        """
+        self.log.info("PUSH : pushing %s->%s", ns, change)
         
         push = xmpp.Node(tag="push", attrs={"date": datetime.datetime.now(), "xmlns": ns, "change": change})
         self.pubSubNodeEvent.add_item(push)
@@ -817,7 +966,7 @@ class TNArchipelEntity:
             
         elif resp_iq.getType() == "result":
             self.log.info("the registration complete")
-            self.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+            self.schedule_restart(1.0)
     
     
     def inband_unregistration(self):
@@ -1051,7 +1200,7 @@ class TNArchipelEntity:
         @type item: dictionnary
         @param item: the dictionnary describing the registrar item
         """
-        self.log.debug("module have registred a method %s for commands %s" % (str(item["method"]), str(item["commands"])))
+        self.log.debug("module have registred a method %s for commands %s", item["method"], item["commands"])
         self.messages_registrar.append(item)
     
     
@@ -1301,40 +1450,115 @@ class TNArchipelEntity:
     
     ### Loop
     
+    def get_stream_fileno(self):
+        """
+        return the file descriptor of the XMPP stream socket, or None
+        if the entity is not connected
+        """
+        if not self.xmppclient or not self.xmppclient.isConnected():
+            return None
+        return self.xmppclient.Connection._sock.fileno()
+    
+    
+    def process_stream(self, timeout=0):
+        """
+        process all the data pending on the XMPP stream. It will wait at most
+        timeout seconds for data to arrive, then drain everything that is
+        already buffered (including TLS buffers) without blocking
+        
+        @type timeout: float
+        @param timeout: the max time to wait for the first data
+        """
+        ret = self.xmppclient.Process(timeout)
+        while ret and not ret == '0':
+            ret = self.xmppclient.Process(0)
+        if not ret:
+            raise IOError("Disconnected from server")
+    
+    
+    def loop_step(self, timeout=3):
+        """
+        perform one iteration of the main loop. If timeout is 0, this
+        will never block, so it can be used by L{TNArchipelReactor}
+        to drive the entity from a shared thread
+        
+        @type timeout: float
+        @param timeout: the max time to wait for incoming data or for a restart
+        @rtype: boolean
+        @return: False if the loop is over
+        """
+        try:
+            if self.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
+                return False
+            if self.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
+                self.process_inband_unregistration()
+                return False
+            if self.loop_status == ARCHIPEL_XMPP_LOOP_ON:
+                if not self.xmppclient.isConnected():
+                    raise IOError("Disconnected from server")
+                self.process_stream(timeout)
+            elif self.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
+                if self.xmppclient and self.xmppclient.isConnected():
+                    self.xmppclient.disconnect()
+                delay = self.loop_restart_date - time.time()
+                if delay > 0:
+                    if timeout > 0: time.sleep(min(delay, timeout))
+                    return True
+                self.connect()
+        except Exception as ex:
+            if str(ex).find('User removed') > -1: # ok, weird.
+                self.log.info("LOOP EXCEPTION: Account has been removed from server")
+                self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+            elif self.auto_reconnect:
+                self.log.error("LOOP EXCEPTION : Disconnected from server")
+                t, v, tr = sys.exc_info()
+                self.log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+                self.schedule_reconnect()
+            else:
+                self.log.error("LOOP EXCEPTION : End of loop forced by exception : %s" % str(ex))
+                t, v, tr = sys.exc_info()
+                self.log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+                self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+        return not self.loop_status == ARCHIPEL_XMPP_LOOP_OFF
+    
+    
+    def schedule_restart(self, delay=1.0):
+        """
+        ask the loop to reconnect the entity in delay seconds
+        
+        @type delay: float
+        @param delay: the number of seconds to wait before reconnecting
+        """
+        self.loop_restart_date  = time.time() + delay
+        self.loop_status        = ARCHIPEL_XMPP_LOOP_RESTART
+    
+    
+    def schedule_reconnect(self):
+        """
+        ask the loop to reconnect the entity after a failure. The delay is given
+        by the reconnect scheduler shared by all entities of the process
+        """
+        delay = archipel.core.archipelReconnectScheduler.scheduler.entity_disconnected(self)
+        self.log.info("trying to reconnect in %.2f seconds" % delay)
+        self.schedule_restart(delay)
+    
+    
+    def close_stream(self):
+        """
+        close the XMPP stream once the loop is over
+        """
+        archipel.core.archipelReconnectScheduler.scheduler.entity_removed(self)
+        if self.xmppclient and self.xmppclient.isConnected():
+            self.xmppclient.disconnect()
+    
+    
     def loop(self):
         """
         This is the main loop of the client
         """
-        while not self.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
-            try:
-                if self.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
-                    self.process_inband_unregistration()
-                    return
-                if self.loop_status == ARCHIPEL_XMPP_LOOP_ON:
-                    if self.xmppclient.isConnected():
-                        self.xmppclient.Process(3)
-                elif self.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
-                    if self.xmppclient.isConnected():
-                        self.xmppclient.disconnect()
-                    time.sleep(1.0)
-                    self.connect()
-            except Exception as ex:
-                if str(ex).find('User removed') > -1: # ok, weird.
-                    self.log.info("LOOP EXCEPTION: Account has been removed from server")
-                    self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
-                elif self.auto_reconnect:
-                    self.log.error("LOOP EXCEPTION : Disconnected from server. Trying to reconnect in 5 five seconds")
-                    t, v, tr = sys.exc_info()
-                    self.log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
-                    self.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
-                    time.sleep(5.0)
-                else:
-                    self.log.error("LOOP EXCEPTION : End of loop forced by exception : %s" % str(ex))
-                    t, v, tr = sys.exc_info()
-                    self.log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
-                    self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
-        if self.xmppclient.isConnected():
-            self.xmppclient.disconnect()
+        while self.loop_step(3):
+            pass
+        self.close_stream()
     
 
 
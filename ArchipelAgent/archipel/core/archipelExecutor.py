@@ -0,0 +1,169 @@
+#
+# archipelExecutor.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelExecutor, a bounded pool of threads used to run slow
+jobs (libvirt calls, qemu-img...) outside of the XMPP read loop.
+"""
+
+import sys
+import time
+import Queue
+import threading
+import traceback
+
+from archipel.utils import *
+
+
+class TNArchipelExecutorJob:
+    """
+    this class represents a job submitted to the L{TNArchipelExecutor}
+    """
+
+    def __init__(self, method, args, key):
+        """
+        the contructor of the class
+
+        @type method: function
+        @param method: the function to run
+        @type args: tuple
+        @param args: the arguments of the function
+        @type key: string
+        @param key: the ordering key of the job or None
+        """
+        self.method         = method
+        self.args           = args
+        self.key            = key
+        self.submit_date    = time.time()
+
+
+
+
+class TNArchipelExecutor:
+    """
+    this class runs jobs in a fixed number of threads. Jobs that share the
+    same key are run one after the other, in the order of submission, so
+    the actions sent to one entity are not reordered.
+    """
+
+    def __init__(self, size, name="ArchipelExecutor", wait_warning_threshold=5.0):
+        """
+        the contructor of the class
+
+        @type size: int
+        @param size: the number of threads
+        @type name: string
+        @param name: the name of the executor, used in logs and threads names
+        @type wait_warning_threshold: float
+        @param wait_warning_threshold: log a warning if a job waits more than this in queue
+        """
+        self.name                   = name
+        self.wait_warning_threshold = wait_warning_threshold
+        self.queue                  = Queue.Queue()
+        self.lock                   = threading.Lock()
+        self.keys                   = {}
+        self.threads                = []
+        self.stats                  = { "submitted": 0,
+                                        "completed": 0,
+                                        "failed": 0,
+                                        "queue_depth": 0,
+                                        "max_queue_depth": 0,
+                                        "total_wait_time": 0.0,
+                                        "max_wait_time": 0.0,
+                                        "total_run_time": 0.0,
+                                        "max_run_time": 0.0 }
+        for i in range(size):
+            thread = threading.Thread(target=self.work, name="%s-%d" % (self.name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def submit(self, method, *args, **kwargs):
+        """
+        submit a new job. If key is given in kwargs, the job will only start once
+        all the previously submitted jobs with the same key are completed
+
+        @type method: function
+        @param method: the function to run
+        """
+        job = TNArchipelExecutorJob(method, args, kwargs.get("key", None))
+        self.lock.acquire()
+        self.stats["submitted"] += 1
+        self.stats["queue_depth"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.stats["queue_depth"])
+        if job.key is None:
+            self.queue.put(job)
+        elif self.keys.has_key(job.key):
+            self.keys[job.key].append(job)
+        else:
+            self.keys[job.key] = []
+            self.queue.put(job)
+        self.lock.release()
+
+
+    def work(self):
+        """
+        the main loop of the executor threads
+        """
+        while True:
+            job = self.queue.get()
+            start = time.time()
+            wait_time = start - job.submit_date
+            if wait_time > self.wait_warning_threshold:
+                log.warning("EXECUTOR: %s: job %s has waited %.2fs in queue" % (self.name, str(job.method), wait_time))
+            failed = False
+            try:
+                job.method(*job.args)
+            except Exception as ex:
+                failed = True
+                log.error("EXECUTOR: %s: exception in job %s: %s" % (self.name, str(job.method), str(ex)))
+                t, v, tr = sys.exc_info()
+                log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+            run_time = time.time() - start
+
+            self.lock.acquire()
+            self.stats["queue_depth"] -= 1
+            self.stats["completed"] += 1
+            if failed: self.stats["failed"] += 1
+            self.stats["total_wait_time"] += wait_time
+            self.stats["max_wait_time"] = max(self.stats["max_wait_time"], wait_time)
+            self.stats["total_run_time"] += run_time
+            self.stats["max_run_time"] = max(self.stats["max_run_time"], run_time)
+            if job.key is not None:
+                if self.keys[job.key]:
+                    self.queue.put(self.keys[job.key].pop(0))
+                else:
+                    del self.keys[job.key]
+            self.lock.release()
+
+
+    def get_stats(self):
+        """
+        @rtype: dict
+        @return: the metrics of the executor (queue depth, wait and run times...)
+        """
+        self.lock.acquire()
+        stats = dict(self.stats)
+        self.lock.release()
+        stats["workers"] = len(self.threads)
+        stats["average_wait_time"] = 0.0
+        stats["average_run_time"] = 0.0
+        if stats["completed"]:
+            stats["average_wait_time"] = stats["total_wait_time"] / stats["completed"]
+            stats["average_run_time"] = stats["total_run_time"] / stats["completed"]
+        return stats
@@ -22,6 +22,7 @@ This provides the possibility to instanciate TNArchipelVirtualMachines
 """
 import xmpp
 import sys
+import os
 import socket
 import sqlite3
 import datetime
@@ -35,6 +36,13 @@ import libvirt
 from archipel.utils import *
 from archipelEntity import *
 from archipelVirtualMachine import *
+import archipelConnectionPool
+import archipelExecutor
+import archipelStore
+import archipelLibvirtPool
+import archipelMetrics
+import archipelIQStats
+import archipelProfiler
 
 
 ARCHIPEL_ERROR_CODE_HYPERVISOR_ALLOC            = -9001
@@ -46,6 +54,25 @@ ARCHIPEL_ERROR_CODE_HYPERVISOR_LIBVIRT_URI      = -9006
 ARCHIPEL_ERROR_CODE_HYPERVISOR_ALLOC_MIGRATION  = -9007
 ARCHIPEL_ERROR_CODE_HYPERVISOR_FREE_MIGRATION   = -9008
 ARCHIPEL_ERROR_CODE_HYPERVISOR_CAPABILITIES     = -9009
+ARCHIPEL_ERROR_CODE_HYPERVISOR_DOMAINS_STATS    = -9010
+ARCHIPEL_ERROR_CODE_HYPERVISOR_IQ_STATS         = -9011
+ARCHIPEL_ERROR_CODE_HYPERVISOR_PROFILE          = -9012
+ARCHIPEL_ERROR_CODE_HYPERVISOR_STACKS           = -9013
+
+# the maximum duration of a profile in seconds
+ARCHIPEL_HYPERVISOR_PROFILE_MAX_DURATION        = 300
+
+# fields that can be requested with the domainsstats action, and the
+# corresponding libvirt stats groups
+ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FIELDS        = {  "state": "VIR_DOMAIN_STATS_STATE",
+                                                    "cpu": "VIR_DOMAIN_STATS_CPU_TOTAL",
+                                                    "balloon": "VIR_DOMAIN_STATS_BALLOON",
+                                                    "vcpu": "VIR_DOMAIN_STATS_VCPU",
+                                                    "interface": "VIR_DOMAIN_STATS_INTERFACE",
+                                                    "block": "VIR_DOMAIN_STATS_BLOCK"}
+
+# filters that can be used with the domainsstats action
+ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FILTERS       = ("active", "inactive", "persistent", "transient", "running", "paused", "shutoff", "other")
 
 class TNThreadedVirtualMachine(Thread):
     """
@@ -113,12 +140,19 @@ class TNArchipelHypervisor(TNArchipelEntity):
         self.local_libvirt_uri          = self.configuration.get("GLOBAL", "libvirt_uri")
         self.entity_type                = "hypervisor"
         self.default_avatar             = self.configuration.get("HYPERVISOR", "hypervisor_default_avatar")
-        self.libvirt_event_callback_id  = None
+        self.libvirt_event_callback_ids = []
+        
+        # store shared by the hypervisor and all its virtual machines
+        if self.configuration.has_option("HYPERVISOR", "hypervisor_store_database_path"):
+            store_db_file               = self.configuration.get("HYPERVISOR", "hypervisor_store_database_path")
+        else:
+            store_db_file               = os.path.join(os.path.dirname(self.database_file), "store.sqlite3")
+        self.store                      = archipelStore.TNArchipelStore(store_db_file)
         
         # permissions
         permission_db_file              = self.configuration.get("HYPERVISOR", "hypervisor_permissions_database_path")
         permission_admin_name           = self.configuration.get("GLOBAL", "archipel_root_admin")
-        self.permission_center          = archipel.core.archipelPermissionCenter.TNArchipelPermissionCenter(permission_db_file, permission_admin_name)
+        self.permission_center          = archipel.core.archipelPermissionCenter.TNArchipelPermissionCenter(self.store, self.jid.getStripped(), permission_admin_name, permission_db_file)
         self.init_permissions()
         
         names_file = open(self.configuration.get("HYPERVISOR", "name_generation_file"), 'r')
@@ -141,15 +175,65 @@ class TNArchipelHypervisor(TNArchipelEntity):
         # module inits
         self.initialize_modules()
         
-        # libvirt connection
-        self.libvirt_connection = libvirt.open(self.local_libvirt_uri)
-        if self.libvirt_connection == None:
-            self.log.error("unable to connect libvirt")
+        # libvirt connections shared with virtual machines
+        libvirt_pool_size = 2
+        libvirt_health_check_interval = 10
+        if self.configuration.has_option("GLOBAL", "libvirt_connection_pool_size"):
+            libvirt_pool_size = self.configuration.getint("GLOBAL", "libvirt_connection_pool_size")
+        if self.configuration.has_option("GLOBAL", "libvirt_health_check_interval"):
+            libvirt_health_check_interval = self.configuration.getint("GLOBAL", "libvirt_health_check_interval")
+        try:
+            self.libvirt_pool = archipelLibvirtPool.TNArchipelLibvirtPool(self.local_libvirt_uri, libvirt_pool_size, libvirt_health_check_interval)
+        except Exception as ex:
+            self.log.error("unable to connect libvirt: %s" % str(ex))
             sys.exit(-42) 
+        self.libvirt_connection = self.libvirt_pool.get_connection()
+        self.libvirt_connection.add_reconnect_callback(self.register_libvirt_events)
         self.log.info("connected to  libvirt")
-        self.libvirt_event_callback_id = self.libvirt_connection.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.hypervisor_on_domain_event, None) 
+        self.register_libvirt_events()
         self.capabilities = self.get_capabilities()
         
+        # reconnection policy shared by all entities
+        archipel.core.archipelReconnectScheduler.scheduler.configure(self.configuration)
+        
+        # executor for slow IQ handlers
+        executor_size = 4
+        if self.configuration.has_option("GLOBAL", "iq_executor_pool_size"):
+            executor_size = self.configuration.getint("GLOBAL", "iq_executor_pool_size")
+        if executor_size > 0:
+            self.executor = archipelExecutor.TNArchipelExecutor(executor_size)
+        
+        # on demand profiling of the agent
+        self.profiler = archipelProfiler.TNArchipelSamplingProfiler()
+        self.profiler_output_directory = os.path.join(self.configuration.get("DEFAULT", "archipel_folder_lib"), "profiles")
+        if self.configuration.has_option("GLOBAL", "profiler_output_directory"):
+            self.profiler_output_directory = self.configuration.get("GLOBAL", "profiler_output_directory")
+        
+        # metrics exposed on localhost
+        archipelMetrics.metrics.add_collector(self.collect_metrics)
+        self.metrics_exporter = None
+        metrics_address = "127.0.0.1"
+        metrics_port = 0
+        if self.configuration.has_option("GLOBAL", "metrics_exporter_address"):
+            metrics_address = self.configuration.get("GLOBAL", "metrics_exporter_address")
+        if self.configuration.has_option("GLOBAL", "metrics_exporter_port"):
+            metrics_port = self.configuration.getint("GLOBAL", "metrics_exporter_port")
+        if metrics_port > 0:
+            try:
+                self.metrics_exporter = archipelMetrics.TNArchipelMetricsExporter(archipelMetrics.metrics, metrics_address, metrics_port)
+                self.metrics_exporter.start()
+            except Exception as ex:
+                self.log.error("unable to start the metrics exporter: %s" % str(ex))
+        
+        # XMPP connection pool for virtual machines
+        self.connection_pool = None
+        pool_size = 0
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_connection_pool_size"):
+            pool_size = self.configuration.getint("VIRTUALMACHINE", "xmpp_connection_pool_size")
+        if pool_size > 0:
+            self.connection_pool = archipelConnectionPool.TNArchipelConnectionPool(pool_size)
+            self.connection_pool.start()
+        
         # persistance
         self.manage_persistance()
         
@@ -159,6 +243,31 @@ class TNArchipelHypervisor(TNArchipelEntity):
         
     
     
+    def register_libvirt_events(self):
+        """
+        register the libvirt domain events handlers. There is only one registration
+        per event type for the whole hypervisor. Events are dispatched to the virtual
+        machines according to the domain UUID. This is also called when the libvirt
+        connection has been reopened
+        """
+        self.libvirt_event_callback_ids = []
+        handlers = [("VIR_DOMAIN_EVENT_ID_LIFECYCLE", self.hypervisor_on_domain_event),
+                    ("VIR_DOMAIN_EVENT_ID_REBOOT", self.hypervisor_on_domain_reboot),
+                    ("VIR_DOMAIN_EVENT_ID_BALLOON_CHANGE", self.hypervisor_on_domain_balloon_change),
+                    ("VIR_DOMAIN_EVENT_ID_IO_ERROR", self.hypervisor_on_domain_io_error),
+                    ("VIR_DOMAIN_EVENT_ID_BLOCK_JOB", self.hypervisor_on_domain_block_job),
+                    ("VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED", self.hypervisor_on_domain_device_removed)]
+        for event_name, handler in handlers:
+            event_id = getattr(libvirt, event_name, None)
+            if event_id is None:
+                self.log.info("libvirt doesn't support %s. ignoring" % event_name)
+                continue
+            try:
+                self.libvirt_event_callback_ids.append(self.libvirt_connection.domainEventRegisterAny(None, event_id, handler, None))
+            except libvirt.libvirtError as ex:
+                self.log.warning("unable to register libvirt event %s: %s" % (event_name, str(ex)))
+    
+    
     def update_presence(self, params=None):
         count   = len(self.virtualmachines)
         nup     = 0
@@ -173,6 +282,7 @@ class TNArchipelHypervisor(TNArchipelEntity):
         TNArchipelEntity.register_handler(self)
         
         self.xmppclient.RegisterHandler('iq', self.process_iq, ns=ARCHIPEL_NS_HYPERVISOR_CONTROL)
+        self.xmppclient.RegisterHandler('iq', self.process_admin_iq, ns=ARCHIPEL_NS_HYPERVISOR_ADMIN)
     
     
     def init_vocabulary(self):
@@ -230,6 +340,10 @@ class TNArchipelHypervisor(TNArchipelEntity):
         self.permission_center.create_permission("ip", "Authorizes users to get hypervisor's IP address", False)
         self.permission_center.create_permission("uri", "Authorizes users to get the hypervisor's libvirt URI", False)
         self.permission_center.create_permission("capabilities", "Authorizes users to access the hypervisor capabilities", False)
+        self.permission_center.create_permission("domainsstats", "Authorizes users to get the statistics of all domains", False)
+        self.permission_center.create_permission("admin_iqstats", "Authorizes users to get and reset the IQ processing statistics of the agent", False)
+        self.permission_center.create_permission("admin_profile", "Authorizes users to profile the agent", False)
+        self.permission_center.create_permission("admin_stacks", "Authorizes users to get the stacks of all the threads of the agent", False)
     
     
     def manage_persistance(self):
@@ -251,8 +365,8 @@ class TNArchipelHypervisor(TNArchipelEntity):
             string_jid, password, date, comment, name = vm
             jid = xmpp.JID(string_jid)
             jid.setResource(self.jid.getNode())
-            vm = self.create_threaded_vm(jid, password, name)
-            self.virtualmachines[vm.jid.getNode()] = vm.get_instance()
+            vm = self.create_vm(jid, password, name)
+            self.virtualmachines[vm.jid.getNode()] = vm
     
         
     def create_threaded_vm(self, jid, password, name):
@@ -271,6 +385,25 @@ class TNArchipelHypervisor(TNArchipelEntity):
         return vm    
     
     
+    def create_vm(self, jid, password, name):
+        """
+        this method creates a L{TNArchipelVirtualMachine} and starts its XMPP loop. If
+        VIRTUALMACHINE:xmpp_connection_pool_size is greater than 0, the VM is attached to
+        the shared connection pool. Otherwise, it gets its own thread.
+        @type jid: string
+        @param jid: the JID of the L{TNArchipelVirtualMachine}
+        @type password: string
+        @param password: the password associated to the JID
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the L{TNArchipelVirtualMachine} instance
+        """
+        if not self.connection_pool:
+            return self.create_threaded_vm(jid, password, name).get_instance()
+        vm = TNArchipelVirtualMachine(jid, password, self, self.configuration, name)
+        self.connection_pool.attach(vm)
+        return vm
+    
+    
     def generate_name(self):
         return self.generated_names[random.randint(0, self.number_of_names)].replace("\n", "")
     
@@ -311,36 +444,155 @@ class TNArchipelHypervisor(TNArchipelEntity):
     
     
     
+    ### Metrics
+    
+    def collect_metrics(self):
+        """
+        metrics collector of the hypervisor. see L{archipelMetrics.TNArchipelMetricsRegistry.add_collector}.
+        It only reads counters already in memory
+        
+        @rtype: list
+        @return: the metric families
+        """
+        vms = self.virtualmachines.values()
+        connected = len([vm for vm in vms if vm.isAuth])
+        cache_hits = 0
+        cache_misses = 0
+        for entity in [self] + vms:
+            cache_stats = entity.permission_center.get_permission_cache_stats()
+            cache_hits += cache_stats["hits"]
+            cache_misses += cache_stats["misses"]
+        scheduler_stats = archipel.core.archipelReconnectScheduler.scheduler.get_stats()
+        families = [("archipel_entities", "gauge", "Number of entities by type and XMPP state",
+                        [({"type": "hypervisor", "state": self.isAuth and "connected" or "disconnected"}, 1),
+                         ({"type": "virtualmachine", "state": "connected"}, connected),
+                         ({"type": "virtualmachine", "state": "disconnected"}, len(vms) - connected)]),
+                    ("archipel_permission_cache_hits", "counter", "Hits of the permission caches", [({}, cache_hits)]),
+                    ("archipel_permission_cache_misses", "counter", "Misses of the permission caches", [({}, cache_misses)]),
+                    ("archipel_reconnect_disconnected_entities", "gauge", "Entities waiting for a reconnection", [({}, scheduler_stats["disconnected_entities"])]),
+                    ("archipel_reconnect_handshakes", "gauge", "XMPP handshakes in progress", [({}, scheduler_stats["handshakes"])]),
+                    ("archipel_reconnect_outage_duration_seconds", "gauge", "Duration of the current XMPP outage", [({}, scheduler_stats["outage_duration"])]),
+                    ("archipel_libvirt_connection_users", "gauge", "Number of entities using each libvirt connection",
+                        [({"connection": str(slot.index)}, len(slot.proxies)) for slot in self.libvirt_pool.slots])]
+        if self.executor:
+            executor_stats = self.executor.get_stats()
+            families.extend([("archipel_executor_jobs_submitted", "counter", "Jobs submitted to the executor", [({}, executor_stats["submitted"])]),
+                             ("archipel_executor_jobs_completed", "counter", "Jobs completed by the executor", [({}, executor_stats["completed"])]),
+                             ("archipel_executor_jobs_failed", "counter", "Jobs of the executor that raised an exception", [({}, executor_stats["failed"])]),
+                             ("archipel_executor_queue_depth", "gauge", "Jobs waiting or running in the executor", [({}, executor_stats["queue_depth"])]),
+                             ("archipel_executor_workers", "gauge", "Threads of the executor", [({}, executor_stats["workers"])]),
+                             ("archipel_executor_wait_seconds", "counter", "Total time spent by jobs in the queue", [({}, executor_stats["total_wait_time"])]),
+                             ("archipel_executor_run_seconds", "counter", "Total time spent running jobs", [({}, executor_stats["total_run_time"])])])
+        return families
+    
+    
+    
     ### LIBVIRT events Processing
     
+    def get_vm_for_domain(self, dom):
+        """
+        return the virtual machine that owns the given domain, if it wants
+        to receive libvirt events. This never fetches the domain XML
+        
+        @type dom: virDomain
+        @param dom: the libvirt domain
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the virtual machine or None
+        """
+        vm = self.virtualmachines.get(dom.UUIDString().lower())
+        if vm and vm.libvirt_events_enabled:
+            return vm
+        return None
+    
+    
     def hypervisor_on_domain_event(self, conn, dom, event, detail, opaque):
         """
-        trigger when a domain trigger vbent. We care only about RESUMED and SHUTDOWNED from MIGRATED
+        trigger when a domain trigger an event. The event is sent to the owning
+        virtual machine, then we handle RESUMED and SHUTDOWNED from MIGRATED
         """
+        vm = self.get_vm_for_domain(dom)
+        if vm:
+            vm.on_domain_event(conn, dom, event, detail, opaque)
+        
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED:
+            vm = self.virtualmachines.get(dom.UUIDString().lower())
+            if not vm:
+                self.log.warning("MIGRATION: migrated domain %s is not an archipel VM. ignoring" % dom.UUIDString())
+                return
             try:
-                strdesc = dom.XMLDesc(0)
-                desc    = xmpp.simplexml.NodeBuilder(data=strdesc).getDom()
-                vmjid   = desc.getTag(name="description").getCDATA().split("::::")[0]
-                self.log.info("MIGRATION: virtual machine %s stopped because of live migration. Freeing softly" % vmjid)
-                self.free_for_migration(xmpp.JID(vmjid))
+                self.log.info("MIGRATION: virtual machine %s stopped because of live migration. Freeing softly" % vm.jid)
+                self.free_for_migration(vm.jid)
                 self.perform_hooks("HOOK_HYPERVISOR_MIGRATEDVM_LEAVE", dom)
             except Exception as ex:
                 self.log.error("MIGRATION: can't free softly this virtual machine: %s" % str(ex))
             
         elif event == libvirt.VIR_DOMAIN_EVENT_RESUMED and detail == libvirt.VIR_DOMAIN_EVENT_RESUMED_MIGRATED:
-            try:
-                strdesc = dom.XMLDesc(0)
-                desc    = xmpp.simplexml.NodeBuilder(data=strdesc).getDom()
-                vmjid   = desc.getTag(name="description").getCDATA().split("::::")[0]
-                vmpass  = desc.getTag(name="description").getCDATA().split("::::")[1]
-                vmname  = desc.getTag(name="name").getCDATA()
-                self.log.info("MIGRATION: virtual machine %s resumed from live migration. Allocating softly" % vmjid)
-                self.alloc_for_migration(xmpp.JID(vmjid), vmname, vmpass)
-                self.perform_hooks("HOOK_HYPERVISOR_MIGRATEDVM_ARRIVE", dom)
-            except Exception as ex:
-                self.log.warning("MIGRATION: can't alloc softly this virtual machine. Maybe it is not an archipel VM: %s" % str(ex))
-            
+            if self.executor:
+                self.executor.submit(self.alloc_migrated_domain, dom)
+            else:
+                self.alloc_migrated_domain(dom)
+    
+    
+    def alloc_migrated_domain(self, dom):
+        """
+        allocate softly the virtual machine of a domain that arrived from live migration.
+        The description of the domain is needed, so this is run in the executor
+        
+        @type dom: virDomain
+        @param dom: the libvirt domain
+        """
+        try:
+            strdesc = dom.XMLDesc(0)
+            desc    = xmpp.simplexml.NodeBuilder(data=strdesc).getDom()
+            vmjid   = desc.getTag(name="description").getCDATA().split("::::")[0]
+            vmpass  = desc.getTag(name="description").getCDATA().split("::::")[1]
+            vmname  = desc.getTag(name="name").getCDATA()
+            self.log.info("MIGRATION: virtual machine %s resumed from live migration. Allocating softly" % vmjid)
+            self.alloc_for_migration(xmpp.JID(vmjid), vmname, vmpass)
+            self.perform_hooks("HOOK_HYPERVISOR_MIGRATEDVM_ARRIVE", dom)
+        except Exception as ex:
+            self.log.warning("MIGRATION: can't alloc softly this virtual machine. Maybe it is not an archipel VM: %s" % str(ex))
+    
+    
+    def hypervisor_on_domain_reboot(self, conn, dom, opaque):
+        """
+        trigger when a domain reboots
+        """
+        vm = self.get_vm_for_domain(dom)
+        if vm: vm.on_domain_reboot()
+    
+    
+    def hypervisor_on_domain_balloon_change(self, conn, dom, actual, opaque):
+        """
+        trigger when the memory balloon of a domain changes
+        """
+        vm = self.get_vm_for_domain(dom)
+        if vm: vm.on_domain_balloon_change(actual)
+    
+    
+    def hypervisor_on_domain_io_error(self, conn, dom, srcpath, devalias, action, opaque):
+        """
+        trigger when a domain gets an IO error on one of its disks
+        """
+        vm = self.get_vm_for_domain(dom)
+        if vm: vm.on_domain_io_error(srcpath, devalias, action)
+    
+    
+    def hypervisor_on_domain_block_job(self, conn, dom, disk, job_type, status, opaque):
+        """
+        trigger when a block job of a domain is over
+        """
+        vm = self.get_vm_for_domain(dom)
+        if vm: vm.on_domain_block_job(disk, job_type, status)
+    
+    
+    def hypervisor_on_domain_device_removed(self, conn, dom, devalias, opaque):
+        """
+        trigger when a device has been removed from a domain
+        """
+        vm = self.get_vm_for_domain(dom)
+        if vm: vm.on_domain_device_removed(devalias)
+    
     
     
     
@@ -374,6 +626,34 @@ class TNArchipelHypervisor(TNArchipelEntity):
         elif action == "ip":            reply = self.iq_ip(iq)
         elif action == "uri":           reply = self.iq_libvirt_uri(iq)
         elif action == "capabilities":  reply = self.iq_capabilities(iq)
+        elif action == "domainsstats":  reply = self.defer_iq(conn, iq, self.iq_domainsstats, ordered=False)
+        
+        if reply:
+            conn.send(reply)
+            raise xmpp.protocol.NodeProcessed
+    
+    
+    def process_admin_iq(self, conn, iq):
+        """
+        this method is invoked when a ARCHIPEL_NS_HYPERVISOR_ADMIN IQ is received.
+        These actions are used to diagnose the agent itself.
+        
+        it understands IQ of type:
+            - iqstats
+            - profile
+            - stacks
+        
+        @type conn: xmpp.Dispatcher
+        @param conn: ths instance of the current connection that send the stanza
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        """
+        action = self.check_acp(conn, iq)
+        self.check_perm(conn, iq, action, -1, prefix="admin_")
+        
+        if action == "iqstats":     reply = self.iq_iqstats(iq)
+        elif action == "profile":   reply = self.iq_profile(conn, iq)
+        elif action == "stacks":    reply = self.iq_stacks(iq)
         
         if reply:
             conn.send(reply)
@@ -400,7 +680,7 @@ class TNArchipelHypervisor(TNArchipelEntity):
         else: name = requested_name
         
         self.log.info("starting xmpp threaded virtual machine")
-        vm = self.create_threaded_vm(vm_jid, vm_password, name).get_instance()
+        vm = self.create_vm(vm_jid, vm_password, name)
         
         if requester:
             self.log.info("adding the requesting controller %s to the VM's roster" % (str(requester)))
@@ -435,7 +715,7 @@ class TNArchipelHypervisor(TNArchipelEntity):
         
         jid.setResource(self.jid.getNode())
         self.log.info("starting xmpp threaded virtual machine with incoming jid : %s" % jid)
-        vm = self.create_threaded_vm(jid, password, name).get_instance()
+        vm = self.create_vm(jid, password, name)
         
         self.log.info("registering the new VM in hypervisor's memory")
         self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(jid.getStripped()), password, datetime.datetime.now(), '', name))
@@ -469,6 +749,8 @@ class TNArchipelHypervisor(TNArchipelEntity):
         self.database.commit()
         
         del self.virtualmachines[uuid]
+        if self.connection_pool: self.connection_pool.detach(jid)
+        self.store.delete_entity(jid.getStripped())
         
         self.log.info("unregistering vm from jabber server")
         vm.inband_unregistration()
@@ -493,6 +775,7 @@ class TNArchipelHypervisor(TNArchipelEntity):
         self.database.execute("delete from virtualmachines where jid='%s'" % jid.getStripped())
         self.database.commit()
         del self.virtualmachines[uuid]
+        if self.connection_pool: self.connection_pool.detach(jid)
         self.remove_jid(jid)
         self.update_presence()
     
@@ -518,6 +801,92 @@ class TNArchipelHypervisor(TNArchipelEntity):
         
     
     
+    def get_domains_stats(self, fields=None, filters=None):
+        """
+        return the statistics of all domains in one libvirt call. If libvirt is too old
+        to support getAllDomainStats, the statistics of the archipel virtual machines
+        are gathered one by one with the same keys.
+        
+        @type fields: list
+        @param fields: the keys of ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FIELDS to get. All if None
+        @type filters: list
+        @param filters: items of ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FILTERS. domains must match all of them
+        @rtype: list
+        @return: list of tuples (uuid, name, dict of stats)
+        """
+        if not fields: fields = ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FIELDS.keys()
+        if not filters: filters = []
+        for field in fields:
+            if not field in ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FIELDS: raise Exception("unknown field %s" % field)
+        for f in filters:
+            if not f in ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FILTERS: raise Exception("unknown filter %s" % f)
+        
+        if hasattr(libvirt.virConnect, "getAllDomainStats"):
+            stats_flags = 0
+            for field in fields:
+                stats_flags |= getattr(libvirt, ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FIELDS[field], 0)
+            flags = 0
+            for f in filters:
+                flags |= getattr(libvirt, "VIR_CONNECT_GET_ALL_DOMAINS_STATS_%s" % f.upper())
+            return [(dom.UUIDString(), dom.name(), stats) for dom, stats in self.libvirt_connection.getAllDomainStats(stats_flags, flags)]
+        
+        ret = []
+        states = {  "running": (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED),
+                    "paused": (libvirt.VIR_DOMAIN_PAUSED,),
+                    "shutoff": (libvirt.VIR_DOMAIN_SHUTOFF,)}
+        for vm in self.virtualmachines.values():
+            dom = vm.domain
+            if not dom:
+                continue
+            try:
+                dominfo = dom.info()
+                active  = dom.isActive()
+                persistent = dom.isPersistent()
+                matches = { "active": active, "inactive": not active,
+                            "persistent": persistent, "transient": not persistent,
+                            "other": not dominfo[0] in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED, libvirt.VIR_DOMAIN_PAUSED, libvirt.VIR_DOMAIN_SHUTOFF)}
+                for state, values in states.items():
+                    matches[state] = dominfo[0] in values
+                if not all([matches[f] for f in filters]):
+                    continue
+                
+                stats = {}
+                if "state" in fields:
+                    stats["state.state"] = dominfo[0]
+                if "cpu" in fields:
+                    stats["cpu.time"] = dominfo[4]
+                if "balloon" in fields:
+                    stats["balloon.maximum"] = dominfo[1]
+                    stats["balloon.current"] = dominfo[2]
+                if "vcpu" in fields:
+                    stats["vcpu.current"] = dominfo[3]
+                if active and ("interface" in fields or "block" in fields):
+                    definition = vm.get_definition()
+                    if "interface" in fields:
+                        nics = [nic for nic in definition.nics if nic["target"]]
+                        stats["net.count"] = len(nics)
+                        for i, nic in enumerate(nics):
+                            s = dom.interfaceStats(nic["target"])
+                            prefix = "net.%d." % i
+                            stats[prefix + "name"] = nic["target"]
+                            for j, key in enumerate(("rx.bytes", "rx.pkts", "rx.errs", "rx.drop", "tx.bytes", "tx.pkts", "tx.errs", "tx.drop")):
+                                stats[prefix + key] = s[j]
+                    if "block" in fields:
+                        disks = [disk for disk in definition.disks if disk["target"]]
+                        stats["block.count"] = len(disks)
+                        for i, disk in enumerate(disks):
+                            s = dom.blockStats(disk["target"])
+                            prefix = "block.%d." % i
+                            stats[prefix + "name"] = disk["target"]
+                            stats[prefix + "path"] = disk["path"]
+                            for j, key in enumerate(("rd.reqs", "rd.bytes", "wr.reqs", "wr.bytes", "errs")):
+                                stats[prefix + key] = s[j]
+                ret.append((vm.uuid, dom.name(), stats))
+            except libvirt.libvirtError as ex:
+                self.log.warning("unable to get statistics of domain %s: %s" % (vm.uuid, str(ex)))
+        return ret
+    
+    
     def get_capabilities(self):
         """return hypervisor's capabilities"""
         capp = xmpp.simplexml.NodeBuilder(data=self.libvirt_connection.getCapabilities()).getDom()
@@ -812,5 +1181,140 @@ class TNArchipelHypervisor(TNArchipelEntity):
         except Exception as ex:
             return build_error_message(self, ex)
     
+    
+    
+    def iq_domainsstats(self, iq):
+        """
+        send the statistics of all domains. the archipel tag can have the attributes
+        "fields" (comma separated keys of ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FIELDS) and
+        "filters" (comma separated items of ARCHIPEL_HYPERVISOR_DOMAINS_STATS_FILTERS)
+        
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            reply   = iq.buildReply("result")
+            query   = iq.getTag("query").getTag("archipel")
+            fields  = None
+            filters = None
+            if query.getAttr("fields"): fields = [f.strip() for f in query.getAttr("fields").split(",")]
+            if query.getAttr("filters"): filters = [f.strip() for f in query.getAttr("filters").split(",")]
+            nodes = []
+            for uuid, name, stats in self.get_domains_stats(fields, filters):
+                attrs = {"uuid": uuid, "name": name}
+                if self.virtualmachines.has_key(uuid):
+                    attrs["jid"] = self.virtualmachines[uuid].jid.getStripped()
+                domain_node = xmpp.Node("domain", attrs=attrs)
+                stats_attrs = {}
+                for key, value in stats.items():
+                    stats_attrs[key] = str(value)
+                domain_node.addChild(name="stats", attrs=stats_attrs)
+                nodes.append(domain_node)
+            reply.setQueryPayload(nodes)
+        except libvirt.libvirtError as ex:
+            reply = build_error_iq(self, ex, iq, ex.get_error_code(), ns=ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_DOMAINS_STATS)
+        return reply
+    
+    
+    def iq_iqstats(self, iq):
+        """
+        send the count, errors and latency of the IQs processed by the agent, for each
+        namespace and action, the slowest first. If the "reset" parameter of the iq
+        node is "true", the statistics are cleared after being sent. The counters
+        exported to the metrics endpoint are not cleared
+        
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the result of the action
+        """
+        try:
+            reply = iq.buildReply("result")
+            reply.setQueryPayload(archipelIQStats.iqstats.get_stats_nodes())
+            if iq.getTag("query").getTag("archipel").getAttr("reset") == "true":
+                archipelIQStats.iqstats.reset()
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_IQ_STATS)
+        return reply
+    
+    
+    def iq_profile(self, conn, iq):
+        """
+        sample the stacks of all the threads of the agent during "duration" seconds
+        (10 by default) every "interval" seconds (0.01 by default), and send the
+        "limit" hottest functions sorted by "sort" (self or total). If "save" is
+        "true", the full report is also written in the profiler output directory.
+        The profile runs in its own thread, so the XMPP loop is not blocked.
+        This will raise xmpp.protocol.NodeProcessed
+        
+        @type conn: xmpp.Dispatcher
+        @param conn: ths instance of the current connection that send the stanza
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        """
+        try:
+            query       = iq.getTag("query").getTag("archipel")
+            duration    = min(float(query.getAttr("duration") or 10), ARCHIPEL_HYPERVISOR_PROFILE_MAX_DURATION)
+            interval    = max(float(query.getAttr("interval") or 0.01), 0.001)
+            limit       = int(query.getAttr("limit") or 20)
+            sort        = query.getAttr("sort") or "self"
+            save        = query.getAttr("save") == "true"
+            if self.profiler.is_running():
+                raise Exception("a profile is already running")
+        except Exception as ex:
+            conn.send(build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_PROFILE))
+            raise xmpp.protocol.NodeProcessed
+        
+        def profile():
+            try:
+                reply = iq.buildReply("result")
+                profile = self.profiler.run(duration, interval)
+                profile_node = xmpp.Node("profile", attrs={"samples": profile.samples, "duration": "%.2f" % profile.duration, "interval": profile.interval})
+                if save:
+                    if not os.path.exists(self.profiler_output_directory):
+                        os.makedirs(self.profiler_output_directory)
+                    path = os.path.join(self.profiler_output_directory, "profile-%s.txt" % time.strftime("%Y%m%d-%H%M%S"))
+                    f = open(path, "w")
+                    f.write(profile.format_report())
+                    f.close()
+                    profile_node.setAttr("file", path)
+                for function, self_count, total_count in profile.get_top(limit, sort):
+                    profile_node.addChild("function", attrs={"name": function, "self": self_count, "total": total_count})
+                reply.setQueryPayload([profile_node])
+            except Exception as ex:
+                reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_PROFILE)
+            self.send_stanza(conn, reply)
+        
+        thread = Thread(target=profile, name="ArchipelProfiler")
+        thread.setDaemon(True)
+        thread.start()
+        raise xmpp.protocol.NodeProcessed
+    
+    
+    def iq_stacks(self, iq):
+        """
+        send the current stack of all the threads of the agent
+        
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the result of the action
+        """
+        try:
+            reply = iq.buildReply("result")
+            nodes = []
+            for name, ident, stack in archipelProfiler.get_thread_stacks():
+                thread_node = xmpp.Node("thread", attrs={"name": name, "ident": ident})
+                thread_node.setData(stack)
+                nodes.append(thread_node)
+            reply.setQueryPayload(nodes)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_STACKS)
+        return reply
+    
 
     
\ No newline at end of file
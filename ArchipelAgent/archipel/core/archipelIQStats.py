@@ -0,0 +1,284 @@
+#
+# archipelIQStats.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelIQStats, shared by all the entities of the process, that
+measures the count, errors and latency of the IQ handlers for each namespace
+and action.
+"""
+
+import time
+import threading
+import xmpp
+
+from archipelMetrics import metrics
+
+
+class TNArchipelIQStatsContext:
+    """
+    this class holds the measure of one IQ being processed
+    """
+
+    def __init__(self, ns, action):
+        """
+        the contructor of the class
+
+        @type ns: string
+        @param ns: the namespace of the handler
+        @type action: string
+        @param action: the archipel action of the IQ
+        """
+        self.ns         = ns
+        self.action     = action
+        self.date       = time.time()
+        self.error      = False
+        self.processed  = False
+        self.deferred   = False
+
+
+
+
+class TNArchipelInstrumentedHandler(object):
+    """
+    this class wraps an IQ handler registered in a xmpp dispatcher. It compares
+    equal to the wrapped handler, so UnregisterHandler still works
+    """
+
+    def __init__(self, stats, handler, ns):
+        """
+        the contructor of the class
+
+        @type stats: L{TNArchipelIQStats}
+        @param stats: the stats to update
+        @type handler: function
+        @param handler: the wrapped handler
+        @type ns: string
+        @param ns: the namespace the handler is registered for
+        """
+        self.stats      = stats
+        self.handler    = handler
+        self.ns         = ns
+
+
+    def __call__(self, conn, iq):
+        context = self.stats.begin(self.ns, iq)
+        try:
+            return self.handler(conn, iq)
+        except xmpp.protocol.NodeProcessed:
+            context.processed = True
+            raise
+        except Exception:
+            context.error = True
+            raise
+        finally:
+            self.stats.end(context)
+
+
+    def __eq__(self, other):
+        if isinstance(other, TNArchipelInstrumentedHandler):
+            other = other.handler
+        return self.handler == other
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __hash__(self):
+        return hash(self.handler)
+
+
+
+
+class TNArchipelIQStats:
+    """
+    this class records, for each (namespace, action), the number of IQs, the
+    number of error replies, the number of IQs that stopped the dispatch
+    (NodeProcessed) and a latency histogram. IQs deferred to the executor are
+    measured until their reply is sent.
+    """
+
+    def __init__(self):
+        """
+        the contructor of the class
+        """
+        self.lock       = threading.Lock()
+        self.local      = threading.local()
+        self.stats      = {}
+        # the exported counters, never reset so they stay monotonic
+        self.totals     = {}
+        self.histogram  = metrics.histogram("archipel_iq_duration_seconds", "Time between the reception of an IQ and its reply")
+        metrics.add_collector(self.collect_metrics)
+
+
+    def instrument(self, xmppclient):
+        """
+        make the given client wrap all the IQ handlers registered from now on,
+        and detect the error replies
+
+        @type xmppclient: xmpp.Client
+        @param xmppclient: a connected client
+        """
+        register = xmppclient.RegisterHandler
+        send = xmppclient.send
+        def register_handler(name, handler, typ="", ns="", *args, **kwargs):
+            if name == "iq" and ns:
+                handler = TNArchipelInstrumentedHandler(self, handler, ns)
+            return register(name, handler, typ, ns, *args, **kwargs)
+        def send_stanza(stanza):
+            context = getattr(self.local, "context", None)
+            if context and isinstance(stanza, xmpp.Node) and stanza.getName() == "iq" and stanza.getType() == "error":
+                context.error = True
+            return send(stanza)
+        xmppclient.RegisterHandler = register_handler
+        xmppclient.send = send_stanza
+
+
+    def begin(self, ns, iq):
+        """
+        start the measure of an IQ in the current thread
+
+        @rtype: L{TNArchipelIQStatsContext}
+        @return: the context of the measure
+        """
+        action = "none"
+        query = iq.getTag("query")
+        if query and query.getTag("archipel") and query.getTag("archipel").getAttr("action"):
+            action = query.getTag("archipel").getAttr("action")
+        context = TNArchipelIQStatsContext(ns, action)
+        self.local.context = context
+        return context
+
+
+    def defer(self):
+        """
+        tell that the IQ processed in the current thread is deferred, so the
+        dispatch is over. It will be recorded when the deferred job calls end
+
+        @rtype: L{TNArchipelIQStatsContext}
+        @return: the context of the measure, or None
+        """
+        context = getattr(self.local, "context", None)
+        if context:
+            context.deferred = True
+            context.processed = True
+        return context
+
+
+    def resume(self, context):
+        """
+        continue the measure of a deferred IQ in the current thread
+
+        @type context: L{TNArchipelIQStatsContext}
+        @param context: the context returned by defer
+        """
+        self.local.context = context
+
+
+    def end(self, context, completed=False):
+        """
+        record the measure of an IQ. deferred IQs are only recorded when completed is True
+
+        @type context: L{TNArchipelIQStatsContext}
+        @param context: the context of the measure
+        @type completed: boolean
+        @param completed: True if the deferred job is over
+        """
+        self.local.context = None
+        if not context or (context.deferred and not completed):
+            return
+        duration = time.time() - context.date
+        key = (context.ns, context.action)
+        self.lock.acquire()
+        try:
+            if not self.stats.has_key(key):
+                self.stats[key] = {"count": 0, "errors": 0, "processed": 0, "deferred": 0, "total_time": 0.0, "max_time": 0.0}
+            stats = self.stats[key]
+            stats["count"] += 1
+            if context.error: stats["errors"] += 1
+            if context.processed: stats["processed"] += 1
+            if context.deferred: stats["deferred"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            if not self.totals.has_key(key):
+                self.totals[key] = {"errors": 0, "processed": 0}
+            if context.error: self.totals[key]["errors"] += 1
+            if context.processed: self.totals[key]["processed"] += 1
+        finally:
+            self.lock.release()
+        self.histogram.observe(duration, {"ns": context.ns, "action": context.action})
+
+
+    def get_stats(self):
+        """
+        @rtype: list
+        @return: tuples (namespace, action, stats), the slowest actions first
+        """
+        self.lock.acquire()
+        stats = [(ns, action, dict(values)) for (ns, action), values in self.stats.items()]
+        self.lock.release()
+        for ns, action, values in stats:
+            values["average_time"] = values["total_time"] / values["count"]
+        stats.sort(key=lambda s: s[2]["total_time"], reverse=True)
+        return stats
+
+
+    def get_stats_nodes(self):
+        """
+        @rtype: list
+        @return: one xmpp.Node per (namespace, action)
+        """
+        nodes = []
+        for ns, action, values in self.get_stats():
+            nodes.append(xmpp.Node("iq", attrs={"ns": ns, "action": action,
+                                                "count": values["count"], "errors": values["errors"],
+                                                "processed": values["processed"], "deferred": values["deferred"],
+                                                "total-time": "%.6f" % values["total_time"],
+                                                "average-time": "%.6f" % values["average_time"],
+                                                "max-time": "%.6f" % values["max_time"]}))
+        return nodes
+
+
+    def reset(self):
+        """
+        forget all the measures. The exported counters are kept
+        """
+        self.lock.acquire()
+        self.stats = {}
+        self.lock.release()
+
+
+    def collect_metrics(self):
+        """
+        metrics collector of the IQ stats
+
+        @rtype: list
+        @return: the metric families
+        """
+        self.lock.acquire()
+        totals = sorted([(ns, action, dict(values)) for (ns, action), values in self.totals.items()])
+        self.lock.release()
+        return [("archipel_iq_errors", "counter", "IQs answered with an error",
+                    [({"ns": ns, "action": action}, values["errors"]) for ns, action, values in totals]),
+                ("archipel_iq_processed", "counter", "IQs that stopped the dispatch with NodeProcessed",
+                    [({"ns": ns, "action": action}, values["processed"]) for ns, action, values in totals])]
+
+
+
+# This single global instance of the stats is shared by all
+# the entities of the process
+iqstats = TNArchipelIQStats()
@@ -0,0 +1,243 @@
+#
+# archipelLibvirtPool.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelLibvirtPool, a small set of libvirt connections owned by the
+hypervisor and shared by all its virtual machines.
+"""
+
+import time
+import threading
+import libvirt
+
+from archipel.utils import *
+from archipelMetrics import metrics
+
+
+libvirt_call_duration = metrics.histogram("archipel_libvirt_call_duration_seconds", "Duration of the libvirt calls")
+
+
+class TNArchipelLibvirtConnectionSlot:
+    """
+    this class holds one real libvirt connection of the pool, and is
+    able to check its health and to reopen it
+    """
+
+    def __init__(self, uri, index):
+        """
+        the contructor of the class
+
+        @type uri: string
+        @param uri: the libvirt URI
+        @type index: int
+        @param index: the index of the slot in the pool
+        """
+        self.uri        = uri
+        self.index      = index
+        self.lock       = threading.RLock()
+        self.proxies    = []
+        self.connection = libvirt.open(self.uri)
+        if self.connection == None:
+            raise Exception("unable to open libvirt connection %s" % self.uri)
+
+
+    def is_alive(self):
+        """
+        @rtype: boolean
+        @return: True if the libvirt connection is usable
+        """
+        connection = self.connection
+        if not connection:
+            return False
+        try:
+            if hasattr(connection, "isAlive"):
+                return connection.isAlive() == 1
+            connection.getLibVersion()
+            return True
+        except libvirt.libvirtError:
+            return False
+
+
+    def reconnect(self):
+        """
+        reopen the libvirt connection if it is dead, and notify the proxies
+        using this slot
+
+        @rtype: boolean
+        @return: True if the connection is usable
+        """
+        self.lock.acquire()
+        try:
+            if self.is_alive():
+                return True
+            log.warning("LIBVIRTPOOL: connection %d to %s is dead. reconnecting" % (self.index, self.uri))
+            try:
+                if self.connection: self.connection.close()
+            except libvirt.libvirtError:
+                pass
+            self.connection = None
+            try:
+                self.connection = libvirt.open(self.uri)
+            except libvirt.libvirtError as ex:
+                log.error("LIBVIRTPOOL: unable to reconnect to %s: %s" % (self.uri, str(ex)))
+                return False
+            log.info("LIBVIRTPOOL: connection %d to %s restored" % (self.index, self.uri))
+        finally:
+            self.lock.release()
+
+        for proxy in self.proxies[:]:
+            proxy.notify_reconnect()
+        return True
+
+
+
+
+class TNArchipelLibvirtConnectionProxy(object):
+    """
+    this class looks like a libvirt.virConnect. It forwards all calls to the
+    connection of its slot. If a call fails because libvirtd has gone, the
+    connection is reopened and the call is performed again.
+    """
+
+    def __init__(self, slot):
+        """
+        the contructor of the class
+
+        @type slot: L{TNArchipelLibvirtConnectionSlot}
+        @param slot: the slot to use
+        """
+        self.slot                   = slot
+        self.reconnect_callbacks    = []
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.slot.connection, name)
+        if not callable(attribute):
+            return attribute
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                try:
+                    return getattr(self.slot.connection, name)(*args, **kwargs)
+                except libvirt.libvirtError:
+                    if self.slot.is_alive() or not self.slot.reconnect():
+                        raise
+                    return getattr(self.slot.connection, name)(*args, **kwargs)
+            finally:
+                libvirt_call_duration.observe(time.time() - start, {"method": name})
+        return call
+
+
+    def add_reconnect_callback(self, callback):
+        """
+        register a function that will be called when the underlying connection
+        has been reopened. Domains, event callbacks, etc. must be recreated there
+
+        @type callback: function
+        @param callback: the function to call
+        """
+        self.reconnect_callbacks.append(callback)
+
+
+    def notify_reconnect(self):
+        """
+        call all the reconnect callbacks
+        """
+        for callback in self.reconnect_callbacks:
+            try:
+                callback()
+            except Exception as ex:
+                log.error("LIBVIRTPOOL: exception in reconnect callback %s: %s" % (str(callback), str(ex)))
+
+
+    def close(self):
+        """
+        connections are owned by the pool. this does nothing
+        """
+        return 0
+
+
+
+
+class TNArchipelLibvirtPool:
+    """
+    this class manages a few libvirt connections shared by all entities
+    of the hypervisor. Entities get a L{TNArchipelLibvirtConnectionProxy}
+    bound to the least used connection, and release it when they are done.
+    A thread checks the health of the connections and reopens them when
+    libvirtd restarts.
+    """
+
+    def __init__(self, uri, size=2, health_check_interval=10):
+        """
+        the contructor of the class
+
+        @type uri: string
+        @param uri: the libvirt URI
+        @type size: int
+        @param size: the number of libvirt connections
+        @type health_check_interval: float
+        @param health_check_interval: the interval between two health checks in seconds
+        """
+        self.uri                    = uri
+        self.health_check_interval  = health_check_interval
+        self.lock                   = threading.Lock()
+        self.slots                  = []
+        for i in range(max(1, size)):
+            self.slots.append(TNArchipelLibvirtConnectionSlot(uri, i))
+        self.health_thread = threading.Thread(target=self.check_health, name="ArchipelLibvirtPoolHealth")
+        self.health_thread.setDaemon(True)
+        self.health_thread.start()
+
+
+    def get_connection(self):
+        """
+        @rtype: L{TNArchipelLibvirtConnectionProxy}
+        @return: a proxy to the least used connection
+        """
+        self.lock.acquire()
+        try:
+            slot = min(self.slots, key=lambda s: len(s.proxies))
+            proxy = TNArchipelLibvirtConnectionProxy(slot)
+            slot.proxies.append(proxy)
+            return proxy
+        finally:
+            self.lock.release()
+
+
+    def release_connection(self, proxy):
+        """
+        give back a proxy returned by get_connection
+
+        @type proxy: L{TNArchipelLibvirtConnectionProxy}
+        @param proxy: the proxy
+        """
+        self.lock.acquire()
+        if proxy in proxy.slot.proxies:
+            proxy.slot.proxies.remove(proxy)
+        self.lock.release()
+
+
+    def check_health(self):
+        """
+        periodically reopen the dead connections
+        """
+        while True:
+            time.sleep(self.health_check_interval)
+            for slot in self.slots:
+                if not slot.is_alive():
+                    slot.reconnect()
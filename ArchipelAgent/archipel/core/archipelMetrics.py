@@ -0,0 +1,392 @@
+#
+# archipelMetrics.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelMetricsRegistry, shared by all the entities of the
+process, that holds the counters and histograms of the agent, and
+TNArchipelMetricsExporter, a small HTTP server that exposes them in the
+OpenMetrics text format.
+"""
+
+import time
+import bisect
+import threading
+import BaseHTTPServer
+
+from archipel.utils import *
+
+
+ARCHIPEL_METRICS_DEFAULT_BUCKETS    = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ARCHIPEL_METRICS_CONTENT_TYPE       = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def format_labels(labels):
+    """
+    @type labels: dict
+    @param labels: the labels
+    @rtype: string
+    @return: the labels in the OpenMetrics format
+    """
+    if not labels:
+        return ""
+    items = []
+    for key in sorted(labels.keys()):
+        value = str(labels[key]).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        items.append("%s=\"%s\"" % (key, value))
+    return "{%s}" % ",".join(items)
+
+
+def format_value(value):
+    """
+    @rtype: string
+    @return: the value in the OpenMetrics format
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+
+
+class TNArchipelMetricsCounter:
+    """
+    this class is a counter with labels
+    """
+
+    def __init__(self, name, description):
+        """
+        the contructor of the class
+
+        @type name: string
+        @param name: the name of the metric family, without the _total suffix
+        @type description: string
+        @param description: the help of the metric
+        """
+        self.name           = name
+        self.description    = description
+        self.lock           = threading.Lock()
+        self.values         = {}
+
+
+    def inc(self, labels=None, value=1):
+        """
+        increment the counter
+
+        @type labels: dict
+        @param labels: the labels of the sample
+        @type value: float
+        @param value: the increment
+        """
+        key = tuple(sorted((labels or {}).items()))
+        self.lock.acquire()
+        self.values[key] = self.values.get(key, 0) + value
+        self.lock.release()
+
+
+    def render(self):
+        """
+        @rtype: list
+        @return: the lines of the metric family
+        """
+        lines = ["# TYPE %s counter" % self.name, "# HELP %s %s" % (self.name, self.description)]
+        self.lock.acquire()
+        values = self.values.items()
+        self.lock.release()
+        for key, value in sorted(values):
+            lines.append("%s_total%s %s" % (self.name, format_labels(dict(key)), format_value(value)))
+        return lines
+
+
+
+
+class TNArchipelMetricsHistogram:
+    """
+    this class is a histogram with labels. Observing a value is O(log(buckets))
+    """
+
+    def __init__(self, name, description, buckets=ARCHIPEL_METRICS_DEFAULT_BUCKETS):
+        """
+        the contructor of the class
+
+        @type name: string
+        @param name: the name of the metric family
+        @type description: string
+        @param description: the help of the metric
+        @type buckets: tuple
+        @param buckets: the sorted upper bounds of the buckets
+        """
+        self.name           = name
+        self.description    = description
+        self.buckets        = tuple(buckets)
+        self.lock           = threading.Lock()
+        self.values         = {}
+
+
+    def observe(self, value, labels=None):
+        """
+        add a value to the histogram
+
+        @type value: float
+        @param value: the observed value
+        @type labels: dict
+        @param labels: the labels of the sample
+        """
+        key = tuple(sorted((labels or {}).items()))
+        index = bisect.bisect_left(self.buckets, value)
+        self.lock.acquire()
+        try:
+            if not self.values.has_key(key):
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            counts = self.values[key]
+            counts[0][index] += 1
+            counts[1] += 1
+            counts[2] += value
+        finally:
+            self.lock.release()
+
+
+    def get_values(self):
+        """
+        @rtype: list
+        @return: tuples (labels, bucket counts, count, sum). bucket counts are not cumulative
+        """
+        self.lock.acquire()
+        values = [(dict(key), list(v[0]), v[1], v[2]) for key, v in self.values.items()]
+        self.lock.release()
+        return values
+
+
+    def render(self):
+        """
+        @rtype: list
+        @return: the lines of the metric family
+        """
+        lines = ["# TYPE %s histogram" % self.name, "# HELP %s %s" % (self.name, self.description)]
+        for labels, counts, count, total in sorted(self.get_values()):
+            cumulative = 0
+            for i in range(len(self.buckets) + 1):
+                cumulative += counts[i]
+                bucket_labels = dict(labels)
+                if i < len(self.buckets):
+                    bucket_labels["le"] = format_value(self.buckets[i])
+                else:
+                    bucket_labels["le"] = "+Inf"
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(bucket_labels), cumulative))
+            lines.append("%s_count%s %d" % (self.name, format_labels(labels), count))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(labels), format_value(total)))
+        return lines
+
+
+
+
+class TNArchipelMetricsRegistry:
+    """
+    this class holds the metrics of the process. Counters and histograms are
+    updated when things happen. The other values are read from the existing
+    caches by collectors, only when the metrics are rendered, so a scrape
+    never triggers a libvirt call or any I/O.
+    """
+
+    def __init__(self):
+        """
+        the contructor of the class
+        """
+        self.lock       = threading.Lock()
+        self.metrics    = {}
+        self.collectors = []
+
+
+    def counter(self, name, description):
+        """
+        get or create a counter
+
+        @type name: string
+        @param name: the name of the counter, without the _total suffix
+        @type description: string
+        @param description: the help of the counter
+        @rtype: L{TNArchipelMetricsCounter}
+        @return: the counter
+        """
+        self.lock.acquire()
+        try:
+            if not self.metrics.has_key(name):
+                self.metrics[name] = TNArchipelMetricsCounter(name, description)
+            return self.metrics[name]
+        finally:
+            self.lock.release()
+
+
+    def histogram(self, name, description, buckets=ARCHIPEL_METRICS_DEFAULT_BUCKETS):
+        """
+        get or create a histogram
+
+        @type name: string
+        @param name: the name of the histogram
+        @type description: string
+        @param description: the help of the histogram
+        @type buckets: tuple
+        @param buckets: the sorted upper bounds of the buckets
+        @rtype: L{TNArchipelMetricsHistogram}
+        @return: the histogram
+        """
+        self.lock.acquire()
+        try:
+            if not self.metrics.has_key(name):
+                self.metrics[name] = TNArchipelMetricsHistogram(name, description, buckets)
+            return self.metrics[name]
+        finally:
+            self.lock.release()
+
+
+    def add_collector(self, collector):
+        """
+        register a function called each time the metrics are rendered.
+        It must return a list of tuples (name, type, help, samples) where
+        type is "gauge" or "counter" and samples is a list of tuples (labels, value)
+
+        @type collector: function
+        @param collector: the function
+        """
+        self.lock.acquire()
+        self.collectors.append(collector)
+        self.lock.release()
+
+
+    def remove_collector(self, collector):
+        """
+        unregister a collector
+
+        @type collector: function
+        @param collector: the function
+        """
+        self.lock.acquire()
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+        self.lock.release()
+
+
+    def collect_process(self):
+        """
+        the default collector, for the process itself
+        """
+        return [("archipel_threads", "gauge", "Number of threads of the agent", [({}, threading.activeCount())]),
+                ("archipel_metrics_scrape_timestamp_seconds", "gauge", "Date of the scrape", [({}, time.time())])]
+
+
+    def render(self):
+        """
+        @rtype: string
+        @return: all the metrics in the OpenMetrics text format
+        """
+        self.lock.acquire()
+        metrics = self.metrics.values()
+        collectors = [self.collect_process] + list(self.collectors)
+        self.lock.release()
+
+        lines = []
+        for metric in sorted(metrics, key=lambda m: m.name):
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as ex:
+                log.error("METRICS: collector %s fails: %s" % (str(collector), str(ex)))
+                continue
+            for name, metric_type, description, samples in families:
+                lines.append("# TYPE %s %s" % (name, metric_type))
+                lines.append("# HELP %s %s" % (name, description))
+                suffix = ""
+                if metric_type == "counter": suffix = "_total"
+                for labels, value in samples:
+                    lines.append("%s%s%s %s" % (name, suffix, format_labels(labels), format_value(value)))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+
+
+class TNArchipelMetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    this class answers the HTTP requests of the exporter
+    """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = self.server.registry.render()
+        except Exception as ex:
+            log.error("METRICS: unable to render metrics: %s" % str(ex))
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ARCHIPEL_METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        log.debug("METRICS: %s - %s" % (self.address_string(), format % args))
+
+
+
+
+class TNArchipelMetricsExporter:
+    """
+    this class serves the metrics of a registry on http://address:port/metrics
+    from its own thread
+    """
+
+    def __init__(self, registry, address="127.0.0.1", port=9488):
+        """
+        the contructor of the class
+
+        @type registry: L{TNArchipelMetricsRegistry}
+        @param registry: the registry to expose
+        @type address: string
+        @param address: the listening address
+        @type port: int
+        @param port: the listening port
+        """
+        self.server             = BaseHTTPServer.HTTPServer((address, port), TNArchipelMetricsRequestHandler)
+        self.server.registry    = registry
+        self.thread             = threading.Thread(target=self.server.serve_forever, name="ArchipelMetricsExporter")
+        self.thread.setDaemon(True)
+
+
+    def start(self):
+        """
+        start serving
+        """
+        self.thread.start()
+        log.info("METRICS: exporter listening on %s:%d" % self.server.server_address)
+
+
+    def stop(self):
+        """
+        stop serving
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+
+# This single global instance of the registry is shared by all
+# the entities of the process
+metrics = TNArchipelMetricsRegistry()
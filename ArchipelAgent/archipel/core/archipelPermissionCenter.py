@@ -15,6 +15,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sqlite3
+import threading
 from sqlobject import *
 from archipel.utils import *
 
@@ -27,7 +30,9 @@ class TNArchipelPermissionCenter:
             lazyUpdate = True
             cacheValues = False
         
-        name = StringCol(alternateID=True)
+        entity = StringCol()
+        name = StringCol()
+        entityNameIndex = DatabaseIndex("entity", "name", unique=True)
         roles = RelatedJoin('TNArchipelRole')
         permissions = RelatedJoin('TNArchipelPermission')
     
@@ -39,7 +44,9 @@ class TNArchipelPermissionCenter:
             lazyUpdate = True
             cacheValues = False
         
-        name = StringCol(alternateID=True)
+        entity = StringCol()
+        name = StringCol()
+        entityNameIndex = DatabaseIndex("entity", "name", unique=True)
         description = StringCol()
         users = RelatedJoin('TNArchipelUser')
         permissions = RelatedJoin('TNArchipelPermission')
@@ -53,21 +60,93 @@ class TNArchipelPermissionCenter:
             lazyUpdate = True
             cacheValues = False
         
-        name = StringCol(alternateID=True)
+        entity = StringCol()
+        name = StringCol()
+        entityNameIndex = DatabaseIndex("entity", "name", unique=True)
         description = StringCol()
         defaultValue = IntCol()
         users = RelatedJoin('TNArchipelUser')
         roles = RelatedJoin('TNArchipelRole')
     
     
-    def __init__(self, database_file, root_admin):
+    def __init__(self, store, entity, root_admin, legacy_database_file=None):
+        """
+        the permissions are stored in the hypervisor wide L{TNArchipelStore}, keyed by entity.
+        If legacy_database_file is given and the permissions of the entity are not yet in the
+        store, the old database file is imported.
+        """
         self.root_admin = root_admin
-        connection_string = 'sqlite://%s' % database_file
-        self.connection = connectionForURI(connection_string)
+        self.entity = entity
+        self.store = store
+        self.effective_permissions = None
+        self.cache_lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.connection = store.permissions_connection
         
-        self.TNArchipelRole.createTable(ifNotExists=True, connection=self.connection)
-        self.TNArchipelUser.createTable(ifNotExists=True, connection=self.connection)
-        self.TNArchipelPermission.createTable(ifNotExists=True, connection=self.connection)
+        if not store.is_imported(self.entity, "permissions"):
+            if legacy_database_file and os.path.exists(legacy_database_file):
+                log.info("importing permissions of %s from %s" % (self.entity, legacy_database_file))
+                self.import_legacy_database(legacy_database_file)
+            store.set_imported(self.entity, "permissions")
+    
+    
+    @staticmethod
+    def create_tables(connection):
+        """create the tables if needed"""
+        TNArchipelPermissionCenter.TNArchipelRole.createTable(ifNotExists=True, connection=connection)
+        TNArchipelPermissionCenter.TNArchipelUser.createTable(ifNotExists=True, connection=connection)
+        TNArchipelPermissionCenter.TNArchipelPermission.createTable(ifNotExists=True, connection=connection)
+    
+    
+    @staticmethod
+    def delete_entity(connection, entity):
+        """delete all users, roles and permissions of given entity"""
+        for cls in (TNArchipelPermissionCenter.TNArchipelUser, TNArchipelPermissionCenter.TNArchipelRole, TNArchipelPermissionCenter.TNArchipelPermission):
+            for obj in list(cls.selectBy(entity=entity, connection=connection)):
+                for join in cls.sqlmeta.joins:
+                    connection.query("DELETE FROM %s WHERE %s = %d" % (join.intermediateTable, join.joinColumn, obj.id))
+                obj.destroySelf()
+    
+    
+    def import_legacy_database(self, database_file):
+        """import the users, roles and permissions of an old per entity permissions database file"""
+        legacy = sqlite3.connect(database_file)
+        try:
+            tables = [row[0] for row in legacy.execute("select name from sqlite_master where type='table'")]
+            if not "TNArchipelPermission" in tables: return
+            perms = {}
+            users = {}
+            roles = {}
+            for row_id, name, description, default in legacy.execute("select id, name, description, default_value from TNArchipelPermission"):
+                self.create_permission(name, description or "", bool(default))
+                perms[row_id] = name
+            for row_id, name in legacy.execute("select id, name from TNArchipelUser"):
+                self.create_user(name)
+                users[row_id] = name
+            for row_id, name, description in legacy.execute("select id, name, description from TNArchipelRole"):
+                self.create_role(name, description or "")
+                roles[row_id] = name
+            for perm_id, user_id in self.read_legacy_join(legacy, tables, "TNArchipelPermission", "TNArchipelUser"):
+                if perms.has_key(perm_id) and users.has_key(user_id): self.grant_permission_to_user(perms[perm_id], users[user_id])
+            for role_id, user_id in self.read_legacy_join(legacy, tables, "TNArchipelRole", "TNArchipelUser"):
+                if roles.has_key(role_id) and users.has_key(user_id): self.give_role_to_user(roles[role_id], users[user_id])
+            for perm_id, role_id in self.read_legacy_join(legacy, tables, "TNArchipelPermission", "TNArchipelRole"):
+                if perms.has_key(perm_id) and roles.has_key(role_id): self.grant_permission_to_role(perms[perm_id], roles[role_id])
+        finally:
+            legacy.close()
+    
+    
+    def read_legacy_join(self, legacy, tables, table1, table2):
+        """return the (table1 id, table2 id) rows of the intermediate table of table1 and table2"""
+        for name in ("%s_%s" % (table1, table2), "%s_%s" % (table2, table1)):
+            if not name in tables: continue
+            columns = [row[1] for row in legacy.execute("PRAGMA table_info(%s)" % name)]
+            simplified = [c.lower().replace("_", "") for c in columns]
+            column1 = columns[[c.startswith(table1.lower()) for c in simplified].index(True)]
+            column2 = columns[[c.startswith(table2.lower()) for c in simplified].index(True)]
+            return legacy.execute("select %s, %s from %s" % (column1, column2, name)).fetchall()
+        return []
     
     
     
@@ -77,7 +156,7 @@ class TNArchipelPermissionCenter:
     def create_permission(self, name, description="", default_permission=False):
         """create a new permission"""
         try:
-            self.TNArchipelPermission(name=name, description=description, defaultValue=int(default_permission), connection=self.connection)
+            self.TNArchipelPermission(entity=self.entity, name=name, description=description, defaultValue=int(default_permission), connection=self.connection)
             return True
         except dberrors.DuplicateEntryError:
             return False
@@ -85,17 +164,15 @@ class TNArchipelPermissionCenter:
     
     def get_permission(self, name):
         """get the permission by name"""
-        try:
-            return self.TNArchipelPermission.byName(name, connection=self.connection)
-        except main.SQLObjectNotFound:
-            return None
+        return self.TNArchipelPermission.selectBy(entity=self.entity, name=name, connection=self.connection).getOne(None)
     
     
     def delete_permission(self, name):
         """delete the permission by name"""
         perm = self.get_permission(name)
         if perm: 
-            perm.destroySelf(connection=self.connection)
+            perm.destroySelf()
+            self.invalidate_permission_cache()
             return True
         else:
             return False
@@ -103,7 +180,7 @@ class TNArchipelPermissionCenter:
     
     def get_permissions(self):
         """return all permissions"""
-        return self.TNArchipelPermission.select(connection=self.connection)
+        return self.TNArchipelPermission.selectBy(entity=self.entity, connection=self.connection)
     
     
     
@@ -115,8 +192,9 @@ class TNArchipelPermissionCenter:
         """create a new user"""
         try:
             trans = self.connection.transaction()
-            self.TNArchipelUser(name=name, connection=self.connection)
+            self.TNArchipelUser(entity=self.entity, name=name, connection=self.connection)
             trans.commit()
+            self.update_user_permission_cache(name)
             return True
         except dberrors.DuplicateEntryError:
             return False
@@ -124,10 +202,7 @@ class TNArchipelPermissionCenter:
     
     def get_user(self, name):
         """get the user by name"""
-        try:
-            return self.TNArchipelUser.byName(name, connection=self.connection)
-        except main.SQLObjectNotFound:
-            return None
+        return self.TNArchipelUser.selectBy(entity=self.entity, name=name, connection=self.connection).getOne(None)
     
     
     def delete_user(self, name):
@@ -137,6 +212,7 @@ class TNArchipelPermissionCenter:
             trans = self.connection.transaction()
             user.destroySelf()
             trans.commit()
+            self.update_user_permission_cache(name)
             return True
         else:
             return False
@@ -162,6 +238,7 @@ class TNArchipelPermissionCenter:
             log.info("setting permission %s to user %s" % (permission_name, user_name))
             perm.addTNArchipelUser(user)
             trans.commit()
+            self.update_user_permission_cache(user_name)
             return True
         else:
             return False
@@ -180,6 +257,7 @@ class TNArchipelPermissionCenter:
             trans.commit()
             self.TNArchipelUser.expired = True
             self.TNArchipelPermission.expired = True
+            self.update_user_permission_cache(user_name)
             return True
         else:
             return False
@@ -225,7 +303,7 @@ class TNArchipelPermissionCenter:
         """create a new role"""
         try:
             trans = self.connection.transaction()
-            self.TNArchipelRole(name=name, description=description, connection=self.connection)
+            self.TNArchipelRole(entity=self.entity, name=name, description=description, connection=self.connection)
             trans.commit()
             return True
         except dberrors.DuplicateEntryError:
@@ -234,10 +312,7 @@ class TNArchipelPermissionCenter:
     
     def get_role(self, name):
         """get the role by name"""
-        try:
-            return self.TNArchipelRole.byName(name, connection=self.connection)
-        except main.SQLObjectNotFound:
-            return None
+        return self.TNArchipelRole.selectBy(entity=self.entity, name=name, connection=self.connection).getOne(None)
     
     
     def delete_role(self, name):
@@ -247,6 +322,7 @@ class TNArchipelPermissionCenter:
             trans = self.connection.transaction()
             role.destroySelf()
             trans.commit()
+            self.invalidate_permission_cache()
             return True
         else:
             return False
@@ -260,6 +336,7 @@ class TNArchipelPermissionCenter:
             trans = self.connection.transaction()
             role.addTNArchipelUser(user)
             trans.commit()
+            self.update_user_permission_cache(user_name)
             return True
         else:
             return False
@@ -272,6 +349,7 @@ class TNArchipelPermissionCenter:
             trans = self.connection.transaction()
             role.removeTNArchipelUser(user)
             trans.commit()
+            self.update_user_permission_cache(user_name)
             return True
         else:
             return False
@@ -299,6 +377,7 @@ class TNArchipelPermissionCenter:
             trans = self.connection.transaction()
             perm.addTNArchipelRole(role)
             trans.commit()
+            self.update_role_permission_cache(role)
             return True
         else:
             return False
@@ -309,8 +388,9 @@ class TNArchipelPermissionCenter:
         role = self.get_role(role_name)
         if role and perm:
             trans = self.connection.transaction()
-            perm.addTNArchipelRole(role)
+            perm.removeTNArchipelRole(role)
             trans.commit()
+            self.update_role_permission_cache(role)
             return True
         else:
             return False
@@ -327,6 +407,71 @@ class TNArchipelPermissionCenter:
     
     
     
+    # 
+    # ### Effective permissions cache
+    #  
+    
+    def compute_user_permissions(self, user):
+        """
+        return a tuple (set of the names of the permissions of the user, including the ones given by its roles,
+        True if the permission "all" is directly granted to the user). Like before the cache, "all" only grants
+        every permission when it is given to the user itself, not through a role
+        """
+        direct = set([perm.name for perm in user.permissions])
+        permissions = set(direct)
+        for role in user.roles:
+            permissions.update([perm.name for perm in role.permissions])
+        return (permissions, "all" in direct)
+    
+    
+    def get_permission_cache(self):
+        """return the map of user name to effective permissions (see compute_user_permissions), building it if needed"""
+        self.cache_lock.acquire()
+        try:
+            if self.effective_permissions is None:
+                self.cache_misses += 1
+                cache = {}
+                for user in self.TNArchipelUser.selectBy(entity=self.entity, connection=self.connection):
+                    cache[user.name] = self.compute_user_permissions(user)
+                self.effective_permissions = cache
+            else:
+                self.cache_hits += 1
+            return self.effective_permissions
+        finally:
+            self.cache_lock.release()
+    
+    
+    def invalidate_permission_cache(self):
+        """drop the cache. it will be rebuilt on next check"""
+        self.cache_lock.acquire()
+        self.effective_permissions = None
+        self.cache_lock.release()
+    
+    
+    def update_user_permission_cache(self, user_name):
+        """recompute the effective permissions of given user"""
+        self.cache_lock.acquire()
+        try:
+            if self.effective_permissions is None: return
+            user = self.get_user(user_name)
+            if user: self.effective_permissions[user_name] = self.compute_user_permissions(user)
+            elif self.effective_permissions.has_key(user_name): del self.effective_permissions[user_name]
+        finally:
+            self.cache_lock.release()
+    
+    
+    def update_role_permission_cache(self, role):
+        """recompute the effective permissions of all users of given role"""
+        for user in role.users:
+            self.update_user_permission_cache(user.name)
+    
+    
+    def get_permission_cache_stats(self):
+        """return the hits and misses counters of the cache"""
+        return {"hits": self.cache_hits, "misses": self.cache_misses}
+    
+    
+    
     # 
     # ### User permissions verification
     #  
@@ -335,15 +480,11 @@ class TNArchipelPermissionCenter:
         """check if given user has given permission"""
         
         if user_name == self.root_admin: return True
-        if self.user_has_permission(user_name, "all"): return True
-        if not self.get_user(user_name): return False
-        if not self.get_permission(permission_name): return False
-        if self.user_has_permission(user_name, permission_name): return True
-        
-        for role in self.get_user_roles(user_name):
-            if self.role_has_permission(role.name, permission_name):
-                return True
-        return False
+        effective = self.get_permission_cache().get(user_name, None)
+        if effective is None: return False
+        permissions, all_granted = effective
+        if all_granted: return True
+        return permission_name in permissions
     
     
     def check_permissions(self, user_name, permissions):
@@ -355,9 +496,10 @@ class TNArchipelPermissionCenter:
 
 
 if __name__ == "__main__":
-    import os, sys
+    import sys
+    from archipel.core.archipelStore import TNArchipelStore
     f = sys.argv[1]
-    p = TNArchipelPermissionCenter(f, "admin")
+    p = TNArchipelPermissionCenter(TNArchipelStore(f), "test", "admin")
     
     print p.create_role("Role1")
     print p.create_role("Role2")
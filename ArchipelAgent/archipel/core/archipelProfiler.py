@@ -0,0 +1,190 @@
+#
+# archipelProfiler.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelSamplingProfiler, that finds the hot functions of the
+running agent by sampling the stacks of all its threads, and
+get_thread_stacks, that dumps these stacks.
+"""
+
+import sys
+import time
+import threading
+import traceback
+
+from archipel.utils import *
+
+
+def get_thread_stacks():
+    """
+    @rtype: list
+    @return: tuples (thread name, thread ident, formatted stack) for all the threads
+    """
+    names = dict([(thread.ident, thread.name) for thread in threading.enumerate()])
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        stacks.append((names.get(ident, "unknown"), ident, "".join(traceback.format_stack(frame))))
+    stacks.sort()
+    return stacks
+
+
+
+
+class TNArchipelProfile:
+    """
+    this class holds the result of one run of the L{TNArchipelSamplingProfiler}.
+    For each function, it counts the samples where the function was running
+    (self) and the samples where it was in the stack (total).
+    """
+
+    def __init__(self, interval):
+        """
+        the contructor of the class
+
+        @type interval: float
+        @param interval: the time between two samples in seconds
+        """
+        self.interval       = interval
+        self.self_counts    = {}
+        self.total_counts   = {}
+        self.samples        = 0
+        self.duration       = 0.0
+
+
+    def get_top(self, limit=20, sort="self"):
+        """
+        @type limit: int
+        @param limit: the number of returned functions
+        @type sort: string
+        @param sort: "self" or "total"
+        @rtype: list
+        @return: tuples (function, self samples, total samples), hottest first
+        """
+        counts = self.self_counts
+        if sort == "total":
+            counts = self.total_counts
+        keys = sorted(counts.keys(), key=lambda k: counts[k], reverse=True)[:limit]
+        return [(key, self.self_counts.get(key, 0), self.total_counts.get(key, 0)) for key in keys]
+
+
+    def format_report(self, limit=100):
+        """
+        @type limit: int
+        @param limit: the number of functions in each section
+        @rtype: string
+        @return: a text report of the profile
+        """
+        lines = ["%d samples in %.2fs, interval %.3fs" % (self.samples, self.duration, self.interval), ""]
+        for sort in ("self", "total"):
+            lines.append("hottest functions by %s samples:" % sort)
+            lines.append("%8s %8s  function" % ("self", "total"))
+            for key, self_count, total_count in self.get_top(limit, sort):
+                lines.append("%8d %8d  %s" % (self_count, total_count, key))
+            lines.append("")
+        return "\n".join(lines)
+
+
+
+
+class TNArchipelSamplingProfiler:
+    """
+    this class samples the stacks of all the threads at a regular interval.
+    Unlike cProfile, it doesn't need to be enabled when the threads start and
+    it doesn't slow down the profiled code, so it can be used on a running agent.
+    Only one profile can run at once, and each run returns its own
+    L{TNArchipelProfile}.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        the contructor of the class
+
+        @type interval: float
+        @param interval: the default time between two samples in seconds
+        """
+        self.interval       = interval
+        self.lock           = threading.Lock()
+
+
+    def function_key(self, frame):
+        """
+        @rtype: string
+        @return: the name of the function of the frame, with its file and line
+        """
+        code = frame.f_code
+        return "%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+    def sample(self, profile):
+        """
+        take one sample of all the threads but the current one
+
+        @type profile: L{TNArchipelProfile}
+        @param profile: the profile to update
+        """
+        current = threading.currentThread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            key = self.function_key(frame)
+            profile.self_counts[key] = profile.self_counts.get(key, 0) + 1
+            seen = {}
+            while frame:
+                key = self.function_key(frame)
+                if not seen.has_key(key):
+                    seen[key] = True
+                    profile.total_counts[key] = profile.total_counts.get(key, 0) + 1
+                frame = frame.f_back
+        profile.samples += 1
+
+
+    def run(self, duration, interval=None):
+        """
+        sample the threads during the given time. Only one profile can run at once
+
+        @type duration: float
+        @param duration: the duration of the profile in seconds
+        @type interval: float
+        @param interval: the time between two samples in seconds. the default interval if None
+        @rtype: L{TNArchipelProfile}
+        @return: the result of this profile
+        """
+        if not self.lock.acquire(False):
+            raise Exception("a profile is already running")
+        try:
+            profile = TNArchipelProfile(interval or self.interval)
+            start = time.time()
+            log.info("PROFILER: profiling all threads during %ss" % duration)
+            while time.time() - start < duration:
+                self.sample(profile)
+                time.sleep(profile.interval)
+            profile.duration = time.time() - start
+            log.info("PROFILER: profile done with %d samples" % profile.samples)
+            return profile
+        finally:
+            self.lock.release()
+
+
+    def is_running(self):
+        """
+        @rtype: boolean
+        @return: True if a profile is running
+        """
+        if self.lock.acquire(False):
+            self.lock.release()
+            return False
+        return True
@@ -0,0 +1,466 @@
+#
+# archipelReactor.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelReactor, an epoll based event loop that drives the XMPP
+streams of several entities and runs timers from a shared heap. The blocking
+steps of the entities (connection, authentication, unregistration) are run
+in worker threads, so they never stall the other streams.
+"""
+
+import os
+import sys
+import time
+import heapq
+import select
+import errno
+import fcntl
+import threading
+import traceback
+
+from archipel.utils import *
+
+
+class TNArchipelReactorTimer:
+    """
+    this class represents a timer scheduled in a L{TNArchipelReactor}
+    """
+
+    def __init__(self, date, sequence, callback, args):
+        """
+        the contructor of the class
+
+        @type date: float
+        @param date: the timestamp when the timer must fire
+        @type sequence: int
+        @param sequence: sequence number, used to keep FIFO order between timers with the same date
+        @type callback: function
+        @param callback: the function to call
+        @type args: tuple
+        @param args: the arguments of the callback
+        """
+        self.date       = date
+        self.sequence   = sequence
+        self.callback   = callback
+        self.args       = args
+        self.cancelled  = False
+
+    def __cmp__(self, other):
+        return cmp((self.date, self.sequence), (other.date, other.sequence))
+
+    def cancel(self):
+        """
+        cancel the timer. It will be dropped when it reaches the top of the heap
+        """
+        self.cancelled = True
+
+
+
+
+class TNArchipelReactor:
+    """
+    this class waits on the sockets of all its entities using epoll (or poll
+    if epoll is not available) and only processes the streams that are readable.
+    Reconnection delays and other timers are kept in a heap, so the reactor
+    sleeps exactly until the next event.
+    """
+
+    def __init__(self, name="ArchipelReactor", housekeeping_interval=1.0):
+        """
+        the contructor of the class
+
+        @type name: string
+        @param name: the name of the reactor, used in logs
+        @type housekeeping_interval: float
+        @param housekeeping_interval: the interval used to check entities whose state has been changed from other threads
+        """
+        self.name                   = name
+        self.housekeeping_interval  = housekeeping_interval
+        self.entities               = {}
+        self.fds                    = {}
+        self.restart_timers         = {}
+        self.blocking_entities      = {}
+        self.incoming_entities      = []
+        self.timers                 = []
+        self.timer_sequence         = 0
+        self.lock                   = threading.Lock()
+        self.stopped                = False
+        self.thread                 = None
+        self.pipetrick              = os.pipe()
+        for fd in self.pipetrick:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        if hasattr(select, "epoll"):
+            self.poller         = select.epoll()
+            self.poll_events    = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self.use_epoll      = True
+        else:
+            self.poller         = select.poll()
+            self.poll_events    = select.POLLIN | select.POLLERR | select.POLLHUP
+            self.use_epoll      = False
+        self.poller.register(self.pipetrick[0], self.poll_events)
+
+
+    ### Timers
+
+    def call_at(self, date, callback, *args):
+        """
+        run callback at given date. This can be called from any thread
+
+        @type date: float
+        @param date: the timestamp
+        @type callback: function
+        @param callback: the function to call
+        @rtype: L{TNArchipelReactorTimer}
+        @return: the timer, that can be cancelled
+        """
+        self.lock.acquire()
+        self.timer_sequence += 1
+        timer = TNArchipelReactorTimer(date, self.timer_sequence, callback, args)
+        heapq.heappush(self.timers, timer)
+        self.lock.release()
+        self.interrupt()
+        return timer
+
+
+    def call_later(self, delay, callback, *args):
+        """
+        run callback in delay seconds. This can be called from any thread
+
+        @type delay: float
+        @param delay: the delay in seconds
+        @type callback: function
+        @param callback: the function to call
+        @rtype: L{TNArchipelReactorTimer}
+        @return: the timer, that can be cancelled
+        """
+        return self.call_at(time.time() + delay, callback, *args)
+
+
+    def next_timeout(self):
+        """
+        @rtype: float
+        @return: the number of seconds until the next timer, or -1 if there is none
+        """
+        self.lock.acquire()
+        try:
+            while self.timers and self.timers[0].cancelled:
+                heapq.heappop(self.timers)
+            if not self.timers:
+                return -1
+            return max(0, self.timers[0].date - time.time())
+        finally:
+            self.lock.release()
+
+
+    def run_timers(self):
+        """
+        run all the timers that are due
+        """
+        now = time.time()
+        due = []
+        self.lock.acquire()
+        while self.timers and self.timers[0].date <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                due.append(timer)
+        self.lock.release()
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception as ex:
+                log.error("REACTOR: %s: exception in timer %s: %s" % (self.name, str(timer.callback), str(ex)))
+                t, v, tr = sys.exc_info()
+                log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+
+
+    ### Entities
+
+    def interrupt(self):
+        """
+        wake up the reactor if it is waiting for events
+        """
+        try:
+            os.write(self.pipetrick[1], 'c')
+        except OSError as ex:
+            if not ex.errno == errno.EAGAIN: raise # the pipe is full, so the reactor will wake up anyway
+
+
+    def add_entity(self, entity):
+        """
+        add an entity to the reactor. The entity will be connected
+        from the reactor thread. This can be called from any thread
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to add
+        """
+        self.lock.acquire()
+        self.incoming_entities.append(entity)
+        self.lock.release()
+        self.interrupt()
+
+
+    def count(self):
+        """
+        @rtype: int
+        @return: the number of entities handled by this reactor
+        """
+        return len(self.entities) + len(self.incoming_entities)
+
+
+    def connect_incoming_entities(self):
+        """
+        connect the entities that have been added since last iteration
+        """
+        self.lock.acquire()
+        incoming = self.incoming_entities
+        self.incoming_entities = []
+        self.lock.release()
+        for entity in incoming:
+            self.entities[entity] = None
+            entity.reactor = self
+            self.run_blocking(entity, self.connect_entity, entity)
+
+
+    def connect_entity(self, entity):
+        """
+        connect and authenticate an entity. this is run in a worker thread
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to connect
+        @rtype: boolean
+        @return: always True, the entity stays in the reactor
+        """
+        try:
+            entity.connect()
+        except Exception as ex:
+            log.error("REACTOR: %s: unable to connect entity %s: %s" % (self.name, str(entity.jid), str(ex)))
+            if entity.auto_reconnect:
+                entity.schedule_reconnect()
+        return True
+
+
+    def run_blocking(self, entity, method, *args):
+        """
+        run a blocking step of an entity in a worker thread. The stream of the
+        entity is not watched until the step is over, so it is only read by
+        the worker. The number of concurrent connections is bounded by the
+        handshake admission of the reconnect scheduler
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @type method: function
+        @param method: the step. It must return False if the entity must leave the reactor
+        """
+        self.unregister_fd(self.entities.get(entity, None))
+        self.entities[entity] = None
+        self.blocking_entities[entity] = True
+        def work():
+            result = False
+            try:
+                result = method(*args)
+            except Exception as ex:
+                log.error("REACTOR: %s: exception in blocking step of entity %s: %s" % (self.name, str(entity.jid), str(ex)))
+                t, v, tr = sys.exc_info()
+                log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+            self.call_later(0, self.did_run_blocking, entity, result)
+        thread = threading.Thread(target=work, name="%s-%s" % (self.name, str(entity.jid)))
+        thread.setDaemon(True)
+        thread.start()
+
+
+    def did_run_blocking(self, entity, result):
+        """
+        called in the reactor thread when a blocking step is over
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @type result: boolean
+        @param result: the result of the step
+        """
+        self.blocking_entities.pop(entity, None)
+        if not self.entities.has_key(entity):
+            # removed while the step was running
+            entity.close_stream()
+            return
+        if not result:
+            self.remove_entity(entity)
+            return
+        self.update_entity(entity)
+
+
+    def remove_entity(self, entity):
+        """
+        remove an entity from the reactor and close its stream
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to remove
+        """
+        self.unregister_fd(self.entities.pop(entity, None))
+        if self.restart_timers.has_key(entity):
+            self.restart_timers.pop(entity).cancel()
+        entity.reactor = None
+        log.info("REACTOR: %s: entity %s has left the reactor" % (self.name, str(entity.jid)))
+        if self.blocking_entities.has_key(entity):
+            # the stream is closed when the blocking step is over
+            return
+        entity.close_stream()
+
+
+    def unregister_fd(self, fd):
+        """
+        stop watching the given file descriptor
+
+        @type fd: int
+        @param fd: the file descriptor
+        """
+        if fd is None:
+            return
+        self.fds.pop(fd, None)
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass # the socket is already closed
+
+
+    def update_entity(self, entity):
+        """
+        make the watched file descriptor follow the state of the entity
+        stream, and schedule the restart of the entity if needed
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to update
+        """
+        if not self.entities.has_key(entity) or self.blocking_entities.has_key(entity):
+            return
+        fd = None
+        if entity.loop_status == ARCHIPEL_XMPP_LOOP_ON:
+            fd = entity.get_stream_fileno()
+        old_fd = self.entities.get(entity, None)
+        if not fd == old_fd:
+            self.unregister_fd(old_fd)
+            if fd is not None:
+                self.poller.register(fd, self.poll_events)
+                self.fds[fd] = entity
+            self.entities[entity] = fd
+        if fd is None:
+            timer = self.restart_timers.get(entity, None)
+            if entity.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
+                if timer and not timer.cancelled and timer.date == entity.loop_restart_date:
+                    return
+                if timer: timer.cancel()
+                self.restart_timers[entity] = self.call_at(entity.loop_restart_date, self.process_entity, entity)
+            else:
+                self.process_entity(entity)
+
+
+    def process_entity(self, entity):
+        """
+        run one non blocking loop step of the entity. The steps that
+        reconnect or unregister the entity are run in a worker thread
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to process
+        """
+        if not self.entities.has_key(entity) or self.blocking_entities.has_key(entity):
+            return
+        if self.restart_timers.has_key(entity):
+            self.restart_timers.pop(entity).cancel()
+        if entity.loop_status in (ARCHIPEL_XMPP_LOOP_RESTART, ARCHIPEL_XMPP_LOOP_REMOVE_USER):
+            self.run_blocking(entity, entity.loop_step, 0)
+            return
+        if not entity.loop_step(0):
+            self.remove_entity(entity)
+            return
+        self.update_entity(entity)
+
+
+    def housekeeping(self):
+        """
+        check the entities whose loop status has been changed by other threads
+        """
+        for entity, fd in self.entities.items():
+            if not entity.loop_status == ARCHIPEL_XMPP_LOOP_ON or fd is None:
+                self.update_entity(entity)
+        self.call_later(self.housekeeping_interval, self.housekeeping)
+
+
+    ### Loop
+
+    def poll(self, timeout):
+        """
+        wait for events
+
+        @type timeout: float
+        @param timeout: the max time to wait in seconds, or -1 to wait forever
+        @rtype: list
+        @return: list of (fd, events)
+        """
+        try:
+            if self.use_epoll:
+                return self.poller.poll(timeout)
+            if timeout >= 0:
+                timeout = int(timeout * 1000)
+            return self.poller.poll(timeout)
+        except (IOError, select.error) as ex:
+            if ex.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+    def run_once(self):
+        """
+        perform one iteration of the reactor
+        """
+        self.connect_incoming_entities()
+        for fd, events in self.poll(self.next_timeout()):
+            if fd == self.pipetrick[0]:
+                try:
+                    os.read(fd, 4096)
+                except OSError:
+                    pass
+                continue
+            entity = self.fds.get(fd, None)
+            if entity:
+                self.process_entity(entity)
+        self.run_timers()
+
+
+    def run(self):
+        """
+        run the reactor until stop() is called
+        """
+        self.thread = threading.currentThread()
+        log.info("REACTOR: %s: started using %s" % (self.name, self.use_epoll and "epoll" or "poll"))
+        self.call_later(self.housekeeping_interval, self.housekeeping)
+        while not self.stopped:
+            try:
+                self.run_once()
+            except Exception as ex:
+                log.error("REACTOR: %s: exception in loop: %s" % (self.name, str(ex)))
+                t, v, tr = sys.exc_info()
+                log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+        for entity in self.entities.keys():
+            self.remove_entity(entity)
+
+
+    def stop(self):
+        """
+        stop the reactor. This can be called from any thread
+        """
+        self.stopped = True
+        self.interrupt()
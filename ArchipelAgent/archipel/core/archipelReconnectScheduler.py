@@ -0,0 +1,202 @@
+#
+# archipelReconnectScheduler.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelReconnectScheduler, shared by all the entities of the
+process, that spreads reconnections over time and limits the number of
+concurrent XMPP handshakes.
+"""
+
+import time
+import random
+import threading
+
+from archipel.utils import *
+
+
+class TNArchipelReconnectScheduler:
+    """
+    this class computes the reconnection delays of the entities, using
+    exponential backoff with jitter, and allows only a limited number
+    of connect/auth handshakes at the same time. It also measures the
+    time needed to recover all the entities after an outage.
+    """
+
+    def __init__(self, base_delay=2.0, max_delay=300.0, max_handshakes=10):
+        """
+        the contructor of the class
+
+        @type base_delay: float
+        @param base_delay: the delay before the first reconnection attempt
+        @type max_delay: float
+        @param max_delay: the maximum delay between two attempts
+        @type max_handshakes: int
+        @param max_handshakes: the maximum number of concurrent handshakes
+        """
+        self.lock                   = threading.Lock()
+        self.attempts               = {}
+        self.outage_start_date      = None
+        self.last_recovery_time     = None
+        self.handshakes             = 0
+        self.configure_values(base_delay, max_delay, max_handshakes)
+
+
+    def configure_values(self, base_delay, max_delay, max_handshakes):
+        """
+        set the parameters of the scheduler
+
+        @type base_delay: float
+        @param base_delay: the delay before the first reconnection attempt
+        @type max_delay: float
+        @param max_delay: the maximum delay between two attempts
+        @type max_handshakes: int
+        @param max_handshakes: the maximum number of concurrent handshakes
+        """
+        self.base_delay     = base_delay
+        self.max_delay      = max_delay
+        self.max_handshakes = max_handshakes
+
+
+    def configure(self, configuration):
+        """
+        read the parameters of the scheduler from the configuration
+
+        @type configuration: ConfigParser
+        @param configuration: the configuration
+        """
+        base_delay      = self.base_delay
+        max_delay       = self.max_delay
+        max_handshakes  = self.max_handshakes
+        if configuration.has_option("GLOBAL", "xmpp_reconnect_base_delay"):
+            base_delay = configuration.getfloat("GLOBAL", "xmpp_reconnect_base_delay")
+        if configuration.has_option("GLOBAL", "xmpp_reconnect_max_delay"):
+            max_delay = configuration.getfloat("GLOBAL", "xmpp_reconnect_max_delay")
+        if configuration.has_option("GLOBAL", "xmpp_max_concurrent_handshakes"):
+            max_handshakes = configuration.getint("GLOBAL", "xmpp_max_concurrent_handshakes")
+        self.configure_values(base_delay, max_delay, max_handshakes)
+
+
+    ### Backoff
+
+    def entity_disconnected(self, entity):
+        """
+        register a failure of the given entity and return the delay to wait
+        before trying to reconnect it. The delay doubles on each failure,
+        up to max_delay, and is randomized to spread the reconnections.
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity that has been disconnected
+        @rtype: float
+        @return: the number of seconds to wait
+        """
+        key = entity.jid.getStripped()
+        self.lock.acquire()
+        if not self.attempts and self.outage_start_date is None:
+            self.outage_start_date = time.time()
+        attempt = self.attempts.get(key, 0)
+        self.attempts[key] = attempt + 1
+        self.lock.release()
+        delay = min(self.max_delay, self.base_delay * (2 ** min(attempt, 16)))
+        return random.uniform(delay / 2.0, delay)
+
+
+    def entity_connected(self, entity):
+        """
+        register the success of the connection of the given entity. if it
+        was the last disconnected one, log the total recovery time
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity that has been connected
+        """
+        key = entity.jid.getStripped()
+        self.lock.acquire()
+        try:
+            if not self.attempts.has_key(key):
+                return
+            del self.attempts[key]
+            if not self.attempts and self.outage_start_date is not None:
+                self.last_recovery_time = time.time() - self.outage_start_date
+                self.outage_start_date = None
+                log.info("RECONNECT: all entities have been recovered in %.2f seconds" % self.last_recovery_time)
+        finally:
+            self.lock.release()
+
+
+    def entity_removed(self, entity):
+        """
+        forget about an entity that won't reconnect anymore
+
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        self.entity_connected(entity)
+
+
+    ### Admission
+
+    def acquire_handshake(self):
+        """
+        try to get the right to start a connect/auth handshake. this never blocks
+
+        @rtype: boolean
+        @return: True if the handshake can start
+        """
+        self.lock.acquire()
+        try:
+            if self.max_handshakes > 0 and self.handshakes >= self.max_handshakes:
+                return False
+            self.handshakes += 1
+            return True
+        finally:
+            self.lock.release()
+
+
+    def release_handshake(self):
+        """
+        release the handshake slot when the handshake is over
+        """
+        self.lock.acquire()
+        self.handshakes -= 1
+        self.lock.release()
+
+
+    def admission_delay(self):
+        """
+        @rtype: float
+        @return: the delay to wait before retrying when all handshake slots are used
+        """
+        return random.uniform(0.5, 2.0)
+
+
+    def get_stats(self):
+        """
+        @rtype: dict
+        @return: the current state of the scheduler
+        """
+        self.lock.acquire()
+        stats = {   "disconnected_entities": len(self.attempts),
+                    "handshakes": self.handshakes,
+                    "outage_duration": self.outage_start_date and time.time() - self.outage_start_date or 0.0,
+                    "last_recovery_time": self.last_recovery_time }
+        self.lock.release()
+        return stats
+
+
+
+# This single global instance of the scheduler is shared by all
+# the entities of the process
+scheduler = TNArchipelReconnectScheduler()
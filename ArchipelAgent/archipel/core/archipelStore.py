@@ -0,0 +1,217 @@
+#
+# archipelStore.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelStore, the sqlite3 database shared by all the entities of
+an hypervisor. It stores permissions, triggers and watchers keyed by entity,
+and is able to import the old per virtual machine database files.
+"""
+
+import os
+import sqlite3
+import datetime
+import threading
+from sqlobject import connectionForURI
+
+from archipel.utils import *
+import archipel.core.archipelPermissionCenter
+
+
+class TNArchipelStore:
+    """
+    this class represents the hypervisor wide store. It uses a single sqlite3
+    file in WAL mode, so readers never wait for writers.
+    """
+
+    def __init__(self, database_file):
+        """
+        the contructor of the class
+
+        @type database_file: string
+        @param database_file: the path of the sqlite3 file
+        """
+        self.database_file  = database_file
+        self.lock           = threading.Lock()
+
+        if not os.path.exists(os.path.dirname(os.path.abspath(self.database_file))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.database_file)))
+
+        self.database = sqlite3.connect(self.database_file, check_same_thread=False)
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.database.execute("PRAGMA synchronous=NORMAL")
+        self.database.execute("create table if not exists triggers (entity text, name text, description text, mode integer, check_method text, check_interval integer)")
+        self.database.execute("create table if not exists watchers (entity text, name text, targetjid text, triggername text, triggeronaction text, triggeroffaction text, state integer)")
+        self.database.execute("create table if not exists imports (entity text, kind text, date date)")
+        self.database.execute("create index if not exists triggers_entity on triggers (entity)")
+        self.database.execute("create index if not exists watchers_entity on watchers (entity)")
+        self.database.execute("create unique index if not exists imports_entity_kind on imports (entity, kind)")
+        self.database.commit()
+
+        self.permissions_connection = connectionForURI("sqlite://%s" % os.path.abspath(self.database_file))
+        archipel.core.archipelPermissionCenter.TNArchipelPermissionCenter.create_tables(self.permissions_connection)
+        log.info("STORE: using database file %s" % self.database_file)
+
+
+    ### Queries
+
+    def execute(self, query, args=()):
+        """
+        execute a writing query and commit it
+
+        @type query: string
+        @param query: the SQL query
+        @type args: tuple
+        @param args: the arguments of the query
+        """
+        self.lock.acquire()
+        try:
+            self.database.execute(query, args)
+            self.database.commit()
+        finally:
+            self.lock.release()
+
+
+    def select(self, query, args=()):
+        """
+        execute a reading query
+
+        @type query: string
+        @param query: the SQL query
+        @type args: tuple
+        @param args: the arguments of the query
+        @rtype: list
+        @return: the rows
+        """
+        self.lock.acquire()
+        try:
+            return self.database.execute(query, args).fetchall()
+        finally:
+            self.lock.release()
+
+
+    ### Triggers
+
+    def get_triggers(self, entity):
+        """
+        @type entity: string
+        @param entity: the entity key
+        @rtype: list
+        @return: list of (name, description, mode, check_method, check_interval)
+        """
+        return self.select("select name, description, mode, check_method, check_interval from triggers where entity=?", (entity,))
+
+
+    def add_trigger(self, entity, name, description, mode, check_method, check_interval):
+        """
+        store a trigger of the entity
+        """
+        self.execute("insert into triggers values(?,?,?,?,?,?)", (entity, name, description, mode, check_method, check_interval))
+
+
+    def remove_trigger(self, entity, name):
+        """
+        remove a trigger of the entity
+        """
+        self.execute("delete from triggers where entity=? and name=?", (entity, name))
+
+
+    def get_watchers(self, entity):
+        """
+        @type entity: string
+        @param entity: the entity key
+        @rtype: list
+        @return: list of (name, targetjid, triggername, triggeronaction, triggeroffaction, state)
+        """
+        return self.select("select name, targetjid, triggername, triggeronaction, triggeroffaction, state from watchers where entity=?", (entity,))
+
+
+    def add_watcher(self, entity, name, targetjid, triggername, triggeronaction, triggeroffaction, state):
+        """
+        store a watcher of the entity
+        """
+        self.execute("insert into watchers values(?,?,?,?,?,?,?)", (entity, name, targetjid, triggername, triggeronaction, triggeroffaction, state))
+
+
+    def remove_watchers(self, entity, triggername):
+        """
+        remove the watchers of the entity that watch given trigger
+        """
+        self.execute("delete from watchers where entity=? and triggername=?", (entity, triggername))
+
+
+    ### Entities
+
+    def is_imported(self, entity, kind):
+        """
+        @type entity: string
+        @param entity: the entity key
+        @type kind: string
+        @param kind: "permissions" or "triggers"
+        @rtype: boolean
+        @return: True if the entity data of given kind are already in the store
+        """
+        return len(self.select("select entity from imports where entity=? and kind=?", (entity, kind))) > 0
+
+
+    def set_imported(self, entity, kind):
+        """
+        remember that the data of given kind of the entity are in the store
+        """
+        self.execute("insert or replace into imports values(?,?,?)", (entity, kind, datetime.datetime.now()))
+
+
+    def import_legacy_triggers(self, entity, database_file):
+        """
+        import the triggers and watchers of an old per virtual machine triggers.sqlite3 file
+
+        @type entity: string
+        @param entity: the entity key
+        @type database_file: string
+        @param database_file: the path of the old file
+        @rtype: int
+        @return: the number of imported rows
+        """
+        count = 0
+        if os.path.exists(database_file):
+            legacy = sqlite3.connect(database_file)
+            try:
+                tables = [row[0] for row in legacy.execute("select name from sqlite_master where type='table'")]
+                if "triggers" in tables:
+                    for name, description, mode, check_method, check_interval in legacy.execute("select * from triggers"):
+                        self.add_trigger(entity, name, description, mode, check_method, check_interval)
+                        count += 1
+                if "watchers" in tables:
+                    for name, targetjid, triggername, onaction, offaction, state in legacy.execute("select * from watchers"):
+                        self.add_watcher(entity, name, targetjid, triggername, onaction, offaction, state)
+                        count += 1
+            finally:
+                legacy.close()
+        self.set_imported(entity, "triggers")
+        return count
+
+
+    def delete_entity(self, entity):
+        """
+        remove everything related to the entity from the store
+
+        @type entity: string
+        @param entity: the entity key
+        """
+        self.execute("delete from triggers where entity=?", (entity,))
+        self.execute("delete from watchers where entity=?", (entity,))
+        self.execute("delete from imports where entity=?", (entity,))
+        archipel.core.archipelPermissionCenter.TNArchipelPermissionCenter.delete_entity(self.permissions_connection, entity)
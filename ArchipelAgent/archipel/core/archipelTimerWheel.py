@@ -0,0 +1,237 @@
+#
+# archipelTimerWheel.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNArchipelTimerWheel, shared by all the entities of the process,
+that runs periodic jobs (like the checks of the automatic triggers) on a
+small pool of threads, whatever the number of jobs.
+"""
+
+import math
+import time
+import threading
+
+from archipelExecutor import TNArchipelExecutor
+
+
+ARCHIPEL_TIMER_WHEEL_TICK       = 1.0
+ARCHIPEL_TIMER_WHEEL_SLOTS      = 64
+ARCHIPEL_TIMER_WHEEL_LEVELS     = 3
+ARCHIPEL_TIMER_WHEEL_WORKERS    = 2
+
+
+class TNArchipelTimerWheelEntry:
+    """
+    this class represents a job scheduled in the L{TNArchipelTimerWheel}
+    """
+
+    def __init__(self, expiry, callback, args, key):
+        """
+        the contructor of the class
+
+        @type expiry: int
+        @param expiry: the tick when the job must run
+        @type callback: function
+        @param callback: the function to call
+        @type args: tuple
+        @param args: the arguments of the callback
+        @type key: string
+        @param key: the executor key of the job, so jobs with the same key never run at the same time
+        """
+        self.expiry     = expiry
+        self.callback   = callback
+        self.args       = args
+        self.key        = key
+        self.cancelled  = False
+
+    def cancel(self):
+        """
+        cancel the job. It will be dropped when its slot is reached
+        """
+        self.cancelled = True
+
+
+
+
+class TNArchipelTimerWheel:
+    """
+    this class is a hierarchical timer wheel. Each level has a fixed number of
+    slots, and each slot of a level covers a whole turn of the level below.
+    Scheduling and cancelling are O(1), and a single thread advances the
+    wheel once per tick, moving the jobs of the upper levels down when their
+    time comes. Due jobs are run by a L{TNArchipelExecutor}.
+    """
+
+    def __init__(self, tick=ARCHIPEL_TIMER_WHEEL_TICK, slots=ARCHIPEL_TIMER_WHEEL_SLOTS, levels=ARCHIPEL_TIMER_WHEEL_LEVELS, workers=ARCHIPEL_TIMER_WHEEL_WORKERS):
+        """
+        the contructor of the class
+
+        @type tick: float
+        @param tick: the resolution of the wheel in seconds
+        @type slots: int
+        @param slots: the number of slots of each level
+        @type levels: int
+        @param levels: the number of levels
+        @type workers: int
+        @param workers: the number of threads running the jobs
+        """
+        self.tick           = tick
+        self.slots          = slots
+        self.levels         = levels
+        self.workers        = workers
+        self.lock           = threading.Lock()
+        self.condition      = threading.Condition(self.lock)
+        self.wheel          = [[[] for i in range(slots)] for l in range(levels)]
+        self.current        = 0
+        self.start_date     = time.time()
+        self.thread         = None
+        self.executor       = None
+        self.stats          = { "scheduled": 0,
+                                "pending": 0,
+                                "cancelled": 0,
+                                "run": 0,
+                                "late_ticks": 0 }
+
+
+    def start(self):
+        """
+        start the thread and the executor. Called by schedule, lock held
+        """
+        self.executor       = TNArchipelExecutor(self.workers, name="ArchipelTimerWheel")
+        self.start_date     = time.time()
+        self.current        = 0
+        self.thread         = threading.Thread(target=self.run, name="ArchipelTimerWheel")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def place(self, entry):
+        """
+        put an entry in its slot. lock must be held
+        """
+        delta = entry.expiry - self.current
+        if delta <= 0:
+            # due now: advance reads the current slot right after the cascade
+            self.wheel[0][self.current % self.slots].append(entry)
+            return
+        expiry = entry.expiry
+        span = self.slots
+        for level in range(self.levels):
+            if delta < span or level == self.levels - 1:
+                if delta >= span:
+                    # too far away: park it in the last slot of the top level, it will be placed again
+                    expiry = self.current + span - 1
+                self.wheel[level][(expiry / (span / self.slots)) % self.slots].append(entry)
+                return
+            span *= self.slots
+
+
+    def schedule(self, delay, callback, *args, **kwargs):
+        """
+        run callback in the executor after delay. This can be called from any thread
+
+        @type delay: float
+        @param delay: the delay in seconds. rounded up to the tick
+        @type callback: function
+        @param callback: the function to call
+        @rtype: L{TNArchipelTimerWheelEntry}
+        @return: the entry, that can be cancelled
+        """
+        self.lock.acquire()
+        try:
+            if not self.thread:
+                self.start()
+            ticks = max(int(math.ceil(delay / self.tick)), 1)
+            entry = TNArchipelTimerWheelEntry(self.current + ticks, callback, args, kwargs.get("key", None))
+            self.place(entry)
+            self.stats["scheduled"] += 1
+            self.stats["pending"] += 1
+            return entry
+        finally:
+            self.lock.release()
+
+
+    def advance(self):
+        """
+        move the wheel one tick forward. lock must be held
+
+        @rtype: list
+        @return: the due entries
+        """
+        self.current += 1
+        span = self.slots
+        for level in range(1, self.levels):
+            if self.current % span:
+                break
+            slot = self.wheel[level][(self.current / span) % self.slots]
+            self.wheel[level][(self.current / span) % self.slots] = []
+            for entry in slot:
+                self.place(entry)
+            span *= self.slots
+        index = self.current % self.slots
+        due = self.wheel[0][index]
+        self.wheel[0][index] = []
+        return due
+
+
+    def run(self):
+        """
+        the main loop of the wheel thread
+        """
+        while True:
+            self.lock.acquire()
+            delay = self.start_date + (self.current + 1) * self.tick - time.time()
+            if delay > 0:
+                self.condition.wait(delay)
+                self.lock.release()
+                continue
+            if delay < -self.tick:
+                self.stats["late_ticks"] += 1
+            due = self.advance()
+            for entry in due:
+                self.stats["pending"] -= 1
+                if entry.cancelled:
+                    self.stats["cancelled"] += 1
+                else:
+                    self.stats["run"] += 1
+            self.lock.release()
+            for entry in due:
+                if not entry.cancelled:
+                    self.executor.submit(entry.callback, *entry.args, key=entry.key)
+
+
+    def get_stats(self):
+        """
+        @rtype: dict
+        @return: the metrics of the wheel and of its executor
+        """
+        self.lock.acquire()
+        stats = dict(self.stats)
+        executor = self.executor
+        self.lock.release()
+        stats["workers"] = self.workers
+        if executor:
+            executor_stats = executor.get_stats()
+            stats["queue_depth"] = executor_stats["queue_depth"]
+            stats["max_run_time"] = executor_stats["max_run_time"]
+        return stats
+
+
+
+# This single global instance of the wheel is shared by all
+# the entities of the process
+wheel = TNArchipelTimerWheel()
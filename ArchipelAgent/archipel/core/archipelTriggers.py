@@ -18,7 +18,11 @@
 import xmpp
 import archipel.core.pubsub
 import datetime
+import time
+import threading
 from archipel.utils import *
+from archipel.core.archipelMetrics import metrics
+from archipel.core.archipelTimerWheel import wheel
 
 ARCHIPEL_TRIGGER_MODE_MANUAL    = 0
 ARCHIPEL_TRIGGER_MODE_AUTO      = 1
@@ -29,6 +33,13 @@ ARCHIPEL_TRIGGER_STATE_ON       = 1
 ARCHIPEL_WATCHER_STATE_OFF      = 0
 ARCHIPEL_WATCHER_STATE_ON       = 1
 
+# a warning is logged when a check method runs longer than this, in seconds
+ARCHIPEL_TRIGGER_SLOW_CHECK     = 1.0
+
+# the automatic triggers that are running, for the metrics
+auto_triggers_lock              = threading.Lock()
+auto_triggers                   = {}
+
 class TNArchipelTrigger:
     """this is the representation of a basic trigger"""
     
@@ -56,17 +67,24 @@ class TNArchipelTrigger:
         self.nodeName       = "/archipel/trigger/%s/%s" % (self.entity.jid.getStripped(), self.name)
         self.pubSubNode     = archipel.core.pubsub.TNPubSubNode(self.entity.xmppclient, self.entity.pubsubserver, self.nodeName)
         self.state          = ARCHIPEL_TRIGGER_STATE_OFF
+        self.published      = False
+        self.timer          = None
+        self.timer_lock     = threading.Lock()
+        self.stopped        = True
+        self.stats          = {"checks": 0, "errors": 0, "flips": 0, "total_time": 0.0, "max_time": 0.0, "last_time": 0.0}
         
         self.init_pubsub_node()
+        
+        if self.mode == ARCHIPEL_TRIGGER_MODE_AUTO and self.check_method:
+            self.start()
     
     
     def init_pubsub_node(self):
         """
-        intialize the pubsubnode. if it doesn't exists, it will be created and configured
+        intialize the pubsubnode. if it doesn't exists, it will be created and configured.
+        this doesn't wait for the answers of the server
         """
-        if not self.pubSubNode.recover():
-            self.pubSubNode.create()                    
-        self.pubSubNode.configure({
+        self.pubSubNode.ensure({
             archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
             archipel.core.pubsub.XMPP_PUBSUB_VAR_MAX_ITEMS: 1,
             archipel.core.pubsub.XMPP_PUBSUB_VAR_PERSIST_ITEMS: 0,
@@ -84,10 +102,18 @@ class TNArchipelTrigger:
     
     def set_state(self, state):
         """
-        manual set if the trigger is on or off
+        manual set if the trigger is on or off. The state is only published
+        the first time and when it changes
         @type state int
         @param state ARCHIPEL_TRIGGER_STATE_OFF or ARCHIPEL_TRIGGER_STATE_ON
+        @return True if the state has been published
         """
+        if self.published and state == self.state:
+            return False
+        if self.published: self.stats["flips"] += 1
+        self.state      = state
+        self.published  = True
+        
         triggerNode = xmpp.Node(tag="trigger", attrs={"date": datetime.datetime.now()})
         
         if self.description:
@@ -98,8 +124,106 @@ class TNArchipelTrigger:
         stateNode.setData(state)
         
         self.pubSubNode.add_item(triggerNode)
+        return True
+    
+    
+    
+    ### Automatic mode
+    
+    def start(self):
+        """
+        start running check_method in the timer wheel of the process
+        """
+        auto_triggers_lock.acquire()
+        auto_triggers[self.nodeName] = self
+        auto_triggers_lock.release()
+        self.timer_lock.acquire()
+        self.stopped    = False
+        self.timer      = wheel.schedule(0, self.check, key=self.nodeName)
+        self.timer_lock.release()
+    
+    
+    def stop(self):
+        """
+        stop running check_method. A check that is running won't be scheduled again
+        """
+        self.timer_lock.acquire()
+        self.stopped = True
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.timer_lock.release()
+        auto_triggers_lock.acquire()
+        if auto_triggers.get(self.nodeName) is self:
+            del auto_triggers[self.nodeName]
+        auto_triggers_lock.release()
+    
+    
+    def check(self):
+        """
+        run check_method and set the state according to its result.
+        this is run by the workers of the timer wheel
+        """
+        if self.stopped:
+            return
+        start = time.time()
+        try:
+            if self.check_method():
+                self.set_state(ARCHIPEL_TRIGGER_STATE_ON)
+            else:
+                self.set_state(ARCHIPEL_TRIGGER_STATE_OFF)
+        except Exception as ex:
+            self.stats["errors"] += 1
+            self.entity.log.error("TRIGGER: check of trigger %s fails: %s" % (self.name, str(ex)))
+        duration = time.time() - start
+        self.stats["checks"] += 1
+        self.stats["total_time"] += duration
+        self.stats["max_time"] = max(self.stats["max_time"], duration)
+        self.stats["last_time"] = duration
+        if duration > ARCHIPEL_TRIGGER_SLOW_CHECK:
+            self.entity.log.warning("TRIGGER: check of trigger %s took %.2fs" % (self.name, duration))
+        self.timer_lock.acquire()
+        reschedule = not self.stopped and self.check_interval > 0
+        if reschedule:
+            self.timer = wheel.schedule(self.check_interval, self.check, key=self.nodeName)
+        self.timer_lock.release()
+        if not reschedule:
+            self.stop()
     
     
+    def get_stats(self):
+        """
+        @return a dict with the number of checks, errors and state flips, and the check times
+        """
+        stats = dict(self.stats)
+        stats["average_time"] = 0.0
+        if stats["checks"]:
+            stats["average_time"] = stats["total_time"] / stats["checks"]
+        return stats
+    
+    
+
+
+
+def collect_metrics():
+    """
+    metrics collector of the automatic triggers
+    """
+    auto_triggers_lock.acquire()
+    triggers = auto_triggers.items()
+    auto_triggers_lock.release()
+    stats = [({"trigger": name}, trigger.get_stats()) for name, trigger in sorted(triggers)]
+    wheel_stats = wheel.get_stats()
+    return [("archipel_trigger_checks", "counter", "Checks of the automatic triggers", [(l, s["checks"]) for l, s in stats]),
+            ("archipel_trigger_check_errors", "counter", "Checks of the automatic triggers that failed", [(l, s["errors"]) for l, s in stats]),
+            ("archipel_trigger_check_seconds", "counter", "Time spent in the checks of the automatic triggers", [(l, s["total_time"]) for l, s in stats]),
+            ("archipel_trigger_check_max_seconds", "gauge", "Longest check of the automatic triggers", [(l, s["max_time"]) for l, s in stats]),
+            ("archipel_trigger_state_flips", "counter", "State changes of the automatic triggers", [(l, s["flips"]) for l, s in stats]),
+            ("archipel_timer_wheel_pending", "gauge", "Jobs waiting in the timer wheel", [({}, wheel_stats["pending"])]),
+            ("archipel_timer_wheel_late_ticks", "counter", "Ticks of the timer wheel processed late", [({}, wheel_stats["late_ticks"])])]
+
+metrics.add_collector(collect_metrics)
+
 
 
 
@@ -115,7 +239,7 @@ class TNArchipelTriggerWatcher:
         self.triggeroffaction   = triggeroffaction
         self.state              = ARCHIPEL_WATCHER_STATE_OFF
         self.nodename           = "/archipel/trigger/%s/%s" % (targetjid.getStripped(), self.triggername)
-        self.pubsubNode         = archipel.core.pubsubTNPubSubNode(self.entity.xmppclient, self.entity.pubsubserver, self.nodename)
+        self.pubsubNode         = archipel.core.pubsub.TNPubSubNode(self.entity.xmppclient, self.entity.pubsubserver, self.nodename)
     
     
     def watch(self):
@@ -37,7 +37,6 @@ import os
 import commands
 from threading import Timer, Thread
 import libvirt
-import sqlite3
 import thread
 
 from archipel.utils import *
@@ -45,6 +44,7 @@ from archipel.core.archipelWebSocket import *
 from archipel.core.libvirtEventLoop import *
 from archipel.core.archipelEntity import *
 from archipel.core.archipelTriggers import *
+from archipel.core.archipelDomainDefinition import *
 
 ARCHIPEL_ERROR_CODE_VM_CREATE                   = -1001
 ARCHIPEL_ERROR_CODE_VM_SUSPEND                  = -1002
@@ -79,10 +79,13 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         TNArchipelEntity.__init__(self, jid, password, configuration, name)
         
         self.hypervisor                 = hypervisor
-        self.libvirt_connection         = libvirt.open(self.configuration.get("GLOBAL", "libvirt_uri"))
+        self.executor                   = hypervisor.executor
+        self.libvirt_connection         = self.hypervisor.libvirt_pool.get_connection()
+        self.libvirt_connection.add_reconnect_callback(self.on_libvirt_reconnect)
         self.libvirt_status             = libvirt.VIR_DOMAIN_SHUTDOWN
         self.domain                     = None
         self.definition                 = None
+        self.definition_cache           = None
         self.uuid                       = self.jid.getNode()
         self.vm_disk_base_path          = self.configuration.get("VIRTUALMACHINE", "vm_base_path") + "/"
         self.folder                     = self.vm_disk_base_path + self.uuid
@@ -90,7 +93,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         self.lock_timer                 = None
         self.maximum_lock_time          = self.configuration.getint("VIRTUALMACHINE", "maximum_lock_time")
         self.is_migrating               = False
-        self.libvirt_event_callback_id  = None
+        self.libvirt_events_enabled     = False
         self.triggers                   = {}
         self.watchers                   = {}
         self.entity_type                = "virtualmachine"
@@ -99,14 +102,17 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         # create VM folders if not exists
         if not os.path.isdir(self.folder): os.makedirs(self.folder)
         
-        # triggers
-        self.log.info("creating/opening the trigger database file %s/triggers.sqlite3" % self.folder)
-        self.trigger_database = sqlite3.connect(self.folder + "/triggers.sqlite3", check_same_thread=False)
+        # triggers and permissions are in the hypervisor store
+        self.store                      = self.hypervisor.store
+        self.store_key                  = self.jid.getStripped()
+        if not self.store.is_imported(self.store_key, "triggers"):
+            self.log.info("importing the trigger database file %s/triggers.sqlite3 if any" % self.folder)
+            self.store.import_legacy_triggers(self.store_key, self.folder + "/triggers.sqlite3")
         
         # permissions
         permission_db_file              = self.folder + "/" + self.configuration.get("VIRTUALMACHINE", "vm_permissions_database_path")
         permission_admin_name           = self.configuration.get("GLOBAL", "archipel_root_admin")
-        self.permission_center          = archipel.core.archipelPermissionCenter.TNArchipelPermissionCenter(permission_db_file, permission_admin_name)
+        self.permission_center          = archipel.core.archipelPermissionCenter.TNArchipelPermissionCenter(self.store, self.store_key, permission_admin_name, permission_db_file)
         self.init_permissions()
         
         # hooks
@@ -279,7 +285,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         xmldesc.getTag('name').setData(self.name)
         
         ret = str(xmldesc).replace('xmlns="http://www.gajim.org/xmlns/undeclared" ', '')
-        self.log.debug("generated XML desc is : %s" % ret)
+        self.log.debug("generated XML desc is : %s", ret)
         return ret
     
     
@@ -326,6 +332,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         
         try:
             self.domain = self.libvirt_connection.lookupByUUIDString(self.uuid)
+            self.invalidate_definition()
         except:
             self.log.warning("Can't connect to domain with UUID %s" % self.uuid)
             self.change_presence("xa", ARCHIPEL_XMPP_SHOW_NOT_DEFINED)
@@ -334,14 +341,31 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         try:
             self.definition = xmpp.simplexml.NodeBuilder(data=str(self.domain.XMLDesc(0))).getDom()
             self.log.info("sucessfully connect to domain uuid {0}".format(self.uuid))
-            self.libvirt_event_callback_id = self.libvirt_connection.domainEventRegisterAny(self.domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.on_domain_event, None)
+            self.libvirt_events_enabled = True
             self.set_presence_according_to_libvirt_info()
         except Exception as ex:
             self.log.error("Exception while connecting to domain : %s" % str(ex))
     
     
+    def on_libvirt_reconnect(self):
+        """
+        called when the shared libvirt connection has been reopened. The old
+        domain object is not valid anymore
+        """
+        self.log.info("libvirt connection has been reopened. reconnecting to domain")
+        self.libvirt_events_enabled = False
+        self.domain = None
+        self.invalidate_definition()
+        if self.isAuth:
+            self.connect_domain()
+    
+    
     def on_domain_event(self, conn, dom, event, detail, opaque):
+        """
+        called by the hypervisor when a libvirt lifecycle event concerns this domain
+        """
         self.log.info("libvirt event received: %d with detail %s" % (event, detail))
+        self.invalidate_definition()
         
         if self.is_migrating:
             self.log.info("event received but virtual machine is migrating.")
@@ -413,11 +437,75 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
             self.unlock()
     
     
+    def on_domain_reboot(self):
+        """
+        called by the hypervisor when the domain reboots
+        """
+        self.log.info("libvirt event received: domain rebooted")
+        self.push_change("virtualmachine:control", "rebooted", excludedgroups=['vitualmachines'])
+    
+    
+    def on_domain_balloon_change(self, actual):
+        """
+        called by the hypervisor when the memory balloon of the domain changes
+        
+        @type actual: int
+        @param actual: the new memory size in KiB
+        """
+        self.log.debug("libvirt event received: balloon changed to %d KiB", actual)
+        self.invalidate_definition()
+    
+    
+    def on_domain_io_error(self, srcpath, devalias, action):
+        """
+        called by the hypervisor when the domain gets an IO error
+        
+        @type srcpath: string
+        @param srcpath: the path of the disk
+        @type devalias: string
+        @param devalias: the alias of the device
+        @type action: int
+        @param action: the action taken by libvirt
+        """
+        self.log.warning("libvirt event received: IO error on %s (%s). action is %d" % (srcpath, devalias, action))
+        self.push_change("virtualmachine:control", "ioerror", excludedgroups=['vitualmachines'])
+    
+    
+    def on_domain_block_job(self, disk, job_type, status):
+        """
+        called by the hypervisor when a block job of the domain is over
+        
+        @type disk: string
+        @param disk: the path of the disk
+        @type job_type: int
+        @param job_type: the type of the job
+        @type status: int
+        @param status: the status of the job
+        """
+        self.log.info("libvirt event received: block job %d on %s ended with status %d" % (job_type, disk, status))
+        self.invalidate_definition()
+        self.push_change("virtualmachine:disk", "blockjob", excludedgroups=['vitualmachines'])
+    
+    
+    def on_domain_device_removed(self, devalias):
+        """
+        called by the hypervisor when a device has been removed from the domain
+        
+        @type devalias: string
+        @param devalias: the alias of the removed device
+        """
+        self.log.info("libvirt event received: device %s removed" % devalias)
+        self.invalidate_definition()
+        self.push_change("virtualmachine:definition", "deviceremoved", excludedgroups=['vitualmachines'])
+    
+    
     def remove_libvirt_handler(self):
-        if not self.libvirt_event_callback_id is None:
+        """
+        stop receiving the libvirt events dispatched by the hypervisor
+        """
+        if self.libvirt_events_enabled:
             self.log.info("removing the libvirt event listener for %s" % self.jid)
-            self.libvirt_connection.domainEventDeregisterAny(self.libvirt_event_callback_id)
-            self.libvirt_event_callback_id = None
+            self.libvirt_events_enabled = False
     
     
     def disconnect(self):
@@ -429,7 +517,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         self.remove_libvirt_handler()
         
         if self.libvirt_connection:
-            self.libvirt_connection.close()
+            self.hypervisor.libvirt_pool.release_connection(self.libvirt_connection)
             self.libvirt_connection = None
         
         self.stop_novnc_proxy()
@@ -445,8 +533,9 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
             self.log.warning("aborting the VNC proxy creation cause current hypervisor %s doesn't support it." % self.libvirt_connection.getType())
             return
         
-        current_vnc_port        = self.vncdisplay()["direct"]
-        novnc_proxy_port        = self.vncdisplay()["proxy"]
+        ports                   = self.vncdisplay()
+        current_vnc_port        = ports["direct"]
+        novnc_proxy_port        = ports["proxy"]
         self.log.info("NOVNC: current proxy port is %d" % novnc_proxy_port)
         
         cert = self.configuration.get("VIRTUALMACHINE", "vnc_certificate_file")
@@ -456,7 +545,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         self.log.info("virtual machine vnc proxy accepts only SSL connection %s" % str(onlyssl))
         self.novnc_proxy = TNArchipelWebSocket("127.0.0.1", current_vnc_port, "0.0.0.0", novnc_proxy_port, certfile=cert, onlySSL=onlyssl)
         self.novnc_proxy.start()
-        self.push_change("virtualmachine:control", "websocketvncstart", excludedgroups=['vitualmachines'])
+        self.push_change("virtualmachine:control", "websocketvncstart", excludedgroups=['vitualmachines'], flush=True)
     
     
     def stop_novnc_proxy(self):
@@ -474,21 +563,25 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         """
         create or read the trigger database
         """ 
-        self.log.info("populating trigger database if not exists")
-        self.trigger_database.execute("create table if not exists triggers (name text, description text, mode integer, check_method text, check_interval integer)")
-        self.trigger_database.execute("create table if not exists watchers (name text, targetjid text, triggername text, triggeronaction text, triggeroffaction text, state integer)")
-        c = self.trigger_database.cursor()
-        
-        c.execute("select * from triggers")
-        for trigger in c:
+        self.log.info("recovering triggers from store")
+        for trigger in self.store.get_triggers(self.store_key):
             name, description, mode, check_method, check_interval = trigger
             self.log.info("recovring trigger %s" % name)
-            self.triggers[name] = TNArchipelTrigger(self, name, description) #FIXME : get the rest of the implementation
+            # actions on auth run again on reconnect: don't leave the trigger of the previous connection running
+            if self.triggers.has_key(name): self.triggers[name].stop()
+            if mode == ARCHIPEL_TRIGGER_MODE_AUTO and check_method and hasattr(self, check_method):
+                self.triggers[name] = TNArchipelTrigger(self, name, description, mode, getattr(self, check_method), check_interval)
+            else:
+                self.triggers[name] = TNArchipelTrigger(self, name, description)
         
-        c.execute("select * from watchers")
-        for watcher in c:
+        for watcher in self.store.get_watchers(self.store_key):
             name, targetjid, triggername, triggeronaction, triggeroffaction, state = watcher
             self.log.info("recovring watcher fro trigger %s" % triggername)
+            if self.watchers.has_key(name) and self.watchers[name].state == ARCHIPEL_WATCHER_STATE_ON:
+                try:
+                    self.watchers[name].unwatch()
+                except Exception as ex:
+                    self.log.warning("Can't unwatch previous watcher %s: %s" % (name, str(ex)))
             try:
                 self.watchers[name] = TNArchipelTriggerWatcher(self, name, xmpp.JID(targetjid), triggername, getattr(self, triggeronaction), getattr(self, triggeroffaction))
                 if state == ARCHIPEL_WATCHER_STATE_ON: self.watchers[name].watch()
@@ -547,7 +640,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         
         
         if action == "info":            reply = self.iq_info(iq)
-        elif action == "create":        reply = self.iq_create(iq)
+        elif action == "create":        reply = self.defer_iq(conn, iq, self.iq_create)
         elif action == "shutdown":      reply = self.iq_shutdown(iq)
         elif action == "destroy":       reply = self.iq_destroy(iq)
         elif action == "reboot":        reply = self.iq_reboot(iq)
@@ -589,7 +682,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
         
-        if action == "define":          reply = self.iq_define(iq)
+        if action == "define":          reply = self.defer_iq(conn, iq, self.iq_define)
         elif action == "undefine":      reply = self.iq_undefine(iq)
         elif action == "capabilities":  reply = self.iq_capabilities(iq)
         
@@ -659,17 +752,37 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         
     
     
-    def network_info(self):
-        desc = xmpp.simplexml.NodeBuilder(data=self.domain.XMLDesc(0)).getDom()
-        interfaces_nodes = desc.getTag("devices").getTags("interface")
+    def get_definition(self):
+        """
+        return the parsed description of the domain. It is fetched from libvirt
+        only when the cache has been invalidated
         
+        @rtype: L{TNArchipelDomainDefinition}
+        @return: the cached definition of the domain
+        """
+        definition = self.definition_cache
+        if definition is None:
+            definition = TNArchipelDomainDefinition(self.domain.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE))
+            self.definition_cache = definition
+        return definition
+    
+    
+    def invalidate_definition(self):
+        """
+        forget the cached description of the domain. It must be called each
+        time the domain definition or its live state changes
+        """
+        self.definition_cache = None
+    
+    
+    def network_info(self):
         netstats = []
-        for nic in interfaces_nodes:
-            name    = nic.getTag("alias").getAttr("name")
-            target  = nic.getTag("target").getAttr("dev")
-            stats   = self.domain.interfaceStats(target)
+        for nic in self.get_definition().nics:
+            if not nic["target"]:
+                continue
+            stats   = self.domain.interfaceStats(nic["target"])
             netstats.append({
-                "name": name,
+                "name": nic["name"],
                 "rx_bytes": stats[0],
                 "rx_packets": stats[1],
                 "rx_errs": stats[2],
@@ -688,6 +801,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         if value < 10 :
             value = 10
         self.domain.setMemory(value)
+        self.invalidate_definition()
         t = Timer(1.0, self.memoryTimer, kwargs={"requestedMemory": value})
         t.start()
     
@@ -707,6 +821,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         if value > self.domain.maxVcpus():
             raise Exception("Maximum vCPU is %d" % self.domain.maxVcpus())
         self.domain.setVcpus(int(value))
+        self.invalidate_definition()
         self.unlock()
         
     # def setCPUsPin(self, vcpu, cpumap):
@@ -720,9 +835,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
     
     
     def vncdisplay(self):
-        xmldesc = self.domain.XMLDesc(0)
-        xmldescnode = xmpp.simplexml.NodeBuilder(data=xmldesc).getDom()
-        directport = int(xmldescnode.getTag(name="devices").getTag(name="graphics").getAttr("port"))
+        directport = self.get_definition().vnc_port
         if directport == -1:
             return {"direct"        : -1, 
                     "proxy"         : -1, 
@@ -741,16 +854,12 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
     
     
     def xmldesc(self):
-        xmldesc = self.domain.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE)
-        descnode = xmpp.simplexml.NodeBuilder(data=xmldesc).getDom()
-        
-        if descnode.getTag("description"):
-            descnode.delChild("description")
-        return descnode
+        return self.get_definition().get_public_node()
     
     
     def define(self, xmldesc):
         self.libvirt_connection.defineXML(self.set_automatic_libvirt_description(xmldesc))
+        self.invalidate_definition()
         if not self.domain:
             self.connect_domain()
         self.definition = xmldesc
@@ -762,6 +871,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
             self.log.warning("virtual machine is already undefined")
             return
         self.domain.undefine()
+        self.invalidate_definition()
         self.log.info("virtual machine undefined")
     
     
@@ -769,6 +879,7 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
         self.remove_libvirt_handler()
         self.domain.undefine()
         self.definition = None
+        self.invalidate_definition()
         self.unlock()
         self.disconnect()
         self.log.info("virtual machine undefined and disconnected")
@@ -860,14 +971,13 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
     def add_trigger(self, name, description):
         if self.triggers.has_key(name): return
         self.triggers[name] = TNArchipelTrigger(self, name, description)
-        self.trigger_database.execute("insert into triggers values(?,?,?,?,?)", (name, description, ARCHIPEL_TRIGGER_MODE_MANUAL, "", -1))
-        self.trigger_database.commit()
+        self.store.add_trigger(self.store_key, name, description, ARCHIPEL_TRIGGER_MODE_MANUAL, "", -1)
     
     
     def remove_trigger(self, name):
         if not self.triggers.has_key(name): return
-        self.trigger_database.execute("delete from triggers where name='%s'" % (name))
-        self.trigger_database.commit()
+        self.store.remove_trigger(self.store_key, name)
+        self.triggers[name].stop()
         self.triggers[name].delete_pubsub_node()
         del self.triggers[name]    
     
@@ -875,15 +985,13 @@ class TNArchipelVirtualMachine(TNArchipelEntity):
     def add_watcher(self, name, targetjid, triggername, onaction, offaction, state=ARCHIPEL_WATCHER_STATE_ON):
         if self.watchers.has_key(name): return
         self.watchers[name] = TNArchipelTriggerWatcher(self, name, targetjid, triggername, onaction, offaction)
-        self.trigger_database.execute("insert into watchers values(?,?,?,?,?,?)", (name, str(targetjid), triggername, onaction.__name__, offaction.__name__, state))
-        self.trigger_database.commit()
+        self.store.add_watcher(self.store_key, name, str(targetjid), triggername, onaction.__name__, offaction.__name__, state)
         if state == ARCHIPEL_WATCHER_STATE_ON: self.watchers[name].watch()
     
     
     def remove_watcher(self, name, force=False):
         if not force and not self.watchers.has_key(name): return
-        self.trigger_database.execute("delete from watchers where triggername='%s'" % (name))
-        self.trigger_database.commit()
+        self.store.remove_watchers(self.store_key, name)
         self.watchers[name].unwatch()
         del self.watchers[name]
         
@@ -17,8 +17,17 @@
 
 
 from archipel.utils import *
+from archipelMetrics import metrics
 import xmpp
 import types
+import time
+import heapq
+import weakref
+import collections
+import threading
+
+
+publish_duration = metrics.histogram("archipel_pubsub_publish_duration_seconds", "Time between the publication of a pubsub item and the answer of the server")
 
 
 XMPP_PUBSUB_VAR_TITLE                                       = "pubsub#title"
@@ -50,6 +59,338 @@ XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM_NEVER              = "never"
 XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM_ON_SUB             = "on_sub"
 XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM_ON_SUB_PRESENCE    = "on_sub_and_presence"
 
+XMPP_NS_RSM                                                 = "http://jabber.org/protocol/rsm"
+
+# the time to wait for the answer of an asynchronous request, in seconds
+ARCHIPEL_PUBSUB_REQUEST_TIMEOUT                             = 30
+
+# the number of items asked in each page when retrieving the items of a node
+ARCHIPEL_PUBSUB_PAGE_SIZE                                   = 100
+
+
+class TNPubSubTimeoutError(Exception):
+    pass
+
+
+
+class TNPubSubFuture:
+    """
+    the result of an asynchronous pubsub request. Callbacks are called
+    with the future, in the thread that receives the answer
+    """
+    
+    def __init__(self):
+        self.event      = threading.Event()
+        self.lock       = threading.Lock()
+        self.callbacks  = []
+        self.result     = None
+        self.error      = None
+    
+    
+    def done(self):
+        """return True if the request is over"""
+        return self.event.isSet()
+    
+    
+    def set_result(self, result):
+        """complete the future with a result. ignored if already completed"""
+        self.complete(result, None)
+    
+    
+    def set_error(self, error):
+        """complete the future with an exception. ignored if already completed"""
+        self.complete(None, error)
+    
+    
+    def complete(self, result, error):
+        self.lock.acquire()
+        if self.event.isSet():
+            self.lock.release()
+            return
+        self.result     = result
+        self.error      = error
+        callbacks       = self.callbacks
+        self.callbacks  = []
+        self.event.set()
+        self.lock.release()
+        for callback in callbacks:
+            self.run_callback(callback)
+    
+    
+    def add_callback(self, callback):
+        """
+        add a function called with the future when it is completed,
+        or right now if it is already completed
+        """
+        self.lock.acquire()
+        if not self.event.isSet():
+            self.callbacks.append(callback)
+            self.lock.release()
+            return self
+        self.lock.release()
+        self.run_callback(callback)
+        return self
+    
+    
+    def run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception as ex:
+            log.error("PUBSUB: exception in future callback %s: %s" % (str(callback), str(ex)))
+    
+    
+    def wait(self, timeout=None):
+        """
+        wait for the result. never do this from the thread that reads the XMPP stream
+        """
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise TNPubSubTimeoutError("timeout")
+        if self.error:
+            raise self.error
+        return self.result
+
+
+
+class TNPubSubTimeouts:
+    """
+    this class fails the futures that have not been answered in time,
+    using a single thread for all the pending requests
+    """
+    
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.condition  = threading.Condition(self.lock)
+        self.deadlines  = []
+        self.thread     = None
+    
+    
+    def add(self, future, timeout, description):
+        self.lock.acquire()
+        heapq.heappush(self.deadlines, (time.time() + timeout, id(future), future, description))
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name="ArchipelPubSubTimeouts")
+            self.thread.setDaemon(True)
+            self.thread.start()
+        self.condition.notify()
+        self.lock.release()
+    
+    
+    def run(self):
+        while True:
+            expired = []
+            self.lock.acquire()
+            while not self.deadlines:
+                self.condition.wait()
+            now = time.time()
+            while self.deadlines and (self.deadlines[0][0] <= now or self.deadlines[0][2].done()):
+                expired.append(heapq.heappop(self.deadlines))
+            delay = None
+            if self.deadlines:
+                delay = max(self.deadlines[0][0] - now, 0.01)
+            if not expired:
+                self.condition.wait(delay)
+            self.lock.release()
+            for deadline, ident, future, description in expired:
+                if not future.done():
+                    log.warning("PUBSUB: request %s timed out" % description)
+                    future.set_error(TNPubSubTimeoutError("request %s timed out" % description))
+
+
+timeouts = TNPubSubTimeouts()
+
+
+
+class TNPubSubEventDispatcher:
+    """
+    this class delivers the pubsub events received by a connection. It
+    registers a single message handler, and finds the subscribers of
+    an event with its node name, whatever the number of subscribed nodes
+    """
+    
+    def __init__(self, xmppclient, on_collected=None):
+        """
+        @type xmppclient xmpp.Client
+        @param xmppclient the connection. only a weak reference is kept, so the
+                          dispatcher doesn't keep the connection alive
+        @type on_collected function
+        @param on_collected called with the weak reference once the connection is collected
+        """
+        self.xmppclient     = weakref.ref(xmppclient, on_collected)
+        self.lock           = threading.Lock()
+        self.subscribers    = {}
+        self.counters       = {}
+        self.registered     = False
+    
+    
+    def add_subscriber(self, nodename, jid, callback):
+        """
+        call callback with the events of the node sent to jid
+        @type nodename string
+        @param nodename the name of the node
+        @type jid xmpp.JID
+        @param jid the subscribed JID. any recipient if None
+        @type callback function
+        @param callback the function called with the event message
+        """
+        if jid: jid = xmpp.JID(jid).getStripped()
+        self.lock.acquire()
+        try:
+            if not self.subscribers.has_key(nodename):
+                self.subscribers[nodename] = []
+            self.subscribers[nodename].append((jid, callback))
+            register = not self.registered
+            self.registered = True
+        finally:
+            self.lock.release()
+        xmppclient = self.xmppclient()
+        if register and xmppclient:
+            xmppclient.RegisterHandler('message', self.on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
+    
+    
+    def remove_subscriber(self, nodename, jid, callback=None):
+        """
+        remove the subscriptions of jid to the node, with the given callback or all
+        @rtype int
+        @return the number of subscriptions of jid to the node that remain
+        """
+        if jid: jid = xmpp.JID(jid).getStripped()
+        self.lock.acquire()
+        try:
+            subscribers = [s for s in self.subscribers.get(nodename, []) if s[0] != jid or (callback and s[1] != callback)]
+            if subscribers:
+                self.subscribers[nodename] = subscribers
+            elif self.subscribers.has_key(nodename):
+                del self.subscribers[nodename]
+            unregister = self.registered and not self.subscribers
+            if unregister: self.registered = False
+            remaining = len([s for s in subscribers if s[0] == jid])
+        finally:
+            self.lock.release()
+        xmppclient = self.xmppclient()
+        if unregister and xmppclient:
+            xmppclient.UnregisterHandler('message', self.on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
+        return remaining
+    
+    
+    def on_pubsub_event(self, conn, event):
+        """
+        call the callbacks subscribed to the node of the event
+        """
+        try:
+            node = event.getTag("event").getTag("items").getAttr("node")
+        except Exception as ex:
+            log.error("PUBSUB: unable to read pubsub event: %s" % str(ex))
+            return
+        to = event.getTo()
+        if to: to = to.getStripped()
+        
+        self.lock.acquire()
+        subscribers = list(self.subscribers.get(node, []))
+        if not self.counters.has_key(node):
+            self.counters[node] = {"received": 0, "delivered": 0, "errors": 0}
+        self.counters[node]["received"] += 1
+        self.lock.release()
+        
+        delivered = errors = 0
+        for jid, callback in subscribers:
+            if jid and jid != to:
+                continue
+            try:
+                callback(event)
+                delivered += 1
+            except Exception as ex:
+                errors += 1
+                log.error("PUBSUB: error in callback of node %s: %s" % (node, str(ex)))
+        
+        self.lock.acquire()
+        self.counters[node]["delivered"] += delivered
+        self.counters[node]["errors"] += errors
+        self.lock.release()
+    
+    
+    def get_counters(self):
+        """
+        @return a dict {node name: {"received", "delivered", "errors"}}. received events
+                without subscribers for this connection are counted too
+        """
+        self.lock.acquire()
+        counters = dict([(node, dict(values)) for node, values in self.counters.items()])
+        self.lock.release()
+        return counters
+
+
+dispatchers_lock    = threading.Lock()
+dispatchers         = {}
+# the keys of the dispatchers whose connection has been collected. they are
+# only appended by the weak reference callbacks, that may run in any thread
+# during a garbage collection, so they can't take dispatchers_lock
+collected_keys      = []
+# the counters of the dispatchers of the collected connections
+retired_counters    = {}
+
+def add_counters(totals, counters):
+    """
+    add the counters of a dispatcher to totals
+    """
+    for node, values in counters.items():
+        total = totals.setdefault(node, {"received": 0, "delivered": 0, "errors": 0})
+        for key, value in values.items():
+            total[key] += value
+
+def retire_collected_dispatchers():
+    """
+    forget the dispatchers of the collected connections, keeping their counters.
+    dispatchers_lock must be held
+    """
+    while collected_keys:
+        key = collected_keys.pop()
+        dispatcher = dispatchers.get(key)
+        if dispatcher and dispatcher.xmppclient() is None:
+            del dispatchers[key]
+            add_counters(retired_counters, dispatcher.get_counters())
+
+def get_event_dispatcher(xmppclient):
+    """
+    @return the TNPubSubEventDispatcher of the connection
+    """
+    key = id(xmppclient)
+    dispatchers_lock.acquire()
+    try:
+        retire_collected_dispatchers()
+        dispatcher = dispatchers.get(key)
+        if not dispatcher or dispatcher.xmppclient() is not xmppclient:
+            if dispatcher:
+                add_counters(retired_counters, dispatcher.get_counters())
+            dispatcher = TNPubSubEventDispatcher(xmppclient, lambda ref: collected_keys.append(key))
+            dispatchers[key] = dispatcher
+        return dispatcher
+    finally:
+        dispatchers_lock.release()
+
+def collect_metrics():
+    """
+    metrics collector of the pubsub events of all the connections
+    """
+    dispatchers_lock.acquire()
+    retire_collected_dispatchers()
+    connections = dispatchers.values()
+    totals = {}
+    add_counters(totals, retired_counters)
+    dispatchers_lock.release()
+    for dispatcher in connections:
+        add_counters(totals, dispatcher.get_counters())
+    families = []
+    for key, description in (("received", "Pubsub events received"),
+                             ("delivered", "Pubsub events delivered to a subscriber"),
+                             ("errors", "Pubsub events whose subscriber failed")):
+        families.append(("archipel_pubsub_events_%s" % key, "counter", description,
+                            [({"node": node}, values[key]) for node, values in sorted(totals.items())]))
+    return families
+
+metrics.add_collector(collect_metrics)
+
+
 
 class TNPubSubNode:
     
@@ -58,7 +399,14 @@ class TNPubSubNode:
         self.pubsubserver   = pubsubserver
         self.nodename       = nodename
         self.recovered      = False
-        self.content        = None
+        self.content        = collections.OrderedDict()
+        self.cursor         = None
+        self.page_size      = ARCHIPEL_PUBSUB_PAGE_SIZE
+        self.max_items      = None
+        self.ensuring       = False
+        self.pending_items  = []
+        self.subscriber_callback    = None
+        self.subscriber_jid         = None
     
     
     
@@ -76,35 +424,113 @@ class TNPubSubNode:
             return False
     
     
-    def retrieve_items(self, wait=False):
+    def retrieve_items(self, wait=False, since=None):
         """
-        retreive or update the content of the node
+        retreive or update the content of the node, page by page
         @type wait Boolean
         @param wait if set to True, will wait for response (do not use this from a callback of XMPP event)
+        @type since string
+        @param since if set, only get the items following this cursor (see get_cursor) and add them to the content
         """
-        iq           = xmpp.Iq(typ="get", to=self.pubsubserver)
-        iq_pubsub    = iq.addChild(name='pubsub', namespace="http://jabber.org/protocol/pubsub")
-        iq_pubsub.addChild(name="items", attrs={"node": self.nodename})
+        if not wait:
+            self.retrieve_items_async(since)
+            return
         
-        if wait:
-            resp = self.xmppclient.SendAndWaitForResponse(iq)
-            return self._did_retrieve_items(self.xmppclient, resp)
-        else:
-            self.xmppclient.SendAndCallForResponse(iq, func=self._did_retrieve_items)
+        content = collections.OrderedDict()
+        if since: content = self.content
+        after = since
+        while True:
+            resp = self.xmppclient.SendAndWaitForResponse(self.build_items_iq(after))
+            if resp.getType() != "result":
+                if since and after == since:
+                    log.warning("PUBSUB: can't get the items of %s since %s. getting all items" % (self.nodename, since))
+                    return self.retrieve_items(wait=True)
+                return False
+            last, more = self.read_items_page(resp, content, after)
+            if last: after = last
+            if not more: break
+        self.content    = content
+        self.cursor     = after
+        self.recovered  = True
+        return self.recovered
     
     
     def _did_retrieve_items(self, conn, resp):
         """
-        callback triggered by retrieve_items
+        callback triggered by a single items request
         """
         if resp.getType() == "result":
-            self.content = resp.getTag("pubsub").getTag("items").getTags("item")
-            self.recovered = True
+            content = collections.OrderedDict()
+            self.cursor     = self.read_items_page(resp, content, None)[0]
+            self.content    = content
+            self.recovered  = True
             return self.recovered
         else:
             return False
     
     
+    def build_items_iq(self, after=None):
+        """
+        build the iq that asks a page of items (XEP-0059)
+        @type after string
+        @param after the id after which the page starts. the first page if None
+        """
+        iq          = xmpp.Iq(typ="get", to=self.pubsubserver)
+        iq_pubsub   = iq.addChild(name='pubsub', namespace=xmpp.protocol.NS_PUBSUB)
+        iq_pubsub.addChild(name="items", attrs={"node": self.nodename})
+        rsm         = iq_pubsub.addChild(name="set", namespace=XMPP_NS_RSM)
+        rsm.addChild("max").setData(self.page_size)
+        if after: rsm.addChild("after").setData(after)
+        return iq
+    
+    
+    def read_items_page(self, resp, content, after):
+        """
+        store the items of a page in content
+        @type resp xmpp.Iq
+        @param resp the answer of the request built by build_items_iq
+        @type content collections.OrderedDict
+        @param content the items, by id
+        @type after string
+        @param after the id after which the page starts
+        @return a tuple (id of the last item of the page given by the server, True if there are more pages).
+                servers that don't support paging send all items in one page, without last id
+        """
+        pubsub  = resp.getTag("pubsub")
+        items   = []
+        if pubsub.getTag("items"):
+            items = pubsub.getTag("items").getTags("item")
+        for item in items:
+            self.store_item(item, content)
+        rsm = pubsub.getTag("set", namespace=XMPP_NS_RSM)
+        if not rsm:
+            return None, False
+        last = rsm.getTagData("last")
+        return last, bool(last and last != after and len(items) >= self.page_size)
+    
+    
+    def store_item(self, item, content=None):
+        """
+        store an item at the end of the content, replacing the item with the same id
+        and dropping the oldest ones if the node has a maximum number of items
+        """
+        if content is None: content = self.content
+        item_id = item.getAttr("id")
+        if content.has_key(item_id):
+            del content[item_id]
+        content[item_id] = item
+        while self.max_items and len(content) > self.max_items:
+            content.popitem(last=False)
+    
+    
+    def get_cursor(self):
+        """
+        @return the id after which the items published since the last retrieval are,
+                as given by the server. used with retrieve_items(since=...)
+        """
+        return self.cursor
+    
+    
     def create(self):
         """
         create node on server if not exists
@@ -139,21 +565,25 @@ class TNPubSubNode:
             
             if nowait:
                 self.xmppclient.send(iq)
+                self.recovered  = False
+                self.content    = collections.OrderedDict()
+                self.cursor     = None
                 return
             else:
                 resp = self.xmppclient.SendAndWaitForResponse(iq)
                 if resp.getType() == "result": 
                     log.info("PUBSUB: pubsub node %s has been deleted" % self.nodename)
+                    self.recovered  = False
+                    self.content    = collections.OrderedDict()
+                    self.cursor     = None
                 else:
                     log.error("PUBSUB: can't delete pubsub: %s" % str(resp))
         except Exception as ex:
             log.error("PUBSUB: unable to delete pubsub node: %s" % str(ex))
     
     
-    def configure(self, options):
-        """configure the node"""
-        if not self.recovered: raise Exception("PUBSUB: node %s doesn't exists" % self.nodename)
-        
+    def build_configure_iq(self, options):
+        """build the iq that configures the node"""
         iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
         pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB + "#owner")
         configure   = pubsub.addChild("configure", attrs={"node": self.nodename})
@@ -161,6 +591,9 @@ class TNPubSubNode:
         
         x.addChild("field", attrs={"var": "FORM_TYPE", "type": "hidden"}).addChild("value").setData("http://jabber.org/protocol/pubsub#node_config")
         
+        if options.has_key(XMPP_PUBSUB_VAR_MAX_ITEMS):
+            self.max_items = int(options[XMPP_PUBSUB_VAR_MAX_ITEMS])
+        
         for key, value in options.items():
             field = x.addChild("field", attrs={"var": key})
             if type(value) == types.ListType:
@@ -168,7 +601,14 @@ class TNPubSubNode:
                     field.addChild("value").setData(v)
             else:
                 field.addChild("value").setData(str(value))
-        #print "\n\n" + str(iq) + "\n\n"
+        return iq
+    
+    
+    def configure(self, options):
+        """configure the node"""
+        if not self.recovered: raise Exception("PUBSUB: node %s doesn't exists" % self.nodename)
+        
+        iq = self.build_configure_iq(options)
         try:
             resp = self.xmppclient.SendAndWaitForResponse(iq)
             if resp.getType() == "result": 
@@ -181,12 +621,176 @@ class TNPubSubNode:
     
     
     
+    ### Asynchronous node management
+    
+    
+    def send_request(self, iq, description, timeout=ARCHIPEL_PUBSUB_REQUEST_TIMEOUT):
+        """
+        send an iq without waiting for the answer
+        @type iq xmpp.Iq
+        @param iq the request
+        @type description string
+        @param description the description of the request, used in logs
+        @type timeout float
+        @param timeout the time to wait for the answer
+        @return a TNPubSubFuture completed with the answer, or with an exception if the answer is an error
+        """
+        future = TNPubSubFuture()
+        def on_response(conn, resp):
+            if resp.getType() == "result":
+                future.set_result(resp)
+            else:
+                future.set_error(Exception("PUBSUB: %s failed: %s" % (description, str(resp.getTag("error")))))
+        self.xmppclient.SendAndCallForResponse(iq, func=on_response)
+        timeouts.add(future, timeout, description)
+        return future
+    
+    
+    def recover_async(self):
+        """
+        get the current pubsub node without waiting. If the node has
+        already been recovered, only the new items are retrieved
+        @return a TNPubSubFuture completed when the items are retrieved
+        """
+        since = None
+        if self.recovered: since = self.cursor
+        return self.retrieve_items_async(since)
+    
+    
+    def retrieve_items_async(self, since=None):
+        """
+        retrieve the items of the node page by page, without waiting
+        @type since string
+        @param since if set, only get the items following this cursor and add them to the content
+        @return a TNPubSubFuture completed with the node when all the pages are retrieved
+        """
+        future  = TNPubSubFuture()
+        content = collections.OrderedDict()
+        if since: content = self.content
+        
+        def request(after):
+            self.send_request(self.build_items_iq(after), "recover %s" % self.nodename).add_callback(lambda f: on_page(f, after))
+        
+        def on_page(f, after):
+            if f.error:
+                if since and after == since and not isinstance(f.error, TNPubSubTimeoutError):
+                    log.warning("PUBSUB: can't get the items of %s since %s. getting all items" % (self.nodename, since))
+                    self.retrieve_items_async().add_callback(lambda full: future.complete(full.result, full.error))
+                else:
+                    future.set_error(f.error)
+                return
+            try:
+                last, more = self.read_items_page(f.result, content, after)
+            except Exception as ex:
+                future.set_error(ex)
+                return
+            if last: after = last
+            if more:
+                request(after)
+                return
+            self.content    = content
+            self.cursor     = after
+            self.recovered  = True
+            future.set_result(self)
+        
+        request(since)
+        return future
+    
+    
+    def create_async(self):
+        """
+        create node on server without waiting
+        @return a TNPubSubFuture completed when the node is created
+        """
+        iq      = xmpp.Iq(typ="set", to=self.pubsubserver)
+        iq.addChild(name="pubsub", namespace=xmpp.protocol.NS_PUBSUB).addChild(name="create", attrs={"node": self.nodename})
+        future  = self.send_request(iq, "create %s" % self.nodename)
+        def on_created(f):
+            if not f.error:
+                log.info("PUBSUB: pubsub node %s has been created" % self.nodename)
+                self.content    = collections.OrderedDict()
+                self.cursor     = None
+                self.recovered  = True
+        return future.add_callback(on_created)
+    
+    
+    def configure_async(self, options):
+        """
+        configure the node without waiting
+        @return a TNPubSubFuture completed when the node is configured
+        """
+        return self.send_request(self.build_configure_iq(options), "configure %s" % self.nodename)
+    
+    
+    def ensure(self, options=None, create=True):
+        """
+        recover the node, create it if it doesn't exist, and configure it, without
+        waiting. The requests of many nodes are pipelined on the stream. The items
+        added in the meantime are published once the node is ready
+        @type options dict
+        @param options the configuration of the node. not configured if None
+        @type create Boolean
+        @param create if False, the node is not created if it doesn't exist
+        @return a TNPubSubFuture completed with the node when it is ready
+        """
+        ready = TNPubSubFuture()
+        self.ensuring = True
+        
+        def on_ready(f):
+            if f and f.error:
+                # like configure, a configuration failure doesn't make the node unusable
+                log.error("PUBSUB: can't configure pubsub %s: %s" % (self.nodename, str(f.error)))
+            self.ensuring = False
+            items = self.pending_items
+            self.pending_items = []
+            for item, callback in items:
+                self.add_item(item, callback)
+            ready.set_result(self)
+        
+        def on_failed(error):
+            log.error("PUBSUB: unable to get pubsub node %s: %s" % (self.nodename, str(error)))
+            self.ensuring = False
+            if self.pending_items:
+                log.error("PUBSUB: %d items for node %s are dropped" % (len(self.pending_items), self.nodename))
+            self.pending_items = []
+            ready.set_error(error)
+        
+        def configure():
+            if options:
+                self.configure_async(options).add_callback(on_ready)
+            else:
+                on_ready(None)
+        
+        def on_created(f):
+            if f.error: on_failed(f.error)
+            else: configure()
+        
+        def on_recovered(f):
+            if not f.error:
+                configure()
+            elif create and not isinstance(f.error, TNPubSubTimeoutError):
+                log.info("PUBSUB: trying to create pubsub node %s" % self.nodename)
+                self.create_async().add_callback(on_created)
+            else:
+                on_failed(f.error)
+        
+        self.recover_async().add_callback(on_recovered)
+        return ready
+    
+    
+    
+    
     ### Item management
      
     
     def get_items(self):
-        """return an array of all items"""
-        return self.content
+        """return an array of all items, oldest first"""
+        return self.content.values()
+    
+    
+    def get_item(self, item_id):
+        """return the item with the given ID, or None"""
+        return self.content.get(item_id)
     
     
     def add_item(self, itemcontentnode, callback=None):
@@ -194,7 +798,11 @@ class TNPubSubNode:
         add a leaf item xmpp.node to the node and will trigger callback if any
         on server answer
         """
-        if not self.recovered: raise Exception("PUBSUB: node %s doesn't exists" % self.nodename)
+        if not self.recovered:
+            if self.ensuring:
+                self.pending_items.append((itemcontentnode, callback))
+                return
+            raise Exception("PUBSUB: node %s doesn't exists" % self.nodename)
         
         iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
         pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
@@ -203,18 +811,21 @@ class TNPubSubNode:
         
         item.addChild(node=itemcontentnode)
         
-        self.xmppclient.SendAndCallForResponse(iq, func=self.did_publish_item, args={"callback": callback, "item": item})
+        self.xmppclient.SendAndCallForResponse(iq, func=self.did_publish_item, args={"callback": callback, "item": item, "date": time.time()})
     
     
-    def did_publish_item(self, conn, response, callback, item):
+    def did_publish_item(self, conn, response, callback, item, date=None):
         """
         triggered on response
         """
         log.debug("PUBSUB: item published is node %s" % self.nodename)
+        if date:
+            publish_duration.observe(time.time() - date, {"result": response.getType()})
         
         if response.getType() == "result":
             item.setAttr("id", response.getTag("pubsub").getTag("publish").getTag("item").getAttr("id"))
-            self.content.append(item)
+            # the server drops the oldest items, so does store_item
+            self.store_item(item)
         if callback: callback(response)
     
     
@@ -223,13 +834,11 @@ class TNPubSubNode:
         iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
         pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
         retract     = pubsub.addChild("retract", attrs={"node": self.nodename})
-        item        = retract.addChild("item", attrs={"id": item_id})
+        retract.addChild("item", attrs={"id": item_id})
+        
+        if self.content.has_key(item_id):
+            del self.content[item_id]
         
-        for item in self.content:
-            if item.getAttr("id") == item_id:
-                self.content.remove(item)
-                break
-            
         self.xmppclient.SendAndCallForResponse(iq, func=self.did_remove_item, args={"callback": callback, "user_info": user_info})
     
     
@@ -243,7 +852,8 @@ class TNPubSubNode:
     
     def subscribe(self, jid, event_callback):
         """
-        subscribe to the node
+        subscribe to the node. The events are delivered by the
+        event dispatcher of the connection
         """
         self.subscriber_callback = event_callback
         self.subscriber_jid      = jid
@@ -252,36 +862,26 @@ class TNPubSubNode:
         pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
         subscribe   = pubsub.addChild("subscribe", attrs={"node": self.nodename, "jid": jid})
         
-        self.xmppclient.RegisterHandler('message', self.on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
+        get_event_dispatcher(self.xmppclient).add_subscriber(self.nodename, jid, event_callback)
         
         self.xmppclient.send(iq)
     
     
-    def on_pubsub_event(self, conn, event):
-        """
-        trigger the callback for events
-        """
-        try:
-            #log.info(event)
-            node = event.getTag("event").getTag("items").getAttr("node")
-            if node == self.nodename and self.subscriber_callback and event.getTo() == self.subscriber_jid:
-                self.subscriber_callback(event)
-        except Exception as ex:
-            log.error("Error in on_pubsub_event : %s" % str(ex))
-    
-    
     def unsubscribe(self, jid):
         """
-        unsubscribe from a node
+        unsubscribe from a node. The subscription of jid on the server is only
+        removed if no other callback of the connection is subscribed to the node
         """
+        remaining = get_event_dispatcher(self.xmppclient).remove_subscriber(self.nodename, jid, self.subscriber_callback)
         self.subscriber_callback    = None
         self.subscriber_jid         = None
+        if remaining > 0:
+            return
         
         iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
         pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
         unsubscribe = pubsub.addChild("unsubscribe", attrs={"node": self.nodename, "jid": jid})
         
-        self.xmppclient.UnregisterHandler('message', self.on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
         log.info(str(iq))
         self.xmppclient.send(iq)
 
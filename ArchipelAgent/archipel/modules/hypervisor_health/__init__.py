@@ -18,11 +18,15 @@
 
 from archipel.utils import *
 import archipel.core.archipelHypervisor
+import archipel.core.archipelVirtualMachine
 
 import health
+import vmhealth
+import archipelStatsRetention
 
 
 ARCHIPEL_NS_HYPERVISOR_HEALTH = "archipel:hypervisor:health"
+ARCHIPEL_NS_VM_HEALTH         = "archipel:virtualmachine:health"
 
 
 ### Registring of the stanza
@@ -34,8 +38,29 @@ def __module_init__health_module(self):
     max_rows_before_purge   = self.configuration.getint("HEALTH", "max_rows_before_purge")
     max_cached_rows         = self.configuration.getint("HEALTH", "max_cached_rows")
     log_file                = self.configuration.get("LOGGING", "logging_file_path")
+    log_date_format         = self.configuration.get("LOGGING", "logging_date_format", raw=True)
+    max_memory_rows         = 17280
+    vm_collection_interval  = 5
+    vm_max_samples          = 720
+    publish_batch           = 1
+    pubsub_max_items        = 10
+    if self.configuration.has_option("HEALTH", "max_memory_rows"):
+        max_memory_rows = self.configuration.getint("HEALTH", "max_memory_rows")
+    retention_tiers = []
+    for name, resolution, retention in archipelStatsRetention.ARCHIPEL_HEALTH_DEFAULT_TIERS:
+        if self.configuration.has_option("HEALTH", "health_retention_%s" % name):
+            retention = self.configuration.getint("HEALTH", "health_retention_%s" % name)
+        retention_tiers.append((name, resolution, retention))
+    if self.configuration.has_option("HEALTH", "vm_health_collection_interval"):
+        vm_collection_interval = self.configuration.getfloat("HEALTH", "vm_health_collection_interval")
+    if self.configuration.has_option("HEALTH", "vm_health_max_samples"):
+        vm_max_samples = self.configuration.getint("HEALTH", "vm_health_max_samples")
+    if self.configuration.has_option("HEALTH", "health_publish_batch"):
+        publish_batch = self.configuration.getint("HEALTH", "health_publish_batch")
+    if self.configuration.has_option("HEALTH", "health_pubsub_max_items"):
+        pubsub_max_items = self.configuration.getint("HEALTH", "health_pubsub_max_items")
     
-    self.module_health = health.TNHypervisorHealth(self, db_file, collection_interval, max_rows_before_purge, max_cached_rows, log_file)
+    self.module_health = health.TNHypervisorHealth(self, db_file, collection_interval, max_rows_before_purge, max_cached_rows, log_file, vm_collection_interval, vm_max_samples, max_memory_rows, tuple(retention_tiers), publish_batch, pubsub_max_items, log_date_format)
 
 
 def __module_register_stanza__heatlh_module(self):
@@ -43,5 +68,16 @@ def __module_register_stanza__heatlh_module(self):
 
 
 
+def __module_init__vm_health_module(self):
+    self.module_vm_health = vmhealth.TNVirtualMachineHealth(self)
+
+
+def __module_register_stanza__vm_heatlh_module(self):
+    self.xmppclient.RegisterHandler('iq', self.module_vm_health.process_iq, ns=ARCHIPEL_NS_VM_HEALTH)
+
+
+
 setattr(archipel.core.archipelHypervisor.TNArchipelHypervisor, "__module_init__health_module", __module_init__health_module)
 setattr(archipel.core.archipelHypervisor.TNArchipelHypervisor, "__module_register_stanza__heatlh_module", __module_register_stanza__heatlh_module)
+setattr(archipel.core.archipelVirtualMachine.TNArchipelVirtualMachine, "__module_init__vm_health_module", __module_init__vm_health_module)
+setattr(archipel.core.archipelVirtualMachine.TNArchipelVirtualMachine, "__module_register_stanza__vm_heatlh_module", __module_register_stanza__vm_heatlh_module)
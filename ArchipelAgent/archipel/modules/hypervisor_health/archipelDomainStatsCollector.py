@@ -0,0 +1,193 @@
+# archipelstatcollector
+#
+# archipelDomainStatsCollector.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+from threading import Thread
+from archipel.utils import *
+from archipelStatsRingBuffer import *
+
+
+# the columns of the domain samples, in order
+ARCHIPEL_DOMAIN_STATS_COLUMNS = ("date", "cpu", "memory", "disk_read", "disk_write", "disk_read_iops", "disk_write_iops", "net_rx", "net_tx")
+
+
+class TNThreadedDomainStatsCollector(Thread):
+    """
+    this class samples all the domains of the hypervisor regularly, using one
+    bulk libvirt call, and keeps the rates of each domain in ring buffers
+    """
+    def __init__(self, hypervisor, collection_interval, max_samples):
+        """
+        the contructor of the class
+
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor
+        @type collection_interval: float
+        @param collection_interval: the interval between two samples in seconds
+        @type max_samples: int
+        @param max_samples: the number of samples kept for each domain
+        """
+        self.hypervisor             = hypervisor
+        self.collection_interval    = collection_interval
+        self.max_samples            = max_samples
+        self.lock                   = threading.Lock()
+        self.samples                = {}
+        self.last_counters          = {}
+        Thread.__init__(self, name="ArchipelDomainStatsCollector")
+        self.setDaemon(True)
+
+
+    def get_counters(self, stats):
+        """
+        extract the cumulative counters from libvirt stats
+
+        @type stats: dict
+        @param stats: the libvirt stats of a domain
+        @rtype: dict
+        @return: the counters
+        """
+        counters = {"cpu": stats.get("cpu.time", 0), "vcpus": stats.get("vcpu.current", 1) or 1,
+                    "memory": stats.get("balloon.current", 0),
+                    "disk_read": 0, "disk_write": 0, "disk_read_iops": 0, "disk_write_iops": 0,
+                    "net_rx": 0, "net_tx": 0}
+        for i in range(stats.get("block.count", 0)):
+            counters["disk_read"]       += stats.get("block.%d.rd.bytes" % i, 0)
+            counters["disk_write"]      += stats.get("block.%d.wr.bytes" % i, 0)
+            counters["disk_read_iops"]  += stats.get("block.%d.rd.reqs" % i, 0)
+            counters["disk_write_iops"] += stats.get("block.%d.wr.reqs" % i, 0)
+        for i in range(stats.get("net.count", 0)):
+            counters["net_rx"]          += stats.get("net.%d.rx.bytes" % i, 0)
+            counters["net_tx"]          += stats.get("net.%d.tx.bytes" % i, 0)
+        return counters
+
+
+    def compute_sample(self, date, previous_date, counters, previous):
+        """
+        compute the rates between two set of counters
+
+        @rtype: tuple
+        @return: a sample with the values of ARCHIPEL_DOMAIN_STATS_COLUMNS
+        """
+        elapsed = date - previous_date
+        if elapsed <= 0:
+            return None
+        def rate(key):
+            delta = counters[key] - previous[key]
+            if delta < 0: delta = 0 # counters have been reset (domain restarted)
+            return delta / elapsed
+        cpu = rate("cpu") * 100.0 / (1000000000.0 * counters["vcpus"])
+        return (date, min(cpu, 100.0), counters["memory"],
+                rate("disk_read"), rate("disk_write"), rate("disk_read_iops"), rate("disk_write_iops"),
+                rate("net_rx"), rate("net_tx"))
+
+
+    def collect(self):
+        """
+        take one sample of all the domains. Nothing is collected until the
+        hypervisor is connected to libvirt, as modules are initialized before
+        """
+        if not getattr(self.hypervisor, "libvirt_connection", None):
+            return
+        date = time.time()
+        domains_stats = self.hypervisor.get_domains_stats(fields=["cpu", "vcpu", "balloon", "block", "interface"], filters=["active"])
+        seen = {}
+        self.lock.acquire()
+        try:
+            for uuid, name, stats in domains_stats:
+                seen[uuid] = True
+                counters = self.get_counters(stats)
+                if self.last_counters.has_key(uuid):
+                    previous_date, previous = self.last_counters[uuid]
+                    sample = self.compute_sample(date, previous_date, counters, previous)
+                    if sample:
+                        if not self.samples.has_key(uuid):
+                            self.samples[uuid] = TNStatsRingBuffer(ARCHIPEL_DOMAIN_STATS_COLUMNS, self.max_samples)
+                        self.samples[uuid].append(sample)
+                self.last_counters[uuid] = (date, counters)
+            for uuid in self.last_counters.keys():
+                if not seen.has_key(uuid):
+                    del self.last_counters[uuid]
+            for uuid in self.samples.keys():
+                if not seen.has_key(uuid) and not self.hypervisor.virtualmachines.has_key(uuid):
+                    del self.samples[uuid]
+        finally:
+            self.lock.release()
+
+
+    def get_domain_stats(self, uuid, limit=1, step=1):
+        """
+        return the last samples of a domain, newest first. if step is greater than 1,
+        each returned sample is the average of step consecutive samples
+
+        @type uuid: string
+        @param uuid: the UUID of the domain
+        @type limit: int
+        @param limit: the maximum number of returned samples
+        @type step: int
+        @param step: the number of samples to average in each returned sample
+        @rtype: list
+        @return: list of dict with keys of ARCHIPEL_DOMAIN_STATS_COLUMNS
+        """
+        step = max(1, step)
+        self.lock.acquire()
+        try:
+            if not self.samples.has_key(uuid):
+                return []
+            samples = self.samples[uuid].get_last_rows(limit * step)
+        finally:
+            self.lock.release()
+        ret = []
+        for i in range(0, len(samples), step):
+            bucket = samples[i:i + step]
+            values = [bucket[0][0]]
+            for column in range(1, len(ARCHIPEL_DOMAIN_STATS_COLUMNS)):
+                values.append(sum([s[column] for s in bucket]) / float(len(bucket)))
+            ret.append(dict(zip(ARCHIPEL_DOMAIN_STATS_COLUMNS, values)))
+        return ret
+
+
+    def get_top_domains(self, column, limit=10):
+        """
+        return the domains with the highest last value of given column
+
+        @type column: string
+        @param column: one of ARCHIPEL_DOMAIN_STATS_COLUMNS
+        @type limit: int
+        @param limit: the number of returned domains
+        @rtype: list
+        @return: list of tuples (uuid, value)
+        """
+        index = ARCHIPEL_DOMAIN_STATS_COLUMNS.index(column)
+        self.lock.acquire()
+        values = [(uuid, samples.get_last_rows(1)[0][index]) for uuid, samples in self.samples.items() if len(samples)]
+        self.lock.release()
+        values.sort(key=lambda v: v[1], reverse=True)
+        return values[:limit]
+
+
+    def run(self):
+        """
+        overiddes sur super class method. sample the domains forever
+        """
+        while(1):
+            try:
+                self.collect()
+            except Exception as ex:
+                log.error("domain stat collection fails. Exception %s" % str(ex))
+            time.sleep(self.collection_interval)
@@ -0,0 +1,194 @@
+# archipelstatcollector
+#
+# archipelLogReader.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import time
+
+
+ARCHIPEL_LOG_LEVELS         = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+ARCHIPEL_LOG_COLORS_RE      = re.compile("\033\\[[0-9;]*m")
+ARCHIPEL_LOG_MAX_BACKUPS    = 100
+
+
+class TNLogReader:
+    """
+    this class reads the records of a rotating log file from the end, without
+    reading the whole file. The backups of the file (file.1, file.2...) are
+    read when needed. Records can be filtered by level, date and content, and
+    read page by page using the returned cursor.
+    """
+    def __init__(self, path, date_format="%Y-%m-%d %H:%M:%S", block_size=65536):
+        """
+        the contructor of the class
+
+        @type path: string
+        @param path: the path of the log file
+        @type date_format: string
+        @param date_format: the date format of the log records
+        @type block_size: int
+        @param block_size: the number of bytes read at once
+        """
+        self.path           = path
+        self.date_format    = date_format
+        self.block_size     = block_size
+
+
+    def get_files(self):
+        """
+        @rtype: list
+        @return: the existing log files as tuples (path, inode), newest first
+        """
+        files = []
+        for i in range(ARCHIPEL_LOG_MAX_BACKUPS + 1):
+            path = self.path
+            if i > 0:
+                path = "%s.%d" % (self.path, i)
+            try:
+                files.append((path, os.stat(path).st_ino))
+            except OSError:
+                if i > 0:
+                    break
+        return files
+
+
+    def reverse_lines(self, path, end=None):
+        """
+        read the lines of a file from the end
+
+        @type path: string
+        @param path: the path of the file
+        @type end: int
+        @param end: the offset to read from. the end of the file if None
+        @rtype: generator
+        @return: tuples (line, offset of the line), last line first
+        """
+        f = open(path, "rb")
+        try:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            if end is not None:
+                position = min(end, position)
+            remaining = ""
+            while position > 0:
+                size = min(self.block_size, position)
+                position -= size
+                f.seek(position)
+                lines = (f.read(size) + remaining).split("\n")
+                remaining = lines.pop(0)
+                line_end = position + len(remaining)
+                offsets = []
+                for line in lines:
+                    offsets.append(line_end + 1)
+                    line_end += len(line) + 1
+                for i in range(len(lines) - 1, -1, -1):
+                    yield lines[i], offsets[i]
+            yield remaining, 0
+        finally:
+            f.close()
+
+
+    def parse_record(self, line):
+        """
+        parse the first line of a record
+
+        @type line: string
+        @param line: the line
+        @rtype: dict
+        @return: the record, or None if the line doesn't start a record
+        """
+        infos = line.split("::", 3)
+        if len(infos) < 4:
+            return None
+        level = ARCHIPEL_LOG_COLORS_RE.sub("", infos[0]).strip()
+        if not level in ARCHIPEL_LOG_LEVELS:
+            return None
+        return {"level": level, "date": infos[1], "file": infos[2], "message": infos[3], "line": line}
+
+
+    def get_timestamp(self, record):
+        """
+        @rtype: float
+        @return: the timestamp of the record, or None if the date can't be parsed
+        """
+        try:
+            return time.mktime(time.strptime(record["date"], self.date_format))
+        except ValueError:
+            return None
+
+
+    def read(self, limit, levels=None, start=None, end=None, search=None, cursor=None):
+        """
+        read the last records matching the filters, newest first. The lines
+        following a record line (tracebacks...) are part of this record
+
+        @type limit: int
+        @param limit: the maximum number of records
+        @type levels: list
+        @param levels: the wanted levels. all if None
+        @type start: float
+        @param start: the oldest wanted timestamp
+        @type end: float
+        @param end: the newest wanted timestamp
+        @type search: string
+        @param search: a string that the records must contain
+        @type cursor: string
+        @param cursor: the cursor returned by a previous read, to get the next page
+        @rtype: tuple
+        @return: the list of records and the cursor of the next page, or None if there is no more records
+        """
+        files = self.get_files()
+        offset = None
+        if cursor:
+            inode, offset = [int(v) for v in cursor.split(":")]
+            while files and files[0][1] != inode:
+                files.pop(0)
+        if levels:
+            levels = [l.upper() for l in levels]
+
+        records = []
+        for path, inode in files:
+            continuation = []
+            for line, line_offset in self.reverse_lines(path, offset):
+                record = self.parse_record(line)
+                if not record:
+                    if line:
+                        continuation.insert(0, line)
+                    continue
+                if continuation:
+                    record["message"] = "\n".join([record["message"]] + continuation)
+                    record["line"] = "\n".join([line] + continuation)
+                    continuation = []
+                if start or end:
+                    timestamp = self.get_timestamp(record)
+                    if timestamp is not None:
+                        if start and timestamp < start:
+                            return records, None
+                        if end and timestamp > end:
+                            continue
+                if levels and not record["level"] in levels:
+                    continue
+                if search and record["line"].find(search) == -1:
+                    continue
+                records.append(record)
+                if len(records) >= limit:
+                    if line_offset == 0 and path == files[-1][0]:
+                        return records, None
+                    return records, "%d:%d" % (inode, line_offset)
+            offset = None
+        return records, None
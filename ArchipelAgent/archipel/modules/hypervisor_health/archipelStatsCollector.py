@@ -16,41 +16,56 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sqlite3
-import datetime
+import os
 import commands
 import time
 from threading import Thread
 from archipel.utils import *
+from archipelStatsRingBuffer import *
+from archipelStatsRetention import *
+
+
+ARCHIPEL_HEALTH_CPU_COLUMNS     = ("date", "id")
+ARCHIPEL_HEALTH_MEMORY_COLUMNS  = ("date", "free", "used", "total", "swapped")
+ARCHIPEL_HEALTH_LOAD_COLUMNS    = ("date", "one", "five", "fifteen")
+ARCHIPEL_HEALTH_DISK_COLUMNS    = ("date", "total", "used", "free", "used_percentage")
+
 
 
 class TNThreadedHealthCollector(Thread):
     """
     this class collects hypervisor stats regularly
     """
-    def __init__(self, database_file, collection_interval, max_rows_before_purge, max_cached_rows):
+    def __init__(self, database_file, collection_interval, max_rows_before_purge, max_cached_rows, max_memory_rows=17280, retention_tiers=ARCHIPEL_HEALTH_DEFAULT_TIERS):
         """
         the contructor of the class
+        
+        @type max_rows_before_purge: int
+        @param max_rows_before_purge: the maximum number of raw samples in database
+        @type max_cached_rows: int
+        @param max_cached_rows: the number of samples collected before saving them into database
+        @type max_memory_rows: int
+        @param max_memory_rows: the number of samples kept in memory
+        @type retention_tiers: tuple
+        @param retention_tiers: the tiers of the database. see L{TNStatsRetention}
         """
         self.database_file          = database_file
         self.collection_interval    = collection_interval
         self.max_rows_before_purge  = max_rows_before_purge
         self.max_cached_rows        = max_cached_rows
-        self.stats_CPU              = []
-        self.stats_memory           = []
-        self.stats_load             = []
-        self.stats_disks            = []
+        self.max_memory_rows        = max(max_memory_rows, max_cached_rows)
+        self.stats_CPU              = TNStatsRingBuffer(ARCHIPEL_HEALTH_CPU_COLUMNS, self.max_memory_rows)
+        self.stats_memory           = TNStatsRingBuffer(ARCHIPEL_HEALTH_MEMORY_COLUMNS, self.max_memory_rows, ARCHIPEL_HEALTH_MEMORY_COLUMNS[1:])
+        self.stats_load             = TNStatsRingBuffer(ARCHIPEL_HEALTH_LOAD_COLUMNS, self.max_memory_rows)
+        self.stats_disks            = TNStatsRingBuffer(ARCHIPEL_HEALTH_DISK_COLUMNS, self.max_memory_rows, ARCHIPEL_HEALTH_DISK_COLUMNS[1:])
+        self.saved_count            = 0
+        self.last_cpu_times         = None
+        self.sample_callbacks       = []
         
         uname = commands.getoutput("uname -rsmo").split()
         self.uname_stats = {"krelease": uname[0] , "kname": uname[1] , "machine": uname[2], "os": uname[3]}
         
-        self.database_query_connection = sqlite3.connect(self.database_file)
-        self.cursor = self.database_query_connection.cursor()
-        
-        self.cursor.execute("create table if not exists cpu (collection_date date, idle int)")
-        self.cursor.execute("create table if not exists memory (collection_date date, free integer, used integer, total integer, swapped integer)")
-        self.cursor.execute("create table if not exists disk (collection_date date, total int, used int, free int, free_percentage int)")
-        self.cursor.execute("create table if not exists load (collection_date date, one float, five float, fifteen float)")
+        self.retention = TNStatsRetention(self.database_file, retention_tiers, max_rows_before_purge)
         log.info("Database ready.")
         
         self.recover_stored_stats()
@@ -58,28 +73,43 @@ class TNThreadedHealthCollector(Thread):
         Thread.__init__(self)
     
     
-    def recover_stored_stats(self):
-        log.info("recovering stored statistics. It may take a while...")
-        self.cursor.execute("select * from cpu order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, idle = values
-            self.stats_CPU.insert(0, {"date": date, "id": idle})
-        
-        self.cursor.execute("select * from memory order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, free, used, total, swapped = values
-            self.stats_memory.insert(0, {"date": date, "free": free, "used" : used, "total": total, "swapped": swapped})
+    def add_sample_callback(self, callback):
+        """
+        register a method called from the collector thread after each new sample
         
-        self.cursor.execute("select * from load order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, one, five, fifteen = values
-            self.stats_load.insert(0, {"date": date, "one": one, "five": five, "fifteen": fifteen})
+        @type callback: function
+        @param callback: the method to call, without argument
+        """
+        self.sample_callbacks.append(callback)
+    
+    
+    def recover_stored_stats(self):
+        log.info("recovering stored statistics...")
+        rows = self.retention.get_last_raw_samples(self.max_memory_rows)
+        self.stats_CPU.extend([row[0:2] for row in rows])
+        self.stats_memory.extend([row[0:1] + row[2:6] for row in rows])
+        self.stats_load.extend([row[0:1] + row[6:9] for row in rows])
+        self.stats_disks.extend([row[0:1] + row[9:13] for row in rows])
+        self.saved_count = self.stats_CPU.get_appended_count()
+        log.info("%d statistics recovered" % len(self.stats_CPU))
+    
+    
+    def get_history(self, start, end, resolution="auto", max_points=2000):
+        """
+        get the stored samples between two dates. see L{TNStatsRetention.query}
         
-        self.cursor.execute("select * from disk order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, total, used, free, free_percentage = values
-            self.stats_disks.insert(0, {"date": date, "total": total, "used": used, "free": free, "free_percentage": free_percentage})
-        log.info("statistics recovered")
+        @type start: float
+        @param start: the start timestamp
+        @type end: float
+        @param end: the end timestamp
+        @type resolution: string
+        @param resolution: the name or resolution of a tier, or "auto"
+        @type max_points: int
+        @param max_points: the maximum number of samples wanted when resolution is auto
+        @rtype: tuple
+        @return: the used tier and the samples, newest first
+        """
+        return self.retention.query(start, end, resolution, max_points, self.collection_interval)
     
     
     def get_collected_stats(self, limit=1):
@@ -90,113 +120,148 @@ class TNThreadedHealthCollector(Thread):
         """        
         log.debug("Retrieving last "+ str(limit) + " recorded stats data for sending")
         try:
-            uptime = commands.getoutput("uptime").split("up ")[1].split(",")[0]
-            uptime_stats = {"up" : uptime}
-            acpu    = self.stats_CPU[-limit:]
-            amem    = self.stats_memory[-limit:]
-            adisk   = self.stats_disks[-limit:]
-            aload   = self.stats_load[-limit:]
-            acpu.reverse()
-            amem.reverse()
-            adisk.reverse()
-            aload.reverse()
+            uptime_stats = {"up" : self.get_uptime()}
+            acpu    = self.stats_CPU.get_last(limit)
+            amem    = self.stats_memory.get_last(limit)
+            adisk   = self.stats_disks.get_last(limit)
+            aload   = self.stats_load.get_last(limit)
             return {"cpu": acpu, "memory": amem, "disk": adisk, "load": aload, "uptime": uptime_stats, "uname": self.uname_stats}
         except Exception as ex:
             log.error("stat recuperation fails. Exception %s" % str(ex))
             return None
     
     
+    def read_proc_file(self, path):
+        """
+        read a whole file of /proc
+        @type path: string
+        @param path: the path of the file
+        @rtype: string
+        @return: the content of the file
+        """
+        f = open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    
+    
+    def get_uptime(self):
+        """
+        @rtype: string
+        @return: the uptime of the host, formatted like the uptime command
+        """
+        seconds = int(float(self.read_proc_file("/proc/uptime").split()[0]))
+        days    = seconds / 86400
+        hours   = (seconds % 86400) / 3600
+        minutes = (seconds % 3600) / 60
+        if days: return "%d days" % days
+        return "%d:%02d" % (hours, minutes)
+    
+    
     def get_memory_stats(self):
-        file_meminfo    = open('/proc/meminfo')
-        meminfo         = file_meminfo.read()
-        file_meminfo.close()
+        meminfo = {}
+        for line in self.read_proc_file("/proc/meminfo").split("\n"):
+            tokens = line.split()
+            if len(tokens) >= 2:
+                meminfo[tokens[0].rstrip(":")] = int(tokens[1])
         
-        meminfolines    = meminfo.split("\n")
-        memTotal        = int(meminfolines[0].split()[1])
-        memFree         = int(meminfolines[1].split()[1])
-        swapped         = int(meminfolines[4].split()[1])
+        memTotal        = meminfo["MemTotal"]
+        memFree         = meminfo["MemFree"]
+        swapped         = meminfo.get("SwapCached", 0)
         memUsed         = memTotal - memFree
         
-        return {"date": datetime.datetime.now(), "free": memFree, "used" : memUsed, "total": memTotal, "swapped": swapped}
+        return {"date": time.time(), "free": memFree, "used" : memUsed, "total": memTotal, "swapped": swapped}
     
     
     def get_cpu_stats(self):
-        dt      = self.deltaTime(1)
-        cpuPct  = (dt[len(dt) - 1] * 100.00 / sum(dt))
-        return {"date": datetime.datetime.now(), "id": cpuPct}
+        """
+        compute the idle percentage since the previous sample. No need to wait
+        """
+        times = self.getTimeList()
+        if self.last_cpu_times:
+            dt = [times[i] - self.last_cpu_times[i] for i in range(len(times))]
+        else:
+            dt = times
+        self.last_cpu_times = times
+        if sum(dt) <= 0:
+            cpuPct = 100.0
+        else:
+            cpuPct = (dt[len(dt) - 1] * 100.00 / sum(dt))
+        return {"date": time.time(), "id": cpuPct}
     
     
     def get_load_stats(self):
-        load_average = commands.getoutput("uptime").split("load average:")[1].split(", ")
+        load_average = self.read_proc_file("/proc/loadavg").split()
         load1min, load5min, load15min = (float(load_average[0]), float(load_average[1]), float(load_average[2]))
-        return {"date": datetime.datetime.now(), "one": load1min, "five": load5min, "fifteen": load15min}
+        return {"date": time.time(), "one": load1min, "five": load5min, "fifteen": load15min}
     
     
     def get_disk_stats(self):
-        disk_free = commands.getoutput("df -h --total | grep total").split()
-        total, used, free, freePrct = (disk_free[1], disk_free[2],disk_free[3], disk_free[4])
-        return {"date": datetime.datetime.now(), "total" : total, "used": used, "free": free, "free_percentage": freePrct}
+        """
+        sum the size of all the mounted block devices, in bytes
+        """
+        total = 0
+        free = 0
+        seen_devices = {}
+        for line in self.read_proc_file("/proc/mounts").split("\n"):
+            tokens = line.split()
+            if len(tokens) < 2 or not tokens[0].startswith("/dev/") or seen_devices.has_key(tokens[0]):
+                continue
+            seen_devices[tokens[0]] = True
+            try:
+                st = os.statvfs(tokens[1].replace("\\040", " "))
+            except OSError:
+                continue
+            total += st.f_blocks * st.f_frsize
+            free += st.f_bavail * st.f_frsize
+        used = total - free
+        usedPrct = 0
+        if total: usedPrct = int(round(used * 100.0 / total))
+        return {"date": time.time(), "total" : total, "used": used, "free": free, "used_percentage": usedPrct}
     
     
     def getTimeList(self):
-        statFile = file("/proc/stat", "r")
-        timeList = statFile.readline().split(" ")[2:6]
-        statFile.close()
+        timeList = self.read_proc_file("/proc/stat").split("\n")[0].split()[1:5]
         for i in range(len(timeList)):
             timeList[i] = int(timeList[i])
         return timeList
     
     
-    def deltaTime(self, interval):
-        x = self.getTimeList()
-        time.sleep(interval)
-        y = self.getTimeList()
-        for i in range(len(x))  :
-            y[i] -= x[i]
-        return y
+    def save_stats(self):
+        """
+        write the samples that are not in the database yet
+        """
+        count = self.stats_CPU.get_appended_count() - self.saved_count
+        if count <= 0:
+            return
+        rows = zip(self.stats_CPU.get_last_rows(count), self.stats_memory.get_last_rows(count),
+                   self.stats_load.get_last_rows(count), self.stats_disks.get_last_rows(count))
+        rows.reverse()
+        self.retention.add_samples([cpu + memory[1:] + load[1:] + disk[1:] for cpu, memory, load, disk in rows])
+        self.saved_count += count
+        log.info("stats saved in database file")
     
     
     def run(self):
         """
         overiddes sur super class method. do the L{TNArchipelVirtualMachine} main loop
         """
-        self.database_thread_connection = sqlite3.connect(self.database_file)
-        
         while(1):
             try:
-                self.stats_CPU.append(self.get_cpu_stats())
-                self.stats_memory.append(self.get_memory_stats())
-                self.stats_load.append(self.get_load_stats())
-                self.stats_disks.append(self.get_disk_stats())
+                for buffer, stats in ((self.stats_CPU, self.get_cpu_stats()), (self.stats_memory, self.get_memory_stats()),
+                                      (self.stats_load, self.get_load_stats()), (self.stats_disks, self.get_disk_stats())):
+                    buffer.append([stats[column] for column in buffer.columns])
+                
+                for callback in self.sample_callbacks:
+                    try:
+                        callback()
+                    except Exception as ex:
+                        log.error("stat callback fails. Exception %s" % str(ex))
+                
+                if self.stats_CPU.get_appended_count() - self.saved_count >= max(1, (self.max_cached_rows - 1) / 2):
+                    self.save_stats()
                 
-                if len(self.stats_CPU) >= self.max_cached_rows:
-                    middle = (self.max_cached_rows - 1) /  2
-                    
-                    self.database_thread_connection.executemany("insert into memory values(:date, :free, :used, :total, :swapped)", self.stats_memory[0:middle])
-                    self.database_thread_connection.executemany("insert into cpu values(:date, :id)", self.stats_CPU[0:middle])
-                    self.database_thread_connection.executemany("insert into load values(:date, :one , :five, :fifteen)", self.stats_load[0:middle])
-                    self.database_thread_connection.executemany("insert into disk values(:date, :total, :used,:free, :free_percentage)", self.stats_disks[0:middle])
-                    log.info("stats saved in database file")
-                    
-                    del self.stats_CPU[0:middle]
-                    del self.stats_memory[0:middle]
-                    del self.stats_load[0:middle]
-                    del self.stats_disks[0:middle]
-                    log.info("cached stats have been purged from memory")
-                        
-                    if int(self.database_thread_connection.execute("select count(*) from memory").fetchone()[0]) >= self.max_rows_before_purge * 2:
-                        self.database_thread_connection.execute("delete from cpu where collection_date=(select collection_date from cpu order by collection_date asc limit "+ str(self.max_rows_before_purge) +")")
-                        self.database_thread_connection.execute("delete from memory where collection_date=(select collection_date from memory order by collection_date asc limit "+ str(self.max_rows_before_purge) +")")
-                        self.database_thread_connection.execute("delete from load where collection_date=(select collection_date from load order by collection_date asc limit "+ str(self.max_rows_before_purge) +")")
-                        self.database_thread_connection.execute("delete from disk where collection_date=(select collection_date from disk order by collection_date asc limit "+ str(self.max_rows_before_purge) +")")
-                        log.debug("old stored stats have been purged from memory")
-                        
-                    self.database_thread_connection.commit()
-                    
                 time.sleep(self.collection_interval)
             except Exception as ex:
                 log.error("stat collection fails. Exception %s" % str(ex))
-    
-
-
-
@@ -0,0 +1,241 @@
+# archipelstatcollector
+#
+# archipelStatsRetention.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import sqlite3
+import threading
+from archipel.utils import *
+
+
+# the metrics stored for each sample, in order
+ARCHIPEL_HEALTH_METRICS = ("cpu_idle", "memory_free", "memory_used", "memory_total", "memory_swapped",
+                           "load_one", "load_five", "load_fifteen",
+                           "disk_total", "disk_used", "disk_free", "disk_used_percentage")
+
+# the default tiers: (name, resolution in seconds, retention in seconds).
+# the first one stores raw samples, the others store min/avg/max rollups
+ARCHIPEL_HEALTH_DEFAULT_TIERS = (("raw", 0, 86400),
+                                 ("minute", 60, 604800),
+                                 ("quarter", 900, 2678400),
+                                 ("hour", 3600, 31536000))
+
+
+class TNStatsRetention:
+    """
+    this class stores the host samples in several tiers, like RRD does. Raw
+    samples are kept for a short time, and are rolled up into tiers of lower
+    resolution that keep the min, average and max of each metric. Each tier
+    has a bounded number of rows and is indexed on time.
+    """
+    def __init__(self, database_file, tiers=ARCHIPEL_HEALTH_DEFAULT_TIERS, max_raw_rows=0):
+        """
+        the contructor of the class
+
+        @type database_file: string
+        @param database_file: the sqlite3 file
+        @type tiers: tuple
+        @param tiers: tuples (name, resolution, retention). the first tier must have a resolution of 0
+        @type max_raw_rows: int
+        @param max_raw_rows: the maximum number of raw samples. 0 means no limit besides retention
+        """
+        self.database_file  = database_file
+        self.tiers          = tiers
+        self.max_raw_rows   = max_raw_rows
+        self.lock           = threading.Lock()
+        self.database       = sqlite3.connect(self.database_file, check_same_thread=False)
+
+        for name, resolution, retention in self.tiers:
+            if resolution == 0:
+                columns = ", ".join(["%s real" % m for m in ARCHIPEL_HEALTH_METRICS])
+            else:
+                columns = ", ".join(["%s_min real, %s_avg real, %s_max real" % (m, m, m) for m in ARCHIPEL_HEALTH_METRICS])
+            self.database.execute("create table if not exists health_%s (date real, %s)" % (name, columns))
+            self.database.execute("create unique index if not exists health_%s_date on health_%s (date)" % (name, name))
+        self.database.commit()
+        self.import_legacy_tables()
+
+
+    def import_legacy_tables(self):
+        """
+        move the samples of the old cpu, memory, load and disk tables into the raw tier.
+        They are rolled up at the next save, and the old tables are dropped
+        """
+        tables = [row[0] for row in self.database.execute("select name from sqlite_master where type='table'")]
+        if not "cpu" in tables or not "memory" in tables or not "load" in tables or not "disk" in tables:
+            return
+        log.info("HEALTH: importing statistics of the old tables. It may take a while...")
+        # old dates are local time strings. julianday reads them as UTC.
+        # each sample was written in the four tables at once, with slightly
+        # different dates, so the rows are matched by rowid
+        offset = time.timezone
+        if time.daylight and time.localtime().tm_isdst: offset = time.altzone
+        def number(column):
+            return "case when typeof(%s) in ('integer', 'real') then %s else 0 end" % (column, column)
+        self.database.execute("""insert or ignore into health_%s select
+                                    (julianday(c.collection_date) - 2440587.5) * 86400.0 + %d,
+                                    c.idle, m.free, m.used, m.total, m.swapped, l.one, l.five, l.fifteen,
+                                    %s, %s, %s, %s
+                                 from cpu c join memory m on m.rowid = c.rowid
+                                            join load l on l.rowid = c.rowid
+                                            join disk d on d.rowid = c.rowid""" % (self.tiers[0][0], offset,
+                                    number("d.total"), number("d.used"), number("d.free"), number("d.free_percentage")))
+        for table in ("cpu", "memory", "load", "disk"):
+            self.database.execute("drop table %s" % table)
+        self.database.commit()
+        log.info("HEALTH: old statistics imported")
+
+
+    def add_samples(self, rows):
+        """
+        store new raw samples, update the rollups and purge old data
+
+        @type rows: list
+        @param rows: list of tuples (date, metrics of ARCHIPEL_HEALTH_METRICS...)
+        """
+        self.lock.acquire()
+        try:
+            self.database.executemany("insert or replace into health_%s values(%s)" % (self.tiers[0][0], ",".join(["?"] * (len(ARCHIPEL_HEALTH_METRICS) + 1))), rows)
+            now = time.time()
+            self.rollup(now)
+            self.purge(now)
+            self.database.commit()
+        finally:
+            self.lock.release()
+
+
+    def rollup(self, now):
+        """
+        aggregate the complete buckets of each tier from the tier above. A bucket
+        is complete when the tier above has data after its end
+        """
+        for i in range(1, len(self.tiers)):
+            source, source_resolution, source_retention = self.tiers[i - 1]
+            name, resolution, retention = self.tiers[i]
+            first, source_last = self.database.execute("select min(date), max(date) from health_%s" % source).fetchone()
+            if source_last is None:
+                continue
+            last = self.database.execute("select max(date) from health_%s" % name).fetchone()[0]
+            if last is None:
+                start = int(first / resolution) * resolution
+            else:
+                start = last + resolution
+            end = int((source_last + source_resolution) / resolution) * resolution
+            if start >= end:
+                continue
+            if source_resolution == 0:
+                aggregates = ", ".join(["min(%s), avg(%s), max(%s)" % (m, m, m) for m in ARCHIPEL_HEALTH_METRICS])
+            else:
+                aggregates = ", ".join(["min(%s_min), avg(%s_avg), max(%s_max)" % (m, m, m) for m in ARCHIPEL_HEALTH_METRICS])
+            self.database.execute("insert or ignore into health_%s select cast(date / %d as integer) * %d as bucket, %s from health_%s where date >= ? and date < ? group by bucket" % (name, resolution, resolution, aggregates, source), (start, end))
+
+
+    def purge(self, now):
+        """
+        remove the data older than the retention of each tier
+        """
+        for name, resolution, retention in self.tiers:
+            self.database.execute("delete from health_%s where date < ?" % name, (now - retention,))
+        if self.max_raw_rows > 0:
+            name = self.tiers[0][0]
+            limit = self.database.execute("select date from health_%s order by date desc limit 1 offset %d" % (name, self.max_raw_rows)).fetchone()
+            if limit:
+                self.database.execute("delete from health_%s where date <= ?" % name, (limit[0],))
+
+
+    def get_last_raw_samples(self, limit):
+        """
+        @type limit: int
+        @param limit: the maximum number of samples
+        @rtype: list
+        @return: the last raw samples as tuples, oldest first
+        """
+        self.lock.acquire()
+        try:
+            rows = self.database.execute("select * from health_%s order by date desc limit %d" % (self.tiers[0][0], limit)).fetchall()
+        finally:
+            self.lock.release()
+        rows.reverse()
+        return rows
+
+
+    def choose_tier(self, start, end, max_points, collection_interval):
+        """
+        choose the most precise tier that still covers start and doesn't return more than max_points
+
+        @rtype: tuple
+        @return: the tier (name, resolution, retention)
+        """
+        now = time.time()
+        for tier in self.tiers:
+            name, resolution, retention = tier
+            if start < now - retention:
+                continue
+            if (end - start) / float(max(resolution, collection_interval, 1)) <= max_points:
+                return tier
+        return self.tiers[-1]
+
+
+    def query(self, start, end, resolution="auto", max_points=2000, collection_interval=1):
+        """
+        return the samples between start and end
+
+        @type start: float
+        @param start: the start timestamp
+        @type end: float
+        @param end: the end timestamp
+        @type resolution: string
+        @param resolution: the name of a tier, its resolution in seconds, or "auto"
+        @type max_points: int
+        @param max_points: the maximum number of samples wanted when resolution is auto
+        @type collection_interval: float
+        @param collection_interval: the interval of raw samples
+        @rtype: tuple
+        @return: the used tier and the list of dict samples, newest first. rollups samples
+                 contain the average in the metric key, and the min and max in metric_min and metric_max
+        """
+        tier = None
+        if resolution in (None, "", "auto"):
+            tier = self.choose_tier(start, end, max_points, collection_interval)
+        else:
+            for t in self.tiers:
+                if t[0] == resolution or str(t[1]) == str(resolution):
+                    tier = t
+            if not tier:
+                raise Exception("unknown resolution %s" % resolution)
+        name, tier_resolution, retention = tier
+
+        self.lock.acquire()
+        try:
+            rows = self.database.execute("select * from health_%s where date >= ? and date <= ? order by date desc" % name, (start, end)).fetchall()
+        finally:
+            self.lock.release()
+
+        samples = []
+        for row in rows:
+            sample = {"date": row[0]}
+            if tier_resolution == 0:
+                for i in range(len(ARCHIPEL_HEALTH_METRICS)):
+                    sample[ARCHIPEL_HEALTH_METRICS[i]] = row[i + 1]
+            else:
+                for i in range(len(ARCHIPEL_HEALTH_METRICS)):
+                    metric = ARCHIPEL_HEALTH_METRICS[i]
+                    sample[metric + "_min"] = row[i * 3 + 1]
+                    sample[metric] = row[i * 3 + 2]
+                    sample[metric + "_max"] = row[i * 3 + 3]
+            samples.append(sample)
+        return tier, samples
@@ -0,0 +1,140 @@
+# archipelstatcollector
+#
+# archipelStatsRingBuffer.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import threading
+
+
+class TNStatsRingBuffer:
+    """
+    this class is a fixed capacity ring buffer of samples. Each column is
+    stored in its own array of doubles, so the memory used is known in advance.
+    Appending is O(1) and reading the k last samples is O(k).
+    """
+    def __init__(self, columns, capacity, integer_columns=()):
+        """
+        the contructor of the class
+
+        @type columns: tuple
+        @param columns: the names of the columns. the first one is the timestamp
+        @type capacity: int
+        @param capacity: the maximum number of samples
+        @type integer_columns: tuple
+        @param integer_columns: the names of the columns returned as integers by get_last
+        """
+        self.columns    = tuple(columns)
+        self.integers   = [c in integer_columns for c in self.columns]
+        self.capacity   = max(1, capacity)
+        self.lock       = threading.Lock()
+        self.data       = [array.array("d", [0.0]) * self.capacity for c in self.columns]
+        self.position   = 0
+        self.count      = 0
+        self.appended   = 0
+
+
+    def __len__(self):
+        return self.count
+
+
+    def append(self, values):
+        """
+        add a sample. the oldest one is dropped if the buffer is full
+
+        @type values: tuple
+        @param values: the values of the sample, in the order of the columns
+        """
+        self.lock.acquire()
+        try:
+            position = self.position
+            for i in range(len(self.columns)):
+                self.data[i][position] = values[i]
+            self.position = (position + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            self.appended += 1
+        finally:
+            self.lock.release()
+
+
+    def extend(self, rows):
+        """
+        add several samples, oldest first
+
+        @type rows: list
+        @param rows: list of tuples
+        """
+        appended = len(rows)
+        rows = rows[-self.capacity:]
+        if not rows:
+            return
+        columns = zip(*rows)
+        self.lock.acquire()
+        try:
+            for i in range(len(self.columns)):
+                column = self.data[i]
+                position = self.position
+                for value in columns[i]:
+                    column[position] = value
+                    position += 1
+                    if position == self.capacity: position = 0
+            self.position = (self.position + len(rows)) % self.capacity
+            self.count = min(self.capacity, self.count + len(rows))
+            self.appended += appended
+        finally:
+            self.lock.release()
+
+
+    def get_last_rows(self, limit=1):
+        """
+        @type limit: int
+        @param limit: the maximum number of samples
+        @rtype: list
+        @return: the last samples as tuples, newest first
+        """
+        self.lock.acquire()
+        try:
+            limit = max(0, min(limit, self.count))
+            indexes = [(self.position - 1 - i) % self.capacity for i in range(limit)]
+            columns = []
+            for i in range(len(self.columns)):
+                column = self.data[i]
+                if self.integers[i]:
+                    columns.append([long(column[j]) for j in indexes])
+                else:
+                    columns.append([column[j] for j in indexes])
+        finally:
+            self.lock.release()
+        return zip(*columns)
+
+
+    def get_last(self, limit=1):
+        """
+        @type limit: int
+        @param limit: the maximum number of samples
+        @rtype: list
+        @return: the last samples as dicts, newest first
+        """
+        return [dict(zip(self.columns, row)) for row in self.get_last_rows(limit)]
+
+
+    def get_appended_count(self):
+        """
+        @rtype: int
+        @return: the total number of samples appended since the creation of the buffer
+        """
+        return self.appended
@@ -19,33 +19,87 @@
 # we need to import the package containing the class to surclass
 from archipel.utils import *
 import archipel.core
-import commands
+import archipel.core.pubsub
+from archipel.core.archipelMetrics import metrics
+from archipel.core.archipelIQStats import iqstats
 import xmpp
 import os
+import time
 import traceback
 from archipelStatsCollector import *
+from archipelDomainStatsCollector import *
+from archipelStatsRetention import *
+from archipelLogReader import *
 
 ARCHIPEL_ERROR_CODE_HEALTH_HISTORY  = -8001
 ARCHIPEL_ERROR_CODE_HEALTH_INFO     = -8002
 ARCHIPEL_ERROR_CODE_HEALTH_LOG      = -8003
+ARCHIPEL_ERROR_CODE_HEALTH_TOP      = -8004
+ARCHIPEL_ERROR_CODE_HEALTH_IQSTATS  = -8005
+
+# the XML node and attribute of each stored metric
+ARCHIPEL_HEALTH_METRICS_NODES = {   "cpu_idle": ("cpu", "id"),
+                                    "memory_free": ("memory", "free"),
+                                    "memory_used": ("memory", "used"),
+                                    "memory_total": ("memory", "total"),
+                                    "memory_swapped": ("memory", "swapped"),
+                                    "load_one": ("load", "one"),
+                                    "load_five": ("load", "five"),
+                                    "load_fifteen": ("load", "fifteen"),
+                                    "disk_total": ("disk", "total"),
+                                    "disk_used": ("disk", "used"),
+                                    "disk_free": ("disk", "free"),
+                                    "disk_used_percentage": ("disk", "used-percentage")}
+
+# the pubsub node where the samples are published
+ARCHIPEL_HEALTH_PUBSUB_NODE = "/archipel/%s/health"
 
 class TNHypervisorHealth:
     
-    def __init__(self, entity, db_file,collection_interval, max_rows_before_purge, max_cached_rows, log_file):
+    def __init__(self, entity, db_file,collection_interval, max_rows_before_purge, max_cached_rows, log_file, vm_collection_interval=5, vm_max_samples=720, max_memory_rows=17280, retention_tiers=ARCHIPEL_HEALTH_DEFAULT_TIERS, publish_batch=1, pubsub_max_items=10, log_date_format="%Y-%m-%d %H:%M:%S"):
         """
         initialize the module
         @type entity TNArchipelEntity
         @param entity the module entity
+        @type vm_collection_interval float
+        @param vm_collection_interval the interval between two samples of the virtual machines. 0 disables it
+        @type vm_max_samples int
+        @param vm_max_samples the number of samples kept for each virtual machine
+        @type max_memory_rows int
+        @param max_memory_rows the number of host samples kept in memory
+        @type retention_tiers tuple
+        @param retention_tiers the retention tiers of the database
+        @type publish_batch int
+        @param publish_batch the number of samples in each item published in the health pubsub node. 0 disables it
+        @type pubsub_max_items int
+        @param pubsub_max_items the number of items kept by the health pubsub node
+        @type log_date_format string
+        @param log_date_format the date format of the log file
         """
-        self.collector = TNThreadedHealthCollector(db_file,collection_interval, max_rows_before_purge, max_cached_rows)
+        self.collector = TNThreadedHealthCollector(db_file,collection_interval, max_rows_before_purge, max_cached_rows, max_memory_rows, retention_tiers)
         self.logfile = log_file
-        self.collector.start()
+        self.logreader = TNLogReader(log_file, log_date_format)
         self.entity = entity
         
+        self.publish_batch      = publish_batch
+        self.pubsub_max_items   = pubsub_max_items
+        self.pubsub_node        = None
+        self.unpublished_count  = 0
+        if self.publish_batch > 0:
+            self.collector.add_sample_callback(self.on_collected_sample)
+        self.collector.start()
+        
+        self.domain_collector = None
+        if vm_collection_interval > 0:
+            self.domain_collector = TNThreadedDomainStatsCollector(entity, vm_collection_interval, vm_max_samples)
+            self.domain_collector.start()
+        
         # permissions
         self.entity.permission_center.create_permission("health_history", "Authorizes user to get the health history", False)
         self.entity.permission_center.create_permission("health_info", "Authorizes user to get entity information", False)
         self.entity.permission_center.create_permission("health_logs", "Authorizes user to get entity logs", False)
+        self.entity.permission_center.create_permission("health_top", "Authorizes user to get the most loaded virtual machines", False)
+        self.entity.permission_center.create_permission("health_iqstats", "Authorizes user to get the IQ processing statistics", False)
         
         registrar_items = [
                             {   "commands" : ["health"], 
@@ -61,6 +115,111 @@ class TNHypervisorHealth:
                             ]
         
         self.entity.add_message_registrar_items(registrar_items)
+        
+        metrics.add_collector(self.collect_metrics)
+    
+    
+    
+    ### Metrics
+    
+    def collect_metrics(self):
+        """
+        metrics collector of the health module. It reads the last samples
+        kept in memory by the collectors
+        
+        @rtype: list
+        @return: the metric families
+        """
+        families = []
+        cpu = self.collector.stats_CPU.get_last(1)
+        memory = self.collector.stats_memory.get_last(1)
+        load = self.collector.stats_load.get_last(1)
+        disk = self.collector.stats_disks.get_last(1)
+        if cpu and memory and load and disk:
+            families.extend([("archipel_host_cpu_idle_percent", "gauge", "Idle CPU of the host", [({}, cpu[0]["id"])]),
+                             ("archipel_host_memory_bytes", "gauge", "Memory of the host",
+                                [({"state": key}, memory[0][key] * 1024) for key in ("free", "used", "total", "swapped")]),
+                             ("archipel_host_load", "gauge", "Load average of the host",
+                                [({"period": key}, load[0][key]) for key in ("one", "five", "fifteen")]),
+                             ("archipel_host_disk_bytes", "gauge", "Local disks of the host",
+                                [({"state": key}, disk[0][key]) for key in ("total", "used", "free")])])
+        if self.domain_collector:
+            columns = ARCHIPEL_DOMAIN_STATS_COLUMNS[1:]
+            samples = dict([(column, []) for column in columns])
+            for uuid in self.domain_collector.samples.keys():
+                stats = self.domain_collector.get_domain_stats(uuid, 1)
+                if not stats:
+                    continue
+                for column in columns:
+                    samples[column].append(({"uuid": uuid}, stats[0][column]))
+            for column in columns:
+                families.append(("archipel_domain_%s" % column, "gauge", "Last %s value of the domains" % column.replace("_", " "), samples[column]))
+        return families
+    
+    
+    
+    ### Pubsub
+    
+    def get_pubsub_node(self):
+        """
+        get the health pubsub node, and create and configure it if needed, without
+        waiting. The node is recovered again when the entity reconnects with a new XMPP client
+        
+        @rtype: L{archipel.core.pubsub.TNPubSubNode}
+        @return: the health pubsub node
+        """
+        if self.pubsub_node and self.pubsub_node.xmppclient is self.entity.xmppclient:
+            return self.pubsub_node
+        nodename = ARCHIPEL_HEALTH_PUBSUB_NODE % self.entity.jid.getStripped()
+        node = archipel.core.pubsub.TNPubSubNode(self.entity.xmppclient, self.entity.pubsubserver, nodename)
+        node.ensure({
+            archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipel.core.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
+            archipel.core.pubsub.XMPP_PUBSUB_VAR_DELIVER_NOTIFICATION: 1,
+            archipel.core.pubsub.XMPP_PUBSUB_VAR_MAX_ITEMS: self.pubsub_max_items,
+            archipel.core.pubsub.XMPP_PUBSUB_VAR_PERSIST_ITEMS: 1,
+            archipel.core.pubsub.XMPP_PUBSUB_VAR_NOTIFY_RECTRACT: 0,
+            archipel.core.pubsub.XMPP_PUBSUB_VAR_DELIVER_PAYLOADS: 1,
+            archipel.core.pubsub.XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM: archipel.core.pubsub.XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM_ON_SUB
+        })
+        self.pubsub_node = node
+        return node
+    
+    
+    def on_collected_sample(self):
+        """
+        called by the collector thread after each sample. When publish_batch samples
+        are waiting, their publication is scheduled in the thread of the entity
+        """
+        self.unpublished_count += 1
+        if self.unpublished_count < self.publish_batch:
+            return
+        count = self.unpublished_count
+        self.unpublished_count = 0
+        if self.entity.reactor:
+            self.entity.reactor.call_later(0, self.publish_stats, count)
+        else:
+            self.publish_stats(count)
+    
+    
+    def publish_stats(self, count):
+        """
+        publish the last samples in the health pubsub node. One item is
+        sent to all the subscribers, whatever their number
+        
+        @type count: int
+        @param count: the number of samples to publish
+        """
+        if not self.entity.isAuth:
+            return
+        try:
+            node = self.get_pubsub_node()
+            stats = self.collector.get_collected_stats(count)
+            healthNode = xmpp.Node("health", attrs={"date": "%.3f" % time.time()})
+            for i in range(len(stats["cpu"])):
+                healthNode.addChild(node=self.build_stat_node(stats, i))
+            node.add_item(healthNode)
+        except Exception as ex:
+            log.error("HEALTH: unable to publish statistics: %s" % str(ex))
     
     
     
@@ -82,9 +241,11 @@ class TNHypervisorHealth:
         action = self.entity.check_acp(conn, iq)
         self.entity.check_perm(conn, iq, action, -1, prefix="health_")
         
-        if action == "history": reply = self.iq_health_info_history(iq)
+        if action == "history": reply = self.entity.defer_iq(conn, iq, self.iq_health_info_history, ordered=False)
         elif action == "info":  reply = self.iq_health_info(iq)
-        elif action == "logs":  reply = self.iq_get_logs(iq)
+        elif action == "logs":  reply = self.entity.defer_iq(conn, iq, self.iq_get_logs, ordered=False)
+        elif action == "top":   reply = self.iq_health_top(iq)
+        elif action == "iqstats": reply = self.iq_health_iqstats(iq)
         
         if reply:
             conn.send(reply)
@@ -92,15 +253,38 @@ class TNHypervisorHealth:
     
     
     
+    def build_stat_node(self, stats, i):
+        """
+        build the XML node of a collected sample
+        
+        @type stats: dict
+        @param stats: the stats returned by get_collected_stats
+        @type i: int
+        @param i: the index of the sample
+        @rtype: xmpp.Node
+        @return: the stat node
+        """
+        statNode = xmpp.Node("stat", attrs={"date": "%.3f" % stats["cpu"][i]["date"]})
+        statNode.addChild("memory", attrs={"free" : stats["memory"][i]["free"], "used": stats["memory"][i]["used"], "total": stats["memory"][i]["total"], "swapped": stats["memory"][i]["swapped"]} )
+        statNode.addChild("cpu", attrs={"id": stats["cpu"][i]["id"]})
+        statNode.addChild("disk", attrs={"total" : stats["disk"][i]["total"], "used":  stats["disk"][i]["used"], "free":  stats["disk"][i]["free"], "used-percentage": "%d%%" % stats["disk"][i]["used_percentage"]})
+        statNode.addChild("load", attrs={"one" : stats["load"][i]["one"], "five":  stats["load"][i]["five"], "fifteen":  stats["load"][i]["fifteen"]})
+        return statNode
+    
+    
     def iq_health_info_history(self, iq):
         """
-        get a range of old stat history according to the limit parameters in iq node
+        get a range of old stat history according to the limit parameters in iq node.
+        if the node has a "from" or a "to" parameter, the stored history is used instead
         
         @type iq: xmpp.Protocol.Iq
         @param iq: the sender request IQ
         @rtype: xmpp.Protocol.Iq
         @return: a ready-to-send IQ containing the results        
         """
+        query = iq.getTag("query").getTag("archipel")
+        if query.getAttr("from") or query.getAttr("to"):
+            return self.iq_health_info_range(iq)
         try:
             reply = iq.buildReply("result")
             self.entity.log.debug("converting stats into XML node")
@@ -114,12 +298,7 @@ class TNHypervisorHealth:
                 number_of_rows = len(stats["memory"])
             
             for i in range(number_of_rows):
-                statNode = xmpp.Node("stat")
-                statNode.addChild("memory", attrs={"free" : stats["memory"][i]["free"], "used": stats["memory"][i]["used"], "total": stats["memory"][i]["total"], "swapped": stats["memory"][i]["swapped"]} )
-                statNode.addChild("cpu", attrs={"id": stats["cpu"][i]["id"]})
-                statNode.addChild("disk", attrs={"total" : stats["disk"][i]["total"], "used":  stats["disk"][i]["used"], "free":  stats["disk"][i]["free"], "used-percentage":  stats["disk"][i]["free_percentage"]})
-                statNode.addChild("load", attrs={"one" : stats["load"][i]["one"], "five":  stats["load"][i]["five"], "fifteen":  stats["load"][i]["fifteen"]})
-                nodes.append(statNode)
+                nodes.append(self.build_stat_node(stats, i))
             
             reply.setQueryPayload(nodes)
         except Exception as ex:
@@ -128,6 +307,48 @@ class TNHypervisorHealth:
     
     
     
+    def iq_health_info_range(self, iq):
+        """
+        get the stored stat history between the "from" and "to" timestamps of the iq node.
+        The "resolution" parameter can be the name of a tier (raw, minute, quarter, hour),
+        its resolution in seconds, or "auto" (default). With auto, the most precise tier
+        returning at most "maxpoints" samples is used. Rollups samples contain the
+        average values, and the min and max values in "min-" and "max-" prefixed attributes
+        
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results        
+        """
+        try:
+            reply       = iq.buildReply("result")
+            query       = iq.getTag("query").getTag("archipel")
+            end         = float(query.getAttr("to") or time.time())
+            start       = float(query.getAttr("from") or 0)
+            resolution  = query.getAttr("resolution") or "auto"
+            max_points  = int(query.getAttr("maxpoints") or 2000)
+            
+            tier, stats = self.collector.get_history(start, end, resolution, max_points)
+            name, tier_resolution, retention = tier
+            nodes = []
+            for stat in stats:
+                statNode = xmpp.Node("stat", attrs={"date": "%.3f" % stat["date"], "resolution": name})
+                children = {}
+                for metric in ARCHIPEL_HEALTH_METRICS:
+                    tag, attr = ARCHIPEL_HEALTH_METRICS_NODES[metric]
+                    if not children.has_key(tag):
+                        children[tag] = statNode.addChild(tag)
+                    children[tag].setAttr(attr, stat[metric])
+                    if tier_resolution > 0:
+                        children[tag].setAttr("min-" + attr, stat[metric + "_min"])
+                        children[tag].setAttr("max-" + attr, stat[metric + "_max"])
+                nodes.append(statNode)
+            reply.setQueryPayload(nodes)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_HISTORY)
+        return reply
+    
+    
     def iq_health_info(self, iq):
         """
         send information about the hypervisor health info
@@ -153,7 +374,7 @@ class TNHypervisorHealth:
                 cpu_node = xmpp.Node("cpu", attrs={"id": stats["cpu"][0]["id"]})
                 nodes.append(cpu_node)
                 
-                disk_free_node = xmpp.Node("disk", attrs={"total" : stats["disk"][0]["total"], "used":  stats["disk"][0]["used"], "free":  stats["disk"][0]["free"], "used-percentage":  stats["disk"][0]["free_percentage"]})
+                disk_free_node = xmpp.Node("disk", attrs={"total" : stats["disk"][0]["total"], "used":  stats["disk"][0]["used"], "free":  stats["disk"][0]["free"], "used-percentage": "%d%%" % stats["disk"][0]["used_percentage"]})
                 nodes.append(disk_free_node)
                 
                 load_node = xmpp.Node("load", attrs={"one" : stats["load"][0]["one"], "five" : stats["load"][0]["five"], "fifteen" : stats["load"][0]["fifteen"]})
@@ -171,6 +392,55 @@ class TNHypervisorHealth:
         return reply
     
     
+    def iq_health_top(self, iq):
+        """
+        send the virtual machines with the highest last value of the column given
+        in the "column" parameter of the iq node (cpu by default)
+        
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results        
+        """
+        try:
+            if not self.domain_collector:
+                raise Exception("virtual machines statistics collection is disabled")
+            reply   = iq.buildReply("result")
+            query   = iq.getTag("query").getTag("archipel")
+            column  = query.getAttr("column") or "cpu"
+            limit   = int(query.getAttr("limit") or 10)
+            if not column in ARCHIPEL_DOMAIN_STATS_COLUMNS[1:]:
+                raise Exception("unknown column %s" % column)
+            nodes = []
+            for uuid, value in self.domain_collector.get_top_domains(column, limit):
+                attrs = {"uuid": uuid, "value": "%.2f" % value}
+                if self.entity.virtualmachines.has_key(uuid):
+                    attrs["jid"] = self.entity.virtualmachines[uuid].jid.getStripped()
+                nodes.append(xmpp.Node("domain", attrs=attrs))
+            reply.setQueryPayload(nodes)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_TOP)
+        return reply
+    
+    
+    def iq_health_iqstats(self, iq):
+        """
+        send the count, errors and latency of the IQs processed by the agent,
+        for each namespace and action, the slowest first
+        
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results        
+        """
+        try:
+            reply = iq.buildReply("result")
+            reply.setQueryPayload(iqstats.get_stats_nodes())
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_IQSTATS)
+        return reply
+    
+    
     def message_health_info(self, msg):
         """
         handle the health info request message
@@ -189,7 +459,10 @@ class TNHypervisorHealth:
     
     def iq_get_logs(self, iq):
         """
-        read the hypervisor's log file
+        read the last records of the hypervisor's log file, oldest first like the
+        output of tail used to be. The iq node can contain the parameters "limit", "levels" (comma separated), "from" and "to" (timestamps)
+        and "search". If there are older records, the reply query has a "cursor" attribute
+        that can be sent back to get the previous page
         
         @type iq: xmpp.Protocol.Iq
         @param iq: the sender request IQ
@@ -198,17 +471,29 @@ class TNHypervisorHealth:
         """
         
         try:
-            reply = iq.buildReply("result")
-            limit = int(iq.getTag("query").getTag("archipel").getAttr("limit"))
-            output = commands.getoutput("tail -n %d %s" % (limit, self.logfile))
+            reply   = iq.buildReply("result")
+            query   = iq.getTag("query").getTag("archipel")
+            limit   = int(query.getAttr("limit") or 1)
+            levels  = None
+            start   = None
+            end     = None
+            if query.getAttr("levels"):
+                levels = query.getAttr("levels").split(",")
+            if query.getAttr("from"):
+                start = float(query.getAttr("from"))
+            if query.getAttr("to"):
+                end = float(query.getAttr("to"))
+            records, cursor = self.logreader.read(limit, levels, start, end, query.getAttr("search"), query.getAttr("cursor"))
+            records.reverse()
             nodes = []
-            for line in output.split("\n"):
-                infos = line.split("::")
-                log_node = xmpp.Node("log", attrs={"level": infos[0], "date": infos[1], "file": "", "method": ""})
-                log_node.setData(line)
+            for record in records:
+                log_node = xmpp.Node("log", attrs={"level": record["level"], "date": record["date"], "file": record["file"], "method": ""})
+                log_node.setData(record["line"])
                 nodes.append(log_node)
-                
+            
             reply.setQueryPayload(nodes)
+            if cursor:
+                reply.getTag("query").setAttr("cursor", cursor)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_LOG)
         return reply
@@ -223,8 +508,9 @@ class TNHypervisorHealth:
             if len(tokens) == 1 :   limit = 1
             elif len(tokens) == 2 : limit = int(tokens[1])
             else: return "I'm sorry, you use a wrong format. You can type 'help' to get help"
-            output = commands.getoutput("tail -n %d %s" % (limit, self.logfile))
-            return output
+            records, cursor = self.logreader.read(limit)
+            records.reverse()
+            return "\n".join([record["line"] for record in records])
         except Exception as ex:
             return build_error_message(self, ex)
     
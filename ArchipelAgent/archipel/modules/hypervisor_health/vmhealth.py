@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# vmhealth.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from archipel.utils import *
+import xmpp
+from archipelDomainStatsCollector import *
+
+ARCHIPEL_ERROR_CODE_VM_HEALTH_HISTORY   = -8101
+ARCHIPEL_ERROR_CODE_VM_HEALTH_INFO      = -8102
+
+class TNVirtualMachineHealth:
+
+    def __init__(self, entity):
+        """
+        initialize the module
+        @type entity TNArchipelVirtualMachine
+        @param entity the module entity
+        """
+        self.entity = entity
+
+        # permissions
+        self.entity.permission_center.create_permission("health_history", "Authorizes user to get the health history of the virtual machine", False)
+        self.entity.permission_center.create_permission("health_info", "Authorizes user to get the current health of the virtual machine", False)
+
+
+    def get_collector(self):
+        """
+        @rtype: L{TNThreadedDomainStatsCollector}
+        @return: the domain stats collector of the hypervisor
+        """
+        module = getattr(self.entity.hypervisor, "module_health", None)
+        if not module or not module.domain_collector:
+            raise Exception("virtual machines statistics collection is disabled")
+        return module.domain_collector
+
+
+
+    ### XMPP Processing
+
+    def process_iq(self, conn, iq):
+        """
+        this method is invoked when a ARCHIPEL_NS_VM_HEALTH IQ is received.
+
+        it understands IQ of type:
+            - info
+            - history
+
+        @type conn: xmpp.Dispatcher
+        @param conn: ths instance of the current connection that send the stanza
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        """
+        action = self.entity.check_acp(conn, iq)
+        self.entity.check_perm(conn, iq, action, -1, prefix="health_")
+
+        if action == "history": reply = self.iq_health_info_history(iq)
+        elif action == "info":  reply = self.iq_health_info(iq)
+
+        if reply:
+            conn.send(reply)
+            raise xmpp.protocol.NodeProcessed
+
+
+    def build_stat_node(self, stat):
+        """
+        build the XML node of a sample
+
+        @type stat: dict
+        @param stat: the sample
+        @rtype: xmpp.Node
+        @return: the stat node
+        """
+        statNode = xmpp.Node("stat", attrs={"date": "%.3f" % stat["date"]})
+        statNode.addChild("cpu", attrs={"usage": "%.2f" % stat["cpu"]})
+        statNode.addChild("memory", attrs={"used": "%d" % stat["memory"]})
+        statNode.addChild("disk", attrs={"read": "%d" % stat["disk_read"], "write": "%d" % stat["disk_write"],
+                                        "read-iops": "%.2f" % stat["disk_read_iops"], "write-iops": "%.2f" % stat["disk_write_iops"]})
+        statNode.addChild("network", attrs={"rx": "%d" % stat["net_rx"], "tx": "%d" % stat["net_tx"]})
+        return statNode
+
+
+    def iq_health_info_history(self, iq):
+        """
+        get the last samples of the virtual machine according to the limit and step
+        parameters in iq node. step is the number of samples averaged in each returned one
+
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            reply = iq.buildReply("result")
+            query = iq.getTag("query").getTag("archipel")
+            limit = int(query.getAttr("limit") or 1)
+            step  = int(query.getAttr("step") or 1)
+            stats = self.get_collector().get_domain_stats(self.entity.uuid, limit, step)
+            reply.setQueryPayload([self.build_stat_node(stat) for stat in stats])
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VM_HEALTH_HISTORY)
+        return reply
+
+
+    def iq_health_info(self, iq):
+        """
+        send the last sample of the virtual machine
+
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            reply = iq.buildReply("result")
+            stats = self.get_collector().get_domain_stats(self.entity.uuid, 1)
+            reply.setQueryPayload([self.build_stat_node(stat) for stat in stats])
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VM_HEALTH_INFO)
+        return reply
@@ -77,7 +77,7 @@ class TNSnapshoting:
         
         if self.entity.is_migrating and (not action in ("current", "get")):
             reply = build_error_iq(self, "virtual machine is migrating. Can't perform any snapshoting operation", iq, ARCHIPEL_NS_ERROR_MIGRATING)
-        elif action == "take":      reply = self.iq_take(iq)
+        elif action == "take":      reply = self.entity.defer_iq(conn, iq, self.iq_take)
         elif action == "delete":    reply = self.iq_delete(iq)
         elif action == "get":       reply = self.iq_get(iq)
         elif action == "current":   reply = self.iq_getcurrent(iq)
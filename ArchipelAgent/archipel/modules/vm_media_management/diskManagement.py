@@ -76,7 +76,7 @@ class TNMediaManagement:
         self.entity.check_perm(conn, iq, action, -1, prefix="drives_")
         
         if self.entity.is_migrating and (not action in ("get", "getiso")): reply = build_error_iq(self, "virtual machine is migrating. Can't perform any drives operation", iq, ARCHIPEL_NS_ERROR_MIGRATING)
-        elif action == "create":    reply = self.iq_create(iq)
+        elif action == "create":    reply = self.entity.defer_iq(conn, iq, self.iq_create)
         elif action == "delete":    reply = self.iq_delete(iq)
         elif action == "get":       reply = self.iq_get(iq)
         elif action == "getiso":    reply = self.iq_getiso(iq)
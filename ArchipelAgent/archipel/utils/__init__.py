@@ -6,7 +6,7 @@ import sys, os
 import datetime
 import ConfigParser
 import xmpp
-import inspect
+import re
 import logging
 import logging.handlers
 import traceback
@@ -23,6 +23,7 @@ ARCHIPEL_NS_GENERIC_ERROR                       = "archipel:error:generic"
 ARCHIPEL_NS_IQ_PUSH                             = "archipel:push"
 ARCHIPEL_NS_SERVICE_MESSAGE                     = "headline"
 ARCHIPEL_NS_HYPERVISOR_CONTROL                  = "archipel:hypervisor:control"
+ARCHIPEL_NS_HYPERVISOR_ADMIN                    = "archipel:hypervisor:admin"
 ARCHIPEL_NS_VM_CONTROL                          = "archipel:vm:control"
 ARCHIPEL_NS_VM_DEFINITION                       = "archipel:vm:definition"
 ARCHIPEL_NS_AVATAR                              = "archipel:avatar"
@@ -63,6 +64,11 @@ ARCHIPEL_LOG_INFO                               = 1
 ARCHIPEL_LOG_WARNING                            = 2
 ARCHIPEL_LOG_ERROR                              = 3
 
+ARCHIPEL_LOG_LEVELS_MAP                         = {  ARCHIPEL_LOG_DEBUG: logging.DEBUG,
+                                                    ARCHIPEL_LOG_INFO: logging.INFO,
+                                                    ARCHIPEL_LOG_WARNING: logging.WARNING,
+                                                    ARCHIPEL_LOG_ERROR: logging.ERROR }
+
 # hypervisor kinds
 ARCHIPEL_HYPERVISOR_TYPE_QEMU                   = "QEMU"
 ARCHIPEL_HYPERVISOR_TYPE_XEN                    = "XEN"
@@ -70,60 +76,74 @@ ARCHIPEL_HYPERVISOR_TYPE_XEN                    = "XEN"
 log = logging.getLogger('archipel')
 
 class TNArchipelLogger:
+    """
+    this class is the logger of the entities. Disabled levels are skipped
+    before doing anything. The message is only formatted by the handlers, and
+    the caller informations are read from the frame of the caller, not from
+    the whole stack. Records contain the entity informations as extra
+    fields (entity_jid, entity_class, entity_type, caller)
+    """
     def __init__(self, entity, pubsubnode=None, xmppconn=None):
         self.xmppclient = xmppconn
         self.entity     = entity
         self.pubSubNode = pubsubnode
+        self.logger     = logging.getLogger('archipel')
+        self.jid        = str(self.entity.jid)
+        self.classname  = self.entity.__class__.__name__
+        self.prefix     = "\033[33m%s.%%s (%s)\033[0m::" % (self.classname, self.jid.replace("%", "%%"))
     
-    def __log(self, level, msg):
-        log = logging.getLogger('archipel')
-        msg = "\033[33m%s.%s (%s)\033[0m::%s" % (self.entity.__class__.__name__, inspect.stack()[2][3],  self.entity.jid, msg)
-        if level < ARCHIPEL_LOG_LEVEL: 
+    def __log(self, level, msg, args):
+        pylevel = ARCHIPEL_LOG_LEVELS_MAP[level]
+        if level < ARCHIPEL_LOG_LEVEL or not self.logger.isEnabledFor(pylevel):
             return
-        elif level == ARCHIPEL_LOG_DEBUG:
-            log.debug(msg)
-        elif level == ARCHIPEL_LOG_INFO:
-            log.info(msg)
-        elif level == ARCHIPEL_LOG_WARNING:
-            log.warning(msg)
-        elif level == ARCHIPEL_LOG_ERROR:
-             log.error(msg)
-            
+        frame   = sys._getframe(2)
+        caller  = frame.f_code.co_name
+        prefix  = self.prefix % caller
+        if args:
+            prefix = prefix.replace("%", "%%")
+        extra   = { "entity_jid": self.jid,
+                    "entity_class": self.classname,
+                    "entity_type": getattr(self.entity, "entity_type", None),
+                    "caller": caller }
+        record  = self.logger.makeRecord(self.logger.name, pylevel, frame.f_code.co_filename, frame.f_lineno, prefix + msg, args, None, caller, extra)
+        self.logger.handle(record)
+        
         # if self.xmppclient and self.pubSubNode:
         #     log = xmpp.Node(tag="log", attrs={"date": datetime.datetime.now(), "level": str(level)})
         #     log.setData(msg)
         #     self.pubSubNode.add_item(log)
     
-        
-        
-    def debug(self, msg):
-        self.__log(ARCHIPEL_LOG_DEBUG, msg)
     
+    def debug(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_DEBUG, msg, args)
     
-    def info(self, msg):
-        self.__log(ARCHIPEL_LOG_INFO, msg)
     
+    def info(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_INFO, msg, args)
     
-    def warning(self, msg):
-        self.__log(ARCHIPEL_LOG_WARNING, msg)
     
+    def warning(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_WARNING, msg, args)
     
-    def error(self, msg):
-        self.__log(ARCHIPEL_LOG_ERROR, msg)
+    
+    def error(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_ERROR, msg, args)
     
 
 
 class ColorFormatter(logging.Formatter):
+    COLORS      = { "DEBUG":        "\033[35mDEBUG   \033[0m",
+                    "INFO":         "\033[32mINFO    \033[0m",
+                    "WARNING":      "\033[33mWARNING \033[0m",
+                    "ERROR":        "\033[31mERROR   \033[0m",
+                    "CRITICAL":     "\033[31mCRITICAL\033[0m",
+                    "$whiteColor":  "\033[37m",
+                    "$noColor":     "\033[0m" }
+    COLORS_RE   = re.compile("|".join([re.escape(k) for k in COLORS.keys()]))
+    
     def format(self, record):
         rec = logging.Formatter.format(self, record)
-        rec = rec.replace("DEBUG",      "\033[35mDEBUG   \033[0m")
-        rec = rec.replace("INFO",       "\033[32mINFO    \033[0m")
-        rec = rec.replace("WARNING",    "\033[33mWARNING \033[0m")
-        rec = rec.replace("ERROR",      "\033[31mERROR   \033[0m")
-        rec = rec.replace("CRITICAL",   "\033[31mCRITICAL\033[0m")
-        rec = rec.replace("$whiteColor",    "\033[37m")
-        rec = rec.replace("$noColor",       "\033[0m")
-        return rec
+        return self.COLORS_RE.sub(lambda m: self.COLORS[m.group(0)], rec)
     
 
 
@@ -167,8 +187,8 @@ def init_conf(path):
 
 def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
     #traceback.print_exc(file=sys.stdout, limit=20)
-    caller = inspect.stack()[1][3]
-    log.error("%s.%s: exception raised is : %s" % (originclass, caller, ex))
+    caller = sys._getframe(1).f_code.co_name
+    log.error("%s.%s: exception raised is : %s", originclass, caller, ex)
     reply = iq.buildReply('error')
     reply.setQueryPayload(iq.getQueryPayload())
     error = xmpp.Node("error", attrs={"code": code, "type": "cancel"})
@@ -179,6 +199,6 @@ def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
 
 
 def build_error_message(originclass, ex):
-    caller = inspect.stack()[3][3]
-    log.error("%s: exception raised is : %s" % (caller, str(ex)))
+    caller = sys._getframe(3).f_code.co_name
+    log.error("%s: exception raised is : %s", caller, ex)
     return str(ex)
@@ -80,6 +80,7 @@ setup(name='archipel-agent',
         'install/bin/archipel-tagnode',
         'install/bin/archipel-updatedomain',
         'install/bin/archipel-initinstall',
+        'install/bin/archipel-migratestore',
         'install/bin/runarchipel'
         ],
       data_files=[
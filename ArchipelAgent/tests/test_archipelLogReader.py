@@ -0,0 +1,131 @@
+#
+# test_archipelLogReader.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+# the package of the module registers itself in the hypervisor, that needs libvirt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "archipel", "modules", "hypervisor_health"))
+from archipelLogReader import TNLogReader
+
+
+def record(level, i, date="2011-01-01 10:00:00"):
+    return "%s::%s::file.py:%d::message %d" % (level, date, i, i)
+
+
+class TestLogReader(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "archipel.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, path, lines):
+        f = open(path, "w")
+        f.write("\n".join(lines) + "\n")
+        f.close()
+
+    def messages(self, records):
+        return [r["message"] for r in records]
+
+    def read_all(self, reader, limit, **kwargs):
+        pages = []
+        records, cursor = reader.read(limit, **kwargs)
+        pages.append(self.messages(records))
+        while cursor:
+            records, cursor = reader.read(limit, cursor=cursor, **kwargs)
+            pages.append(self.messages(records))
+        return pages
+
+    def test_newest_first(self):
+        self.write(self.path, [record("INFO", i) for i in range(5)])
+        records, cursor = TNLogReader(self.path).read(3)
+        self.assertEqual(self.messages(records), ["message 4", "message 3", "message 2"])
+        self.assertEqual(records[0]["level"], "INFO")
+        self.assertEqual(records[0]["file"], "file.py:4")
+        self.assertTrue(cursor)
+
+    def test_no_file(self):
+        self.assertEqual(TNLogReader(self.path).read(10), ([], None))
+
+    def test_last_page(self):
+        self.write(self.path, [record("INFO", i) for i in range(3)])
+        self.assertEqual(TNLogReader(self.path).read(3)[1], None)
+        self.assertEqual(TNLogReader(self.path).read(10)[1], None)
+
+    def test_pages_across_rotated_files(self):
+        self.write(self.path + ".2", [record("INFO", i) for i in range(0, 3)])
+        self.write(self.path + ".1", [record("INFO", i) for i in range(3, 6)])
+        self.write(self.path, [record("INFO", i) for i in range(6, 9)])
+        pages = self.read_all(TNLogReader(self.path, block_size=16), 2)
+        self.assertEqual(pages, [["message 8", "message 7"], ["message 6", "message 5"], ["message 4", "message 3"],
+                                 ["message 2", "message 1"], ["message 0"]])
+
+    def test_cursor_follows_rotation(self):
+        self.write(self.path + ".1", [record("INFO", i) for i in range(0, 3)])
+        self.write(self.path, [record("INFO", i) for i in range(3, 6)])
+        reader = TNLogReader(self.path)
+        records, cursor = reader.read(2)
+        self.assertEqual(self.messages(records), ["message 5", "message 4"])
+        os.rename(self.path + ".1", self.path + ".2")
+        os.rename(self.path, self.path + ".1")
+        self.write(self.path, [record("INFO", 6)])
+        records, cursor = reader.read(2, cursor=cursor)
+        self.assertEqual(self.messages(records), ["message 3", "message 2"])
+
+    def test_continuation_lines(self):
+        self.write(self.path, [record("INFO", 0), record("ERROR", 1), "Traceback:", "  line", record("INFO", 2)])
+        records, cursor = TNLogReader(self.path, block_size=8).read(10)
+        self.assertEqual(self.messages(records), ["message 2", "message 1\nTraceback:\n  line", "message 0"])
+        self.assertEqual(records[1]["line"], record("ERROR", 1) + "\nTraceback:\n  line")
+
+    def test_colored_levels(self):
+        self.write(self.path, ["\033[32mINFO\033[0m::2011-01-01 10:00:00::file.py:1::colored"])
+        records, cursor = TNLogReader(self.path).read(10)
+        self.assertEqual(records[0]["level"], "INFO")
+
+    def test_levels_and_search(self):
+        self.write(self.path, [record("INFO", 0), record("ERROR", 1), record("DEBUG", 2), record("ERROR", 13)])
+        reader = TNLogReader(self.path)
+        self.assertEqual(self.messages(reader.read(10, levels=["error"])[0]), ["message 13", "message 1"])
+        self.assertEqual(self.messages(reader.read(10, search="message 1")[0]), ["message 13", "message 1"])
+        self.assertEqual(self.messages(reader.read(10, levels=["info"], search="message 1")[0]), [])
+
+    def test_paged_filter(self):
+        self.write(self.path + ".1", [record("ERROR", 0), record("INFO", 1)])
+        self.write(self.path, [record("ERROR", 2), record("INFO", 3), record("ERROR", 4)])
+        pages = self.read_all(TNLogReader(self.path), 2, levels=["ERROR"])
+        self.assertEqual(pages, [["message 4", "message 2"], ["message 0"]])
+
+    def test_dates(self):
+        dates = ["2011-01-01 10:00:00", "2011-01-01 11:00:00", "2011-01-01 12:00:00"]
+        self.write(self.path, [record("INFO", i, dates[i]) for i in range(3)])
+        reader = TNLogReader(self.path)
+        timestamp = time.mktime(time.strptime(dates[1], "%Y-%m-%d %H:%M:%S"))
+        self.assertEqual(self.messages(reader.read(10, start=timestamp)[0]), ["message 2", "message 1"])
+        self.assertEqual(self.messages(reader.read(10, end=timestamp)[0]), ["message 1", "message 0"])
+        self.assertEqual(reader.read(10, start=timestamp)[1], None)
+
+
+if __name__ == "__main__":
+    unittest.main()
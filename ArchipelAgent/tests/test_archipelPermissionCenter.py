@@ -0,0 +1,97 @@
+#
+# test_archipelPermissionCenter.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from archipel.core.archipelStore import TNArchipelStore
+from archipel.core.archipelPermissionCenter import TNArchipelPermissionCenter
+
+
+class TestPermissionCenterCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = TNArchipelStore(os.path.join(self.folder, "store.sqlite3"))
+        self.center = TNArchipelPermissionCenter(self.store, "vm@archipel", "admin@archipel")
+        for name in ("perm1", "perm2", "all"):
+            self.center.create_permission(name)
+        self.center.create_user("user")
+        self.center.create_role("role")
+        self.center.give_role_to_user("role", "user")
+
+    def tearDown(self):
+        self.store.permissions_connection.close()
+        shutil.rmtree(self.folder)
+
+    def test_root_admin_has_all_permissions(self):
+        self.assertTrue(self.center.check_permission("admin@archipel", "perm1"))
+
+    def test_unknown_user_is_denied(self):
+        self.assertFalse(self.center.check_permission("nobody", "perm1"))
+
+    def test_direct_permission(self):
+        self.assertFalse(self.center.check_permission("user", "perm1"))
+        self.center.grant_permission_to_user("perm1", "user")
+        self.assertTrue(self.center.check_permission("user", "perm1"))
+        self.center.revoke_permission_to_user("perm1", "user")
+        self.assertFalse(self.center.check_permission("user", "perm1"))
+
+    def test_role_permission(self):
+        self.center.grant_permission_to_role("perm2", "role")
+        self.assertTrue(self.center.check_permission("user", "perm2"))
+        self.center.retract_role_to_user("role", "user")
+        self.assertFalse(self.center.check_permission("user", "perm2"))
+
+    def test_revoked_role_permission(self):
+        self.center.grant_permission_to_role("perm2", "role")
+        self.assertTrue(self.center.check_permission("user", "perm2"))
+        self.center.revoke_permission_to_role("perm2", "role")
+        self.assertFalse(self.center.check_permission("user", "perm2"))
+
+    def test_all_granted_directly(self):
+        self.center.grant_permission_to_user("all", "user")
+        self.assertTrue(self.center.check_permission("user", "perm1"))
+
+    def test_all_granted_by_a_role(self):
+        self.center.grant_permission_to_role("all", "role")
+        self.assertFalse(self.center.check_permission("user", "perm1"))
+
+    def test_deleted_user_is_denied(self):
+        self.center.grant_permission_to_user("perm1", "user")
+        self.assertTrue(self.center.check_permission("user", "perm1"))
+        self.center.delete_user("user")
+        self.assertFalse(self.center.check_permission("user", "perm1"))
+
+    def test_deleted_permission_is_denied(self):
+        self.center.grant_permission_to_user("perm1", "user")
+        self.assertTrue(self.center.check_permission("user", "perm1"))
+        self.center.delete_permission("perm1")
+        self.assertFalse(self.center.check_permission("user", "perm1"))
+
+    def test_cache_is_built_once(self):
+        self.center.check_permission("user", "perm1")
+        self.center.grant_permission_to_user("perm1", "user")
+        self.center.check_permission("user", "perm1")
+        self.center.check_permission("user", "perm2")
+        self.assertEqual(self.center.get_permission_cache_stats(), {"hits": 2, "misses": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
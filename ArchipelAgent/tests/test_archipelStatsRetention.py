@@ -0,0 +1,122 @@
+#
+# test_archipelStatsRetention.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# the package of the module registers itself in the hypervisor, that needs libvirt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "archipel", "modules", "hypervisor_health"))
+from archipelStatsRetention import TNStatsRetention, ARCHIPEL_HEALTH_METRICS
+
+
+TIERS = (("raw", 0, 3600), ("minute", 60, 7200), ("hour", 3600, 86400))
+
+
+def sample(date, cpu_idle):
+    return (date, cpu_idle) + (0,) * (len(ARCHIPEL_HEALTH_METRICS) - 1)
+
+
+class TestStatsRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.database_file = os.path.join(self.folder, "stats.sqlite3")
+        self.base = int(time.time() / 60) * 60 - 600
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def query(self, retention, resolution):
+        tier, samples = retention.query(0, time.time() + 3600, resolution)
+        return [(s["date"], s.get("cpu_idle_min"), s["cpu_idle"], s.get("cpu_idle_max")) for s in samples]
+
+    def test_raw_samples(self):
+        retention = TNStatsRetention(self.database_file, TIERS)
+        retention.add_samples([sample(self.base, 1), sample(self.base + 1, 2)])
+        self.assertEqual([row[0:2] for row in retention.get_last_raw_samples(10)], [(self.base, 1), (self.base + 1, 2)])
+        self.assertEqual([row[0:2] for row in retention.get_last_raw_samples(1)], [(self.base + 1, 2)])
+
+    def test_rollup_complete_buckets(self):
+        retention = TNStatsRetention(self.database_file, TIERS)
+        retention.add_samples([sample(self.base, 1), sample(self.base + 20, 2), sample(self.base + 40, 3),
+                               sample(self.base + 60, 10), sample(self.base + 130, 4)])
+        self.assertEqual(self.query(retention, "minute"), [(self.base + 60, 10, 10, 10), (self.base, 1, 2, 3)])
+
+    def test_rollup_next_buckets(self):
+        retention = TNStatsRetention(self.database_file, TIERS)
+        retention.add_samples([sample(self.base, 1), sample(self.base + 60, 10), sample(self.base + 130, 4)])
+        retention.add_samples([sample(self.base + 140, 6), sample(self.base + 190, 0)])
+        self.assertEqual(self.query(retention, "minute"), [(self.base + 120, 4, 5, 6), (self.base + 60, 10, 10, 10), (self.base, 1, 1, 1)])
+
+    def test_rollup_of_rollups(self):
+        retention = TNStatsRetention(self.database_file, TIERS)
+        hour = int(time.time() / 3600) * 3600 - 7200
+        retention.add_samples([sample(hour, 1), sample(hour + 1800, 3), sample(hour + 3600, 5), sample(hour + 3660, 0)])
+        tier, samples = retention.query(0, time.time(), "hour")
+        self.assertEqual([(s["date"], s["cpu_idle_min"], s["cpu_idle_max"]) for s in samples], [(hour, 1, 3)])
+
+    def test_purge_retention(self):
+        retention = TNStatsRetention(self.database_file, TIERS)
+        now = time.time()
+        retention.add_samples([sample(now - 7200, 1), sample(now - 10, 2)])
+        self.assertEqual([row[0] for row in retention.get_last_raw_samples(10)], [now - 10])
+
+    def test_purge_max_raw_rows(self):
+        retention = TNStatsRetention(self.database_file, TIERS, max_raw_rows=2)
+        retention.add_samples([sample(self.base + i, i) for i in range(4)])
+        self.assertEqual([row[1] for row in retention.get_last_raw_samples(10)], [2, 3])
+
+    def test_choose_tier(self):
+        retention = TNStatsRetention(self.database_file, TIERS)
+        now = time.time()
+        self.assertEqual(retention.query(now - 600, now, "auto", 2000)[0][0], "raw")
+        self.assertEqual(retention.query(now - 600, now, "auto", 100)[0][0], "minute")
+        self.assertEqual(retention.query(now - 5000, now, "auto", 2000)[0][0], "minute")
+        self.assertEqual(retention.query(now - 10000, now, "auto", 2000)[0][0], "hour")
+        self.assertRaises(Exception, retention.query, now - 600, now, "day")
+
+    def test_import_legacy_tables(self):
+        date = int(time.time()) - 600
+        local_date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(date))
+        database = sqlite3.connect(self.database_file)
+        database.execute("create table cpu (collection_date date, idle int)")
+        database.execute("create table memory (collection_date date, free integer, used integer, total integer, swapped integer)")
+        database.execute("create table disk (collection_date date, total int, used int, free int, free_percentage int)")
+        database.execute("create table load (collection_date date, one float, five float, fifteen float)")
+        database.execute("insert into cpu values(?, 90)", (local_date,))
+        database.execute("insert into memory values(?, 1, 2, 3, 4)", (local_date,))
+        database.execute("insert into load values(?, 0.5, 0.25, 0.125)", (local_date,))
+        database.execute("insert into disk values(?, 100, 40, 60, 40)", (local_date,))
+        database.commit()
+        database.close()
+
+        retention = TNStatsRetention(self.database_file, TIERS)
+        rows = retention.get_last_raw_samples(10)
+        self.assertEqual(len(rows), 1)
+        self.assertAlmostEqual(rows[0][0], date, 2)
+        self.assertEqual(rows[0][1:], (90, 1, 2, 3, 4, 0.5, 0.25, 0.125, 100, 40, 60, 40))
+        tables = [row[0] for row in retention.database.execute("select name from sqlite_master where type='table'")]
+        self.assertEqual(sorted(tables), ["health_hour", "health_minute", "health_raw"])
+
+
+if __name__ == "__main__":
+    unittest.main()
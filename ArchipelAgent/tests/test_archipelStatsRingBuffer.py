@@ -0,0 +1,84 @@
+#
+# test_archipelStatsRingBuffer.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+# the package of the module registers itself in the hypervisor, that needs libvirt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "archipel", "modules", "hypervisor_health"))
+from archipelStatsRingBuffer import TNStatsRingBuffer
+
+
+class TestStatsRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = TNStatsRingBuffer(("date", "value", "count"), 3, ("count",))
+
+    def test_empty(self):
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(self.buffer.get_last(10), [])
+
+    def test_append_newest_first(self):
+        self.buffer.append((1.0, 0.5, 10))
+        self.buffer.append((2.0, 1.5, 20))
+        self.assertEqual(self.buffer.get_last_rows(10), [(2.0, 1.5, 20), (1.0, 0.5, 10)])
+        self.assertEqual(self.buffer.get_last(1), [{"date": 2.0, "value": 1.5, "count": 20}])
+
+    def test_integer_columns(self):
+        self.buffer.append((1.0, 0.5, 10))
+        row = self.buffer.get_last_rows(1)[0]
+        self.assertTrue(isinstance(row[2], (int, long)))
+        self.assertTrue(isinstance(row[1], float))
+
+    def test_append_drops_the_oldest(self):
+        for i in range(5):
+            self.buffer.append((float(i), 0.0, i))
+        self.assertEqual(len(self.buffer), 3)
+        self.assertEqual([row[0] for row in self.buffer.get_last_rows(10)], [4.0, 3.0, 2.0])
+        self.assertEqual(self.buffer.get_appended_count(), 5)
+
+    def test_extend(self):
+        self.buffer.append((0.0, 0.0, 0))
+        self.buffer.extend([(1.0, 0.0, 1), (2.0, 0.0, 2)])
+        self.assertEqual([row[0] for row in self.buffer.get_last_rows(10)], [2.0, 1.0, 0.0])
+
+    def test_extend_wraps(self):
+        self.buffer.append((0.0, 0.0, 0))
+        self.buffer.append((1.0, 0.0, 1))
+        self.buffer.extend([(2.0, 0.0, 2), (3.0, 0.0, 3)])
+        self.assertEqual([row[0] for row in self.buffer.get_last_rows(10)], [3.0, 2.0, 1.0])
+
+    def test_extend_more_than_capacity(self):
+        self.buffer.extend([(float(i), 0.0, i) for i in range(7)])
+        self.assertEqual(len(self.buffer), 3)
+        self.assertEqual([row[0] for row in self.buffer.get_last_rows(10)], [6.0, 5.0, 4.0])
+        self.assertEqual(self.buffer.get_appended_count(), 7)
+
+    def test_extend_nothing(self):
+        self.buffer.extend([])
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_limit(self):
+        for i in range(3):
+            self.buffer.append((float(i), 0.0, i))
+        self.assertEqual(len(self.buffer.get_last_rows(2)), 2)
+        self.assertEqual(self.buffer.get_last_rows(0), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
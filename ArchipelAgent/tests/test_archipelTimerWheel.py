@@ -0,0 +1,94 @@
+#
+# test_archipelTimerWheel.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+from archipel.core.archipelTimerWheel import TNArchipelTimerWheel, TNArchipelTimerWheelEntry
+
+
+class TestTimerWheelSlots(unittest.TestCase):
+
+    def setUp(self):
+        # 4 slots and 3 levels: level 0 covers 4 ticks, level 1 16 ticks, level 2 64 ticks
+        self.wheel = TNArchipelTimerWheel(tick=1.0, slots=4, levels=3)
+
+    def due_tick(self, expiry, limit=1000):
+        entry = TNArchipelTimerWheelEntry(expiry, None, (), None)
+        self.wheel.place(entry)
+        for i in range(limit):
+            if entry in self.wheel.advance():
+                return self.wheel.current
+        return None
+
+    def test_first_level(self):
+        self.assertEqual(self.due_tick(1), 1)
+        self.assertEqual(self.due_tick(self.wheel.current + 3), 4)
+
+    def test_cascade(self):
+        self.assertEqual(self.due_tick(10), 10)
+
+    def test_beyond_the_top_level(self):
+        self.assertEqual(self.due_tick(100), 100)
+        self.assertEqual(self.due_tick(self.wheel.current + 500), 600)
+
+    def test_all_delays_from_all_positions(self):
+        for start in range(0, 70, 3):
+            for delay in range(1, 150, 7):
+                self.wheel.current = start
+                self.assertEqual(self.due_tick(start + delay), start + delay, "start %d delay %d" % (start, delay))
+
+    def test_entries_of_the_same_slot(self):
+        entries = [TNArchipelTimerWheelEntry(expiry, None, (), None) for expiry in (5, 9, 5)]
+        for entry in entries:
+            self.wheel.place(entry)
+        due = {}
+        for i in range(12):
+            for entry in self.wheel.advance():
+                due[entries.index(entry)] = self.wheel.current
+        self.assertEqual(due, {0: 5, 1: 9, 2: 5})
+
+
+class TestTimerWheelThread(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TNArchipelTimerWheel(tick=0.01, slots=4, levels=3)
+
+    def test_schedule(self):
+        done = threading.Event()
+        values = []
+        def callback(value):
+            values.append(value)
+            done.set()
+        self.wheel.schedule(0.05, callback, "value")
+        done.wait(5)
+        self.assertEqual(values, ["value"])
+
+    def test_cancel(self):
+        done = threading.Event()
+        called = []
+        self.wheel.schedule(0.02, called.append, "cancelled").cancel()
+        self.wheel.schedule(0.1, done.set)
+        done.wait(5)
+        self.assertTrue(done.isSet())
+        self.assertEqual(called, [])
+        stats = self.wheel.get_stats()
+        self.assertEqual((stats["scheduled"], stats["cancelled"], stats["pending"]), (2, 1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#
+# test_pubsub.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import xmpp
+from archipel.core.pubsub import TNPubSubNode, XMPP_NS_RSM
+
+
+def page(ids, last=None, rsm=True, typ="result"):
+    iq = xmpp.Iq(typ=typ)
+    items = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB).addChild("items", attrs={"node": "/node"})
+    for item_id in ids:
+        items.addChild("item", attrs={"id": item_id})
+    if rsm:
+        rsm_node = iq.getTag("pubsub").addChild("set", namespace=XMPP_NS_RSM)
+        if last: rsm_node.addChild("last").setData(last)
+    return iq
+
+
+class FakeClient:
+
+    def __init__(self, responses):
+        self.responses  = list(responses)
+        self.sent       = []
+
+    def SendAndWaitForResponse(self, iq):
+        self.sent.append(iq)
+        return self.responses.pop(0)
+
+
+def after(iq):
+    return iq.getTag("pubsub").getTag("set", namespace=XMPP_NS_RSM).getTagData("after")
+
+
+class TestPubSubItemsPages(unittest.TestCase):
+
+    def setUp(self):
+        self.node = TNPubSubNode(None, "pubsub.archipel", "/node")
+        self.node.page_size = 2
+
+    def test_page_with_more(self):
+        content = {}
+        self.assertEqual(self.node.read_items_page(page(["a", "b"], "b"), content, None), ("b", True))
+        self.assertEqual(sorted(content.keys()), ["a", "b"])
+
+    def test_short_page_is_the_last(self):
+        self.assertEqual(self.node.read_items_page(page(["a"], "a"), {}, None), ("a", False))
+
+    def test_empty_page(self):
+        self.assertEqual(self.node.read_items_page(page([]), {}, "b"), (None, False))
+
+    def test_same_last_is_the_last(self):
+        self.assertEqual(self.node.read_items_page(page(["a", "b"], "b"), {}, "b"), ("b", False))
+
+    def test_no_paging_support(self):
+        content = {}
+        self.assertEqual(self.node.read_items_page(page(["a", "b", "c"], rsm=False), content, None), (None, False))
+        self.assertEqual(len(content), 3)
+
+    def test_store_item_replaces_and_drops_oldest(self):
+        self.node.max_items = 2
+        for item_id in ("a", "b", "a", "c"):
+            self.node.store_item(xmpp.Node("item", attrs={"id": item_id}))
+        self.assertEqual([item.getAttr("id") for item in self.node.get_items()], ["a", "c"])
+
+    def test_retrieve_all_pages(self):
+        client = FakeClient([page(["a", "b"], "b"), page(["c", "d"], "d"), page(["e"], "e")])
+        self.node.xmppclient = client
+        self.assertTrue(self.node.retrieve_items(wait=True))
+        self.assertEqual([after(iq) for iq in client.sent], [None, "b", "d"])
+        self.assertEqual(self.node.content.keys(), ["a", "b", "c", "d", "e"])
+        self.assertEqual(self.node.get_cursor(), "e")
+
+    def test_retrieve_since_cursor(self):
+        self.node.xmppclient = FakeClient([page(["a", "b"], "b"), page([])])
+        self.node.retrieve_items(wait=True)
+        client = FakeClient([page(["c"], "c")])
+        self.node.xmppclient = client
+        self.assertTrue(self.node.retrieve_items(wait=True, since=self.node.get_cursor()))
+        self.assertEqual([after(iq) for iq in client.sent], ["b"])
+        self.assertEqual(self.node.content.keys(), ["a", "b", "c"])
+        self.assertEqual(self.node.get_cursor(), "c")
+
+    def test_retrieve_since_unknown_cursor(self):
+        client = FakeClient([page([], typ="error"), page(["a"], "a")])
+        self.node.xmppclient = client
+        self.assertTrue(self.node.retrieve_items(wait=True, since="gone"))
+        self.assertEqual([after(iq) for iq in client.sent], ["gone", None])
+        self.assertEqual(self.node.content.keys(), ["a"])
+
+    def test_retrieve_error(self):
+        self.node.xmppclient = FakeClient([page([], typ="error")])
+        self.assertFalse(self.node.retrieve_items(wait=True))
+        self.assertFalse(self.node.recovered)
+
+
+if __name__ == "__main__":
+    unittest.main()